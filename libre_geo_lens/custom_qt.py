@@ -1,15 +1,17 @@
 import os
-import json
 import subprocess
+import markdown
 from PIL import Image
-from qgis.PyQt.QtGui import QPixmap, QImage, QColor
-from qgis.PyQt.QtCore import Qt, QTimer
+from qgis.PyQt.QtGui import QPixmap, QImage, QColor, QTextCursor
+from qgis.PyQt.QtCore import Qt, QTimer, QAbstractListModel, QModelIndex, QObject, QElapsedTimer
 from qgis.PyQt.QtWidgets import (QMessageBox, QInputDialog, QLabel, QVBoxLayout, QPushButton, QWidget,
                                  QDialog, QScrollArea, QTextBrowser, QHBoxLayout)
 from qgis.core import (QgsRectangle, QgsWkbTypes, QgsProject, QgsGeometry, QgsPointXY,
                        QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsFeatureRequest)
 from qgis.gui import QgsMapToolEmitPoint, QgsRubberBand
 
+from .utils.raw_image_utils import best_raw_chip_path
+
 
 def zoom_to_and_flash_feature(feature, canvas, layer):
     if not feature or not feature.geometry():
@@ -61,6 +63,201 @@ class CustomTextBrowser(QTextBrowser):
         super().setSource(url)  # Call parent method for other links
 
 
+class StreamingMarkdownRenderer(QObject):
+    """
+    Renders a markdown response at the end of a text browser while it's being streamed.
+    Completed blocks (up to the last blank line outside of a code fence) are rendered once and appended through
+    a cursor, and only the block in progress is re-rendered, at most once every `interval_ms`.
+    If anything else changes the document meanwhile, the block in progress is looked for again before rendering.
+    """
+    def __init__(self, text_browser, prefix="", interval_ms=100, parent=None):
+        super().__init__(parent)
+        self.text_browser = text_browser
+        self.document = text_browser.document()
+        self.completed_text = ""  # Markdown rendered for good
+        self.pending_text = prefix  # Markdown not rendered for good yet
+        self.interval_ms = interval_ms
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.render)
+        self.last_render = QElapsedTimer()
+
+        # The response goes in its own block, and everything after tail_start gets re-rendered
+        cursor = QTextCursor(self.document)
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertBlock()
+        self.tail_start = cursor.position()
+        self.tail_text = ""  # What's after tail_start, as last rendered
+        self.rendering = False
+        self.document_changed = False
+        self.document.contentsChange.connect(self.on_contents_change)
+
+    def append(self, text):
+        self.pending_text += text
+        if not self.render_timer.isActive():
+            elapsed = self.last_render.elapsed() if self.last_render.isValid() else self.interval_ms
+            self.render_timer.start(max(0, self.interval_ms - elapsed))
+
+    def stop(self):
+        self.render_timer.stop()
+
+    def on_contents_change(self, position, chars_removed, chars_added):
+        if not self.rendering:
+            self.document_changed = True
+
+    def text_from(self, position):
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(position)
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        return cursor.selectedText()
+
+    def find_tail(self, cursor):
+        """
+        Point tail_start at the block in progress again after the document was changed by something else,
+        e.g. rewritten with setHtml. If it's not at the end anymore, the response is rendered again there.
+        """
+        cursor.movePosition(QTextCursor.End)
+        tail_start = cursor.position() - len(self.tail_text)
+        if self.tail_text and tail_start >= 0 and self.text_from(tail_start) == self.tail_text:
+            self.tail_start = tail_start
+            return
+        cursor.insertBlock()
+        if self.completed_text:
+            cursor.insertHtml(markdown.markdown(self.completed_text))
+            cursor.insertBlock()
+        self.tail_start = cursor.position()
+
+    def completed_blocks_end(self):
+        """Index of the last blank line of the pending text that isn't inside a code fence, -1 if none"""
+        end = self.pending_text.rfind("\n\n")
+        while end >= 0 and self.pending_text.count("```", 0, end) % 2 == 1:
+            end = self.pending_text.rfind("\n\n", 0, end)
+        return end
+
+    def render(self):
+        self.last_render.start()
+        self.rendering = True
+        try:
+            cursor = QTextCursor(self.document)
+            if self.document_changed:
+                self.find_tail(cursor)
+                self.document_changed = False
+            cursor.setPosition(self.tail_start)
+            cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+
+            end = self.completed_blocks_end()
+            if end > 0:
+                cursor.insertHtml(markdown.markdown(self.pending_text[:end]))
+                cursor.insertBlock()
+                self.tail_start = cursor.position()
+                self.completed_text += self.pending_text[:end + 2]
+                self.pending_text = self.pending_text[end + 2:]
+            cursor.insertHtml(markdown.markdown(self.pending_text))
+            self.tail_text = self.text_from(self.tail_start)
+        finally:
+            self.rendering = False
+        self.text_browser.verticalScrollBar().setValue(self.text_browser.verticalScrollBar().maximum())
+
+
+class ChatListModel(QAbstractListModel):
+    """
+    Chats list backed by the logs database, newest first, fetched a page at a time as the view scrolls.
+    When a filter is set (e.g. search results) only those chats are listed.
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, logs_db, parent=None):
+        super().__init__(parent)
+        self.logs_db = logs_db
+        self.chats = []  # Loaded [chat_id, summary] rows
+        self.total_count = 0
+        self.filtered = False
+
+    def reload(self):
+        """Drop the loaded rows and start again from the first page of all chats"""
+        self.beginResetModel()
+        self.chats = []
+        self.total_count = self.logs_db.count_chats()
+        self.filtered = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def set_filter(self, chats):
+        """Only list the given (chat_id, summary) rows, or all the chats again if None"""
+        if chats is None:
+            self.reload()
+            return
+        self.beginResetModel()
+        self.chats = [[chat_id, summary] for chat_id, summary in chats]
+        self.total_count = len(self.chats)
+        self.filtered = True
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.chats)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.chats):
+            return None
+        chat_id, summary = self.chats[index.row()]
+        if role == Qt.DisplayRole:
+            return summary if summary else "New chat"
+        if role == Qt.UserRole:
+            return chat_id
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and len(self.chats) < self.total_count
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        offset = len(self.chats)
+        page = self.logs_db.fetch_chat_summaries(offset, self.PAGE_SIZE)
+        if not page:  # Chats were deleted since counting
+            self.total_count = offset
+            return
+        self.beginInsertRows(QModelIndex(), offset, offset + len(page) - 1)
+        self.chats.extend([chat_id, summary] for chat_id, summary in page)
+        self.endInsertRows()
+
+    def row_of_chat(self, chat_id, fetch=False):
+        """Row of the chat among the loaded ones (fetching more pages until it's found if fetch), or -1"""
+        checked_rows = 0
+        while True:
+            for row in range(checked_rows, len(self.chats)):
+                if self.chats[row][0] == chat_id:
+                    return row
+            checked_rows = len(self.chats)
+            if not fetch or not self.canFetchMore(QModelIndex()):
+                return -1
+            self.fetchMore(QModelIndex())
+
+    def add_chat(self, chat_id, summary=""):
+        """Show a newly created chat at the top"""
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self.chats.insert(0, [chat_id, summary])
+        self.total_count += 1
+        self.endInsertRows()
+
+    def remove_chat(self, chat_id):
+        row = self.row_of_chat(chat_id)
+        if row < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.chats[row]
+        self.total_count -= 1
+        self.endRemoveRows()
+
+    def set_summary(self, chat_id, summary):
+        row = self.row_of_chat(chat_id)
+        if row < 0:
+            return
+        self.chats[row][1] = summary
+        self.dataChanged.emit(self.index(row), self.index(row), [Qt.DisplayRole])
+
+
 class ImageDisplayWidget(QWidget):
     def __init__(self, parent=None, canvas=None, log_layer=None):
         super().__init__(parent)
@@ -194,13 +391,16 @@ class ImageDisplayWidget(QWidget):
         # Remove the corresponding image data
         del self.images[index_to_remove]
 
-    def clear_images(self):
-        while self.image_layout.count():
+    def clear_images(self, count=None):
+        """Remove the first `count` images, or all of them"""
+        if count is None:
+            count = len(self.images)
+        for _ in range(min(count, self.image_layout.count())):
             item = self.image_layout.takeAt(0)
             widget = item.widget()
             if widget:
                 widget.deleteLater()
-        self.images.clear()
+        del self.images[:count]
 
     def handle_single_click(self, _, img_metadata):
         self.current_image_metadata = img_metadata  # Store metadata for single-click action
@@ -211,7 +411,7 @@ class ImageDisplayWidget(QWidget):
         # Execute double-click action
         if image_metadata and image_metadata.get("image_path"):
             image_path = image_metadata["image_path"]
-            raw_image_path = image_path.replace("_screen.png", "_raw.png")
+            raw_image_path = best_raw_chip_path(image_path)
             screen_image_exists = os.path.exists(image_path)
             raw_image_exists = os.path.exists(raw_image_path)
             # Determine the available options and prompt the user
@@ -324,17 +524,25 @@ class IdentifyDrawnAreaTool(QgsMapToolEmitPoint):
         transformed_point = QgsGeometry.fromPointXY(clicked_point)
         transformed_point.transform(transform)
 
-        layer_features = self.log_layer.getFeatures()
+        # Temp drawings that haven't been sent to the MLLM yet are only in the image display widget and log layer
+        for image in self.parent_dialog.image_display_widget.images:
+            if (image["image_path"] is None and image["rectangle_geom"] is not None
+                    and image["rectangle_geom"].contains(transformed_point)):
+                QMessageBox.information(None, "Feature Info", "This feature has no interactions yet.")
+                return
+
+        # Use the chips' spatial index to only look at the features of candidate chips
+        point = transformed_point.asPoint()
+        candidate_chip_ids = [chip[0] for chip in self.parent_dialog.logs_db.query_chips_at_point(point.x(), point.y())]
 
         features, attributes = [], []
-        for feature in layer_features:
-            if feature.geometry().contains(transformed_point):
-                if str(feature.attributes()[1]) != "NULL":
+        if candidate_chip_ids:
+            chip_ids_str = ", ".join(f"'{chip_id}'" for chip_id in candidate_chip_ids)
+            request = QgsFeatureRequest().setFilterExpression(f'"ChipId" IN ({chip_ids_str})')
+            for feature in self.log_layer.getFeatures(request):
+                if str(feature.attributes()[1]) != "NULL" and feature.geometry().contains(transformed_point):
                     features.append(feature)
                     attributes.append(feature.attributes())
-                else:  # If it's a temp drawing that hasn't been sent to MLLM yet
-                    QMessageBox.information(None, "Feature Info", "This feature has no interactions yet.")
-                    return
 
         if len(attributes) == 0:
             QMessageBox.information(None, "Feature Info", "No feature found at the clicked location.")
@@ -344,20 +552,16 @@ class IdentifyDrawnAreaTool(QgsMapToolEmitPoint):
         if not selected_chip:
             return
 
-        # Could be optimized if we directly tracked the chips linked to each chat in the database
-        all_chats = self.parent_dialog.logs_db.fetch_all_chats()
-        all_interactions = {interaction[0]: json.loads(interaction[3]) for interaction in self.parent_dialog.logs_db.fetch_all_interactions()}
-        chats = {}
-        for chat in all_chats:
-            for interaction_id in json.loads(chat[1]):
-                if int(selected_chip[2]) in all_interactions[interaction_id]:
-                    if chat[2] in chats:
-                        chats[chat[2]].append(interaction_id)
-                    else:
-                        chats[chat[2]] = [interaction_id]
+        chats, chat_summaries = {}, {}
+        for chat_id, chat_summary, interaction_id in self.parent_dialog.logs_db.fetch_chats_with_chip(int(selected_chip[2])):
+            chat_summaries[chat_id] = chat_summary
+            if chat_id in chats:
+                chats[chat_id].append(interaction_id)
+            else:
+                chats[chat_id] = [interaction_id]
 
         selected_chat, _ = self.prompt_selection(
-            "chat", chats, lambda chat_summary: chat_summary, lambda x: x
+            "chat", chats, lambda chat_id: chat_summaries[chat_id] or "New chat", lambda x: x
         )
         if not selected_chat:  # Features / chips that belonged to chat/s which have been deleted
             feature = features[selected_index]
@@ -401,41 +605,7 @@ class IdentifyDrawnAreaTool(QgsMapToolEmitPoint):
             return return_func(options), 0
         return options[0], 0
 
-    def open_chat_and_scroll_to_interaction(self, chat_summary, interaction_key):
-        for i in range(self.parent_dialog.chat_list.count()):
-            item = self.parent_dialog.chat_list.item(i)
-            if chat_summary in item.text():
-                self.parent_dialog.chat_list.setCurrentItem(item)
-                self.parent_dialog.load_chat(item)
-                break
-        self.scroll_to_interaction(interaction_key)
-
-    def scroll_to_interaction(self, interaction_id):
-        # Construct the interaction ID anchor
-        interaction_anchor = f"interaction-{interaction_id}"
-        # Retrieve the current chat HTML
-        chat_html = self.parent_dialog.chat_history.toHtml()
-        if interaction_anchor in chat_html:
-            highlighted_html = '<p style'.join(
-                chat_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[:-1] +
-                [chat_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[-1].replace('="', '=" background-color: yellow;')]
-            ) + f'<a name="{interaction_anchor}">' + chat_html.split(f'<a name="{interaction_anchor}">')[1]
-            self.parent_dialog.chat_history.setHtml(highlighted_html)
-            self.parent_dialog.chat_history.scrollToAnchor(interaction_anchor)
-            # Remove highlight after a short duration
-            QTimer.singleShot(2000, lambda: self.remove_highlight(interaction_id))
-        else:
-            QMessageBox.warning(None, "Error", f"Interaction ID {interaction_id} not found.")
-
-    def remove_highlight(self, interaction_id):
-        """
-        Removes the temporary highlight from the interaction.
-        """
-        interaction_anchor = f"interaction-{interaction_id}"
-        highlighted_html = self.parent_dialog.chat_history.toHtml()
-        chat_html = '<p style'.join(
-            highlighted_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[:-1] +
-            [highlighted_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[-1].replace(' background-color:#ffff00;','')]
-        ) + f'<a name="{interaction_anchor}">' + highlighted_html.split(f'<a name="{interaction_anchor}">')[1]
-        self.parent_dialog.chat_history.setHtml(chat_html)
-        self.parent_dialog.chat_history.scrollToAnchor(interaction_anchor)
+    def open_chat_and_scroll_to_interaction(self, chat_id, interaction_key):
+        # The chat isn't opened while a response is being streamed, see open_chat
+        if self.parent_dialog.open_chat(chat_id):
+            self.parent_dialog.scroll_to_interaction(interaction_key)
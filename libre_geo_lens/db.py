@@ -1,54 +1,103 @@
+import ast
 import json
 import sqlite3
 import logging
+import threading
+from contextlib import contextmanager
 
 
 class LogsDB:
     # Current database schema version
-    CURRENT_VERSION = 1
-    
+    CURRENT_VERSION = 4
+    # Number of prepared statements kept per connection, so repeated queries skip re-compilation
+    STATEMENT_CACHE_SIZE = 256
+
     def __init__(self, db_path):
         self.db_path = db_path
         self.logger = logging.getLogger(__name__)
+        # sqlite3 connections shouldn't be shared between threads, so each thread gets its own long-lived one
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """Long-lived connection for the calling thread, opened (and configured) on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None so that transactions are only opened explicitly through self.transaction()
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=self.STATEMENT_CACHE_SIZE)
+            # Enable WAL mode for better performance with concurrent reads/writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Ensure synchronous mode is set for best performance while maintaining integrity
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.transaction_depth = 0
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a cursor whose statements are committed together on exit, or rolled back if an exception is raised.
+        Nested transactions join the outermost one, so several write methods can be grouped into a single commit.
+        """
+        conn = self.connection
+        cursor = conn.cursor()
+        if self._local.transaction_depth == 0:
+            cursor.execute("BEGIN")
+        self._local.transaction_depth += 1
+        try:
+            yield cursor
+        except BaseException:
+            self._local.transaction_depth -= 1
+            if self._local.transaction_depth == 0 and conn.in_transaction:
+                conn.rollback()
+            raise
+        self._local.transaction_depth -= 1
+        if self._local.transaction_depth == 0:
+            conn.commit()
+
+    def close(self):
+        """Close all the connections opened by this instance"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
     def initialize_database(self):
         """Initialize the database or migrate it if necessary"""
         # Check if database exists and needs migration
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Check if SchemaVersion table exists
-            cursor.execute("""
-                SELECT name FROM sqlite_master 
-                WHERE type='table' AND name='SchemaVersion'
-            """)
-            schema_version_exists = cursor.fetchone() is not None
-            
-            if not schema_version_exists:
-                # New database or old version without versioning
-                self._setup_new_database(conn, cursor)
-            else:
-                # Check current version and migrate if needed
-                cursor.execute("SELECT version FROM SchemaVersion")
-                current_version = cursor.fetchone()[0]
-                
-                if current_version < self.CURRENT_VERSION:
-                    self._migrate_database(conn, cursor, current_version)
-            
-            conn.close()
-            
+            conn = self.connection
+            with self.transaction() as cursor:
+                # Check if SchemaVersion table exists
+                cursor.execute("""
+                    SELECT name FROM sqlite_master 
+                    WHERE type='table' AND name='SchemaVersion'
+                """)
+                schema_version_exists = cursor.fetchone() is not None
+
+                if not schema_version_exists:
+                    # New database or old version without versioning
+                    self._setup_new_database(conn, cursor)
+                else:
+                    # Check current version and migrate if needed
+                    cursor.execute("SELECT version FROM SchemaVersion")
+                    current_version = cursor.fetchone()[0]
+
+                    if current_version < self.CURRENT_VERSION:
+                        self._migrate_database(conn, cursor, current_version)
+
         except sqlite3.Error as e:
             self.logger.error(f"Database initialization error: {e}")
             raise
     
     def _setup_new_database(self, conn, cursor):
         """Set up a new database or add versioning to existing one"""
-        # Enable WAL mode for better performance with concurrent reads/writes
-        conn.execute("PRAGMA journal_mode=WAL")
-        # Ensure synchronous mode is set for best performance while maintaining integrity
-        conn.execute("PRAGMA synchronous=NORMAL")
-        
         # Check if tables already exist (old database without versioning)
         cursor.execute("""
             SELECT name FROM sqlite_master 
@@ -100,6 +149,10 @@ class LogsDB:
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_chip_id ON Chips(id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_id ON Chats(id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_interaction_id ON Interactions(id)")
+
+        self._create_relationship_tables(cursor)
+        self._create_spatial_index(cursor)
+        self._create_full_text_index(cursor)
         
         # Create version tracking table
         cursor.execute("""
@@ -110,8 +163,7 @@ class LogsDB:
         
         # Insert current version
         cursor.execute("INSERT INTO SchemaVersion (version) VALUES (?)", (self.CURRENT_VERSION,))
-        
-        conn.commit()
+
         self.logger.info(f"Created new database with schema version {self.CURRENT_VERSION}")
     
     def _add_version_tracking(self, conn, cursor):
@@ -129,21 +181,19 @@ class LogsDB:
                 )
             """)
             
-            # Determine version based on structure
+            # Determine version based on structure (version tracking was added in version 1)
             if 'chips_original_resolutions' in columns and 'chips_actual_resolutions' in columns:
-                cursor.execute("INSERT INTO SchemaVersion (version) VALUES (?)", (self.CURRENT_VERSION,))
-                self.logger.info(f"Added version tracking to existing database - current version: {self.CURRENT_VERSION}")
+                detected_version = 1
             else:
                 # Old structure, needs migration
-                cursor.execute("INSERT INTO SchemaVersion (version) VALUES (?)", (0,))
-                self.logger.info("Added version tracking to existing database - needs migration from version 0")
-                # Perform migration to latest version
-                self._migrate_database(conn, cursor, 0)
-            
-            conn.commit()
+                detected_version = 0
+            cursor.execute("INSERT INTO SchemaVersion (version) VALUES (?)", (detected_version,))
+            self.logger.info(f"Added version tracking to existing database - needs migration from version {detected_version}")
+            # Perform migration to latest version
+            self._migrate_database(conn, cursor, detected_version)
         except sqlite3.Error as e:
+            # The enclosing transaction in initialize_database takes care of the rollback
             self.logger.error(f"Error adding version tracking: {e}")
-            conn.rollback()
             raise
     
     def _migrate_database(self, conn, cursor, from_version):
@@ -154,14 +204,19 @@ class LogsDB:
             # Apply all necessary migrations in sequence
             if from_version < 1:
                 self._migrate_to_v1(conn, cursor)
+            if from_version < 2:
+                self._migrate_to_v2(conn, cursor)
+            if from_version < 3:
+                self._migrate_to_v3(conn, cursor)
+            if from_version < 4:
+                self._migrate_to_v4(conn, cursor)
             
             # Update schema version
             cursor.execute("UPDATE SchemaVersion SET version = ?", (self.CURRENT_VERSION,))
-            conn.commit()
             self.logger.info(f"Database successfully migrated to version {self.CURRENT_VERSION}")
         except sqlite3.Error as e:
+            # The enclosing transaction in initialize_database takes care of the rollback
             self.logger.error(f"Migration error: {e}")
-            conn.rollback()
             raise
     
     def _migrate_to_v1(self, conn, cursor):
@@ -179,205 +234,490 @@ class LogsDB:
         if 'chips_actual_resolutions' not in columns:
             cursor.execute("ALTER TABLE Interactions ADD COLUMN chips_actual_resolutions TEXT")
             self.logger.info("Added chips_actual_resolutions column to Interactions table")
-        
-        conn.commit()
 
-    def save_chip(self, image_path, geocoords):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _migrate_to_v2(self, conn, cursor):
+        """Migrate database to version 2"""
+        self.logger.info("Applying migration to version 2")
+
+        self._create_relationship_tables(cursor)
+
+        # Backfill the junction tables from the sequences stored as text
+        cursor.execute("SELECT id, interactions_sequence FROM Chats")
+        chat_interactions_rows = [
+            (chat_id, position, interaction_id)
+            for chat_id, interactions_sequence in cursor.fetchall()
+            for position, interaction_id in enumerate(self._decode_list(interactions_sequence))
+        ]
+        cursor.executemany(
+            "INSERT INTO ChatInteractions (chat_id, position, interaction_id) VALUES (?, ?, ?)",
+            chat_interactions_rows
+        )
 
         cursor.execute("""
-            INSERT INTO Chips (image_path, geocoords)
-            VALUES (?, ?)
-        """, (image_path, str(geocoords)))
+            SELECT id, chips_sequence, chips_mode_sequence, chips_original_resolutions, chips_actual_resolutions
+            FROM Interactions
+        """)
+        interaction_chips_rows = []
+        for interaction_id, chips, modes, original_resolutions, actual_resolutions in cursor.fetchall():
+            interaction_chips_rows.extend(self._interaction_chips_rows(
+                interaction_id, self._decode_list(chips), self._decode_list(modes),
+                self._decode_list(original_resolutions), self._decode_list(actual_resolutions)
+            ))
+        cursor.executemany("""
+            INSERT INTO InteractionChips (interaction_id, position, chip_id, mode, original_res, actual_res)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, interaction_chips_rows)
+
+        self.logger.info(f"Backfilled {len(chat_interactions_rows)} chat interactions "
+                         f"and {len(interaction_chips_rows)} interaction chips")
+
+    def _migrate_to_v3(self, conn, cursor):
+        """Migrate database to version 3"""
+        self.logger.info("Applying migration to version 3")
+
+        self._create_spatial_index(cursor)
+
+        # Backfill the spatial index from the chips' geocoords
+        cursor.execute("SELECT id, geocoords FROM Chips")
+        rtree_rows = []
+        for chip_id, geocoords in cursor.fetchall():
+            bbox = self._geocoords_bbox(json.loads(geocoords))
+            if bbox is not None:
+                rtree_rows.append((chip_id, *bbox))
+        cursor.executemany(
+            "INSERT INTO ChipsRTree (id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)", rtree_rows
+        )
 
-        chip_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return chip_id
+        self.logger.info(f"Backfilled the spatial index with {len(rtree_rows)} chips")
 
-    def save_interaction(self, text_input, text_output, chips_sequence, mllm_service, mllm_model, 
-                       chips_mode_sequence, chips_original_resolutions=None, chips_actual_resolutions=None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _migrate_to_v4(self, conn, cursor):
+        """Migrate database to version 4"""
+        self.logger.info("Applying migration to version 4")
+
+        self._create_full_text_index(cursor)
+        # Index the existing prompts and responses
+        cursor.execute("INSERT INTO InteractionsFTS (InteractionsFTS) VALUES ('rebuild')")
 
+    @staticmethod
+    def _create_spatial_index(cursor):
+        """Create the R*Tree with the bounding box (in EPSG:4326) of each chip, sharing its id"""
         cursor.execute("""
-            INSERT INTO Interactions (text_input, text_output, chips_sequence, mllm_service, mllm_model, 
-                                     chips_mode_sequence, chips_original_resolutions, chips_actual_resolutions)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (text_input, text_output, str(chips_sequence), mllm_service, mllm_model, 
-              str(chips_mode_sequence), str(chips_original_resolutions), str(chips_actual_resolutions)))
+            CREATE VIRTUAL TABLE IF NOT EXISTS ChipsRTree USING rtree(
+                id,
+                min_x, max_x,
+                min_y, max_y
+            )
+        """)
 
-        interaction_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return interaction_id
+    @staticmethod
+    def _create_full_text_index(cursor):
+        """Create the FTS5 index over the interactions' prompts and responses (external content, no text duplication)"""
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS InteractionsFTS USING fts5(
+                text_input,
+                text_output,
+                content='Interactions',
+                content_rowid='id'
+            )
+        """)
 
-    def save_chat(self, interactions_sequence):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def _fts_query(text):
+        """Turn free text into an FTS5 query matching all its terms, with the last one as a prefix (search-as-you-type)"""
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if not terms:
+            return None
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    @staticmethod
+    def _geocoords_bbox(geocoords):
+        """(min_x, max_x, min_y, max_y) of a list of [x, y] coordinates, in the R*Tree column order"""
+        if not geocoords:
+            return None
+        xs = [point[0] for point in geocoords]
+        ys = [point[1] for point in geocoords]
+        return min(xs), max(xs), min(ys), max(ys)
+
+    @staticmethod
+    def _create_relationship_tables(cursor):
+        """Create the junction tables linking chats to interactions and interactions to chips"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ChatInteractions (
+                chat_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                interaction_id INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, position)
+            )
+        """)
 
         cursor.execute("""
-            INSERT INTO Chats (interactions_sequence, summary)
-            VALUES (?, ?)
-        """, (str(interactions_sequence), "",))
+            CREATE TABLE IF NOT EXISTS InteractionChips (
+                interaction_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                chip_id INTEGER NOT NULL,
+                mode TEXT,
+                original_res TEXT,
+                actual_res TEXT,
+                PRIMARY KEY (interaction_id, position)
+            )
+        """)
 
-        chat_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return chat_id
+        # The primary keys already cover lookups by chat and by interaction, these cover the reverse direction
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_interactions_interaction_id "
+                       "ON ChatInteractions(interaction_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_interaction_chips_chip_id ON InteractionChips(chip_id)")
 
-    def fetch_all_chips(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def _decode_list(text):
+        """Decode a sequence stored as text (JSON or the str() of a Python list). NULL, 'None' or garbage give []"""
+        if not text:
+            return []
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return []
+        return list(value) if isinstance(value, (list, tuple)) else []
+
+    @staticmethod
+    def _interaction_chips_rows(interaction_id, chips_sequence, chips_mode_sequence,
+                                chips_original_resolutions=None, chips_actual_resolutions=None):
+        """Build the InteractionChips rows for an interaction, tolerating missing or shorter resolution lists"""
+        chips_original_resolutions = chips_original_resolutions or []
+        chips_actual_resolutions = chips_actual_resolutions or []
+        rows = []
+        for position, chip_id in enumerate(chips_sequence):
+            rows.append((
+                interaction_id, position, chip_id,
+                chips_mode_sequence[position] if position < len(chips_mode_sequence) else None,
+                chips_original_resolutions[position] if position < len(chips_original_resolutions) else None,
+                chips_actual_resolutions[position] if position < len(chips_actual_resolutions) else None
+            ))
+        return rows
+
+    def save_chip(self, image_path, geocoords):
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO Chips (image_path, geocoords)
+                VALUES (?, ?)
+            """, (image_path, str(geocoords)))
+            chip_id = cursor.lastrowid
+
+            bbox = self._geocoords_bbox(geocoords)
+            if bbox is not None:
+                cursor.execute(
+                    "INSERT INTO ChipsRTree (id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)", (chip_id, *bbox)
+                )
+            return chip_id
 
-        cursor.execute("SELECT * FROM Chips")
-        chips = cursor.fetchall()
-        conn.close()
-        return chips
+    def save_interaction(self, text_input, text_output, chips_sequence, mllm_service, mllm_model, 
+                       chips_mode_sequence, chips_original_resolutions=None, chips_actual_resolutions=None):
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO Interactions (text_input, text_output, chips_sequence, mllm_service, mllm_model, 
+                                         chips_mode_sequence, chips_original_resolutions, chips_actual_resolutions)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (text_input, text_output, str(chips_sequence), mllm_service, mllm_model, 
+                  str(chips_mode_sequence), str(chips_original_resolutions), str(chips_actual_resolutions)))
+            interaction_id = cursor.lastrowid
+
+            cursor.execute(
+                "INSERT INTO InteractionsFTS (rowid, text_input, text_output) VALUES (?, ?, ?)",
+                (interaction_id, text_input, text_output)
+            )
+            cursor.executemany("""
+                INSERT INTO InteractionChips (interaction_id, position, chip_id, mode, original_res, actual_res)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, self._interaction_chips_rows(interaction_id, chips_sequence, chips_mode_sequence,
+                                              chips_original_resolutions, chips_actual_resolutions))
+            return interaction_id
 
-    def fetch_chip_by_id(self, chip_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def save_chat(self, interactions_sequence):
+        with self.transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO Chats (interactions_sequence, summary)
+                VALUES (?, ?)
+            """, (str(interactions_sequence), "",))
+            chat_id = cursor.lastrowid
+
+            cursor.executemany(
+                "INSERT INTO ChatInteractions (chat_id, position, interaction_id) VALUES (?, ?, ?)",
+                [(chat_id, position, interaction_id) for position, interaction_id in enumerate(interactions_sequence)]
+            )
+            return chat_id
 
-        cursor.execute("SELECT * FROM Chips WHERE id = ?", (chip_id,))
-        chip = cursor.fetchone()
-        conn.close()
-        return chip
+    def fetch_all_chips(self):
+        return self.connection.execute("SELECT * FROM Chips").fetchall()
 
-    def fetch_all_interactions(self):
-        conn = sqlite3.connect(self.db_path)
-        # Enable WAL mode for better performance with concurrent reads/writes
-        conn.execute("PRAGMA journal_mode=WAL")
-        cursor = conn.cursor()
+    def fetch_chip_by_id(self, chip_id):
+        return self.connection.execute("SELECT * FROM Chips WHERE id = ?", (chip_id,)).fetchone()
+
+    def query_chips_at_point(self, x, y):
+        """Fetch the chips whose footprint bounding box contains the point (in EPSG:4326)"""
+        return self.connection.execute("""
+            SELECT c.*
+            FROM ChipsRTree r
+            JOIN Chips c ON c.id = r.id
+            WHERE r.min_x <= ? AND r.max_x >= ? AND r.min_y <= ? AND r.max_y >= ?
+        """, (x, x, y, y)).fetchall()
+
+    def query_chips_in_bbox(self, min_x, min_y, max_x, max_y):
+        """Fetch the chips whose footprint bounding box intersects the given bounding box (in EPSG:4326)"""
+        return self.connection.execute("""
+            SELECT c.*
+            FROM ChipsRTree r
+            JOIN Chips c ON c.id = r.id
+            WHERE r.min_x <= ? AND r.max_x >= ? AND r.min_y <= ? AND r.max_y >= ?
+        """, (max_x, min_x, max_y, min_y)).fetchall()
 
-        cursor.execute("SELECT * FROM Interactions")
-        interactions = cursor.fetchall()
-        conn.close()
-        return interactions
+    def fetch_all_interactions(self):
+        return self.connection.execute("SELECT * FROM Interactions").fetchall()
 
     def fetch_interaction_by_id(self, interaction_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM Interactions WHERE id = ?", (interaction_id,))
-        interaction = cursor.fetchone()
-        conn.close()
-        return interaction
+        return self.connection.execute("SELECT * FROM Interactions WHERE id = ?", (interaction_id,)).fetchone()
 
     def fetch_all_chats(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM Chats")
-        chats = cursor.fetchall()
-        conn.close()
-        return chats
+        return self.connection.execute("SELECT * FROM Chats").fetchall()
 
     def fetch_chat_by_id(self, chat_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self.connection.execute("SELECT * FROM Chats WHERE id = ?", (chat_id,)).fetchone()
+
+    def fetch_chat_bundle(self, chat_id):
+        """
+        Fetch all the interactions of a chat, in order, together with their chips, using two queries.
+        Returns a list of dicts with the interaction columns and a "chips" list of dicts with the id, image_path,
+        mode, original_res and actual_res of each chip, in the order they were sent.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT i.id, i.text_input, i.text_output, i.mllm_service, i.mllm_model
+            FROM ChatInteractions ci
+            JOIN Interactions i ON i.id = ci.interaction_id
+            WHERE ci.chat_id = ?
+            ORDER BY ci.position
+        """, (chat_id,))
+        interactions = []
+        interactions_by_id = {}
+        for interaction_id, text_input, text_output, mllm_service, mllm_model in cursor.fetchall():
+            interaction = {
+                "id": interaction_id,
+                "text_input": text_input,
+                "text_output": text_output,
+                "mllm_service": mllm_service,
+                "mllm_model": mllm_model,
+                "chips": []
+            }
+            interactions.append(interaction)
+            interactions_by_id[interaction_id] = interaction
+
+        cursor.execute("""
+            SELECT ic.interaction_id, c.id, c.image_path, ic.mode, ic.original_res, ic.actual_res
+            FROM ChatInteractions ci
+            JOIN InteractionChips ic ON ic.interaction_id = ci.interaction_id
+            JOIN Chips c ON c.id = ic.chip_id
+            WHERE ci.chat_id = ?
+            ORDER BY ci.position, ic.position
+        """, (chat_id,))
+        for interaction_id, chip_id, image_path, mode, original_res, actual_res in cursor.fetchall():
+            interactions_by_id[interaction_id]["chips"].append({
+                "id": chip_id,
+                "image_path": image_path,
+                "mode": mode,
+                "original_res": original_res,
+                "actual_res": actual_res
+            })
+
+        return interactions
 
-        cursor.execute("SELECT * FROM Chats WHERE id = ?", (chat_id,))
-        chat = cursor.fetchone()
-        conn.close()
-        return chat
+    def count_chats(self):
+        return self.connection.execute("SELECT COUNT(*) FROM Chats").fetchone()[0]
+
+    def count_chat_interactions(self, chat_id):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM ChatInteractions WHERE chat_id = ?", (chat_id,)
+        ).fetchone()[0]
+
+    def fetch_first_turns(self, chat_id, limit):
+        """Fetch the (text_input, text_output) of the first interactions of a chat, in order"""
+        return self.connection.execute("""
+            SELECT i.text_input, i.text_output
+            FROM ChatInteractions ci
+            JOIN Interactions i ON i.id = ci.interaction_id
+            WHERE ci.chat_id = ?
+            ORDER BY ci.position
+            LIMIT ?
+        """, (chat_id, limit)).fetchall()
+
+    def fetch_chat_summaries(self, offset, limit):
+        """Fetch a page of (chat_id, summary), newest chats first, without loading the interactions sequences"""
+        return self.connection.execute(
+            "SELECT id, summary FROM Chats ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)
+        ).fetchall()
+
+    def search_interactions(self, text, limit=500):
+        """
+        Full-text search over prompts and responses.
+        Returns (chat_id, chat_summary, interaction_id) for the best matching interaction of each matching chat,
+        best chats first.
+        """
+        query = self._fts_query(text)
+        if query is None:
+            return []
+        rows = self.connection.execute("""
+            SELECT ci.chat_id, c.summary, ci.interaction_id
+            FROM InteractionsFTS f
+            JOIN ChatInteractions ci ON ci.interaction_id = f.rowid
+            JOIN Chats c ON c.id = ci.chat_id
+            WHERE InteractionsFTS MATCH ?
+            ORDER BY f.rank
+            LIMIT ?
+        """, (query, limit)).fetchall()
+        best_match_by_chat = {}
+        for chat_id, chat_summary, interaction_id in rows:
+            if chat_id not in best_match_by_chat:
+                best_match_by_chat[chat_id] = (chat_id, chat_summary, interaction_id)
+        return list(best_match_by_chat.values())
+
+    def fetch_chats_with_chip(self, chip_id):
+        """Returns (chat_id, summary, interaction_id) for every interaction in which the chip was sent, in chat order"""
+        return self.connection.execute("""
+            SELECT DISTINCT c.id, c.summary, ci.interaction_id
+            FROM InteractionChips ic
+            JOIN ChatInteractions ci ON ci.interaction_id = ic.interaction_id
+            JOIN Chats c ON c.id = ci.chat_id
+            WHERE ic.chip_id = ?
+            ORDER BY c.id, ci.position
+        """, (chip_id,)).fetchall()
 
     def add_new_interaction_to_chat(self, chat_id, interaction_id):
-        chats = self.fetch_all_chats()
-        selected_chat = next(chat for chat in chats if chat[0] == chat_id)
-        interactions_sequence = json.loads(selected_chat[1])
+        with self.transaction() as cursor:
+            selected_chat = self.fetch_chat_by_id(chat_id)
+            interactions_sequence = json.loads(selected_chat[1])
 
-        # Append the new interaction ID
-        interactions_sequence.append(interaction_id)
+            # Append the new interaction ID
+            interactions_sequence.append(interaction_id)
 
-        # Update the chat in the database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE Chats SET interactions_sequence = ? WHERE id = ?",
-            (json.dumps(interactions_sequence), chat_id),
-        )
-        conn.commit()
-        conn.close()
+            # Update the chat in the database
+            cursor.execute(
+                "UPDATE Chats SET interactions_sequence = ? WHERE id = ?",
+                (json.dumps(interactions_sequence), chat_id),
+            )
+            cursor.execute(
+                "INSERT INTO ChatInteractions (chat_id, position, interaction_id) VALUES (?, ?, ?)",
+                (chat_id, len(interactions_sequence) - 1, interaction_id)
+            )
 
-    def update_chat_summary(self, chat_id, summary):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def record_interaction(self, chat_id, text_input, text_output, chips, mllm_service, mllm_model,
+                           summary=None, finalize_image_path=None, move_image=None):
+        """
+        Persist a whole MLLM round trip in a single transaction: the chips that haven't been saved yet,
+        the interaction, its link to the chat and, optionally, the new chat summary.
+        Each chip is a dict with "mode", "original_res" and "actual_res", plus either the "id" of a saved chip
+        or the "image_path" and "geocoords" of a new one. Since chip images are named after the chip id,
+        finalize_image_path(image_path, chip_id) is called for each new chip and must return its final image path,
+        and move_image(image_path, final_image_path) is called to move its files there. If the transaction is
+        rolled back, the files are moved back, since the chip ids will be given to the next chips saved.
+        The new chips' dicts are updated in place with their id and final image path.
+        Returns the interaction id and the ids of the chips, in order.
+        """
+        new_chips = []  # (chip, chip_id, final image path)
+        moved_images = []  # (image_path, final image path)
+        try:
+            with self.transaction():
+                chip_ids = []
+                for chip in chips:
+                    chip_id = chip.get("id")
+                    if chip_id is None:
+                        chip_id = self.save_chip(chip["image_path"], chip["geocoords"])
+                        image_path = chip["image_path"]
+                        if finalize_image_path is not None:
+                            image_path = finalize_image_path(chip["image_path"], chip_id)
+                            if move_image is not None:
+                                move_image(chip["image_path"], image_path)
+                                moved_images.append((chip["image_path"], image_path))
+                            self.update_chip_image_path(chip_id, image_path)
+                        new_chips.append((chip, chip_id, image_path))
+                    chip_ids.append(chip_id)
+
+                interaction_id = self.save_interaction(
+                    text_input=text_input, text_output=text_output,
+                    chips_sequence=chip_ids,
+                    mllm_service=mllm_service, mllm_model=mllm_model,
+                    chips_mode_sequence=[chip["mode"] for chip in chips],
+                    chips_original_resolutions=[chip["original_res"] for chip in chips],
+                    chips_actual_resolutions=[chip["actual_res"] for chip in chips]
+                )
+                self.add_new_interaction_to_chat(chat_id, interaction_id)
+                if summary is not None:
+                    self.update_chat_summary(chat_id, summary)
+        except BaseException:
+            for image_path, final_image_path in reversed(moved_images):
+                try:
+                    move_image(final_image_path, image_path)
+                except OSError as e:
+                    self.logger.error(f"Failed to move {final_image_path} back to {image_path}: {e}")
+            raise
 
-        cursor.execute(
-            "UPDATE Chats SET summary = ? WHERE id = ?",
-            (summary, chat_id),
-        )
-        conn.commit()
-        conn.close()
+        for chip, chip_id, image_path in new_chips:
+            chip["id"], chip["image_path"] = chip_id, image_path
+        return interaction_id, chip_ids
+
+    def update_chat_summary(self, chat_id, summary):
+        with self.transaction() as cursor:
+            cursor.execute(
+                "UPDATE Chats SET summary = ? WHERE id = ?",
+                (summary, chat_id),
+            )
 
     def update_chip_image_path(self, chip_id, image_path):
         """Update the image path for a chip"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE Chips SET image_path = ? WHERE id = ?",
-            (image_path, chip_id)
-        )
-        conn.commit()
-        conn.close()
-
+        with self.transaction() as cursor:
+            cursor.execute(
+                "UPDATE Chips SET image_path = ? WHERE id = ?",
+                (image_path, chip_id)
+            )
 
     def delete_chat(self, chat_id, delete_chips):
-        """Delete a chat and its associated data"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Get chat's interactions
-        cursor.execute("SELECT interactions_sequence FROM Chats WHERE id = ?", (chat_id,))
-        interactions_sequence = json.loads(cursor.fetchone()[0])
-
-        if delete_chips:
-            # Get chips associated with these interactions
-            chips_to_check = set()
-            for interaction_id in interactions_sequence:
-                cursor.execute("SELECT chips_sequence FROM Interactions WHERE id = ?", (interaction_id,))
-                chips_sequence = json.loads(cursor.fetchone()[0])
-                chips_to_check.update(chips_sequence)
-
-            # For each chip, check if it's used in other chats' interactions
-            chips_to_delete = set()
-            for chip_id in chips_to_check:
-                is_used = False
-                # Get all interactions from other chats
-                cursor.execute("SELECT interactions_sequence FROM Chats WHERE id != ?", (chat_id,))
-                other_chats_interactions = []
-                for chat in cursor.fetchall():
-                    other_chats_interactions.extend(json.loads(chat[0]))
-
-                # Get chips from those interactions
-                for interaction_id in other_chats_interactions:
-                    cursor.execute("SELECT chips_sequence FROM Interactions WHERE id = ?", (interaction_id,))
-                    other_interaction = cursor.fetchone()
-                    other_chips = json.loads(other_interaction[0])
-                    if chip_id in other_chips:
-                        is_used = True
-                        break
-                if not is_used:
-                    chips_to_delete.add(chip_id)
-                    cursor.execute("SELECT image_path FROM Chips WHERE id = ?", (chip_id,))
-                    image_path = cursor.fetchone()[0]
-                    # Return image paths for deletion
-                    yield image_path, chip_id
-        else:
+        """
+        Delete a chat and its associated data.
+        If delete_chips, also deletes the chips that aren't used by any other chat and returns their
+        (image_path, chip_id) so that the caller can remove the image files and log features.
+        """
+        with self.transaction() as cursor:
             chips_to_delete = []
-
-        # Delete interactions
-        for interaction_id in interactions_sequence:
-            cursor.execute("DELETE FROM Interactions WHERE id = ?", (interaction_id,))
-
-        # Delete chips
-        for chip_id in chips_to_delete:
-            cursor.execute("DELETE FROM Chips WHERE id = ?", (chip_id,))
-
-        # Delete chat
-        cursor.execute("DELETE FROM Chats WHERE id = ?", (chat_id,))
-
-        conn.commit()
-        conn.close()
+            if delete_chips:
+                # Chips sent in this chat that weren't sent in any other chat, looked up by chip id
+                cursor.execute("""
+                    SELECT c.image_path, c.id
+                    FROM Chips c
+                    WHERE c.id IN (
+                        SELECT ic.chip_id
+                        FROM ChatInteractions ci
+                        JOIN InteractionChips ic ON ic.interaction_id = ci.interaction_id
+                        WHERE ci.chat_id = ?
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM InteractionChips ic
+                        JOIN ChatInteractions ci ON ci.interaction_id = ic.interaction_id
+                        WHERE ic.chip_id = c.id AND ci.chat_id != ?
+                    )
+                """, (chat_id, chat_id))
+                chips_to_delete = cursor.fetchall()
+
+            cursor.execute("SELECT interaction_id FROM ChatInteractions WHERE chat_id = ?", (chat_id,))
+            interaction_ids = [(interaction_id,) for interaction_id, in cursor.fetchall()]
+
+            # Delete relationships, interactions (and their full-text index entries), chips and chat
+            cursor.executemany("""
+                INSERT INTO InteractionsFTS (InteractionsFTS, rowid, text_input, text_output)
+                SELECT 'delete', id, text_input, text_output FROM Interactions WHERE id = ?
+            """, interaction_ids)
+            cursor.executemany("DELETE FROM InteractionChips WHERE interaction_id = ?", interaction_ids)
+            cursor.execute("DELETE FROM ChatInteractions WHERE chat_id = ?", (chat_id,))
+            cursor.executemany("DELETE FROM Interactions WHERE id = ?", interaction_ids)
+            cursor.executemany("DELETE FROM Chips WHERE id = ?", [(chip_id,) for _, chip_id in chips_to_delete])
+            cursor.executemany("DELETE FROM ChipsRTree WHERE id = ?", [(chip_id,) for _, chip_id in chips_to_delete])
+            cursor.execute("DELETE FROM Chats WHERE id = ?", (chat_id,))
+
+        return chips_to_delete
@@ -1,5 +1,4 @@
 import os
-import math
 import json
 import io
 import base64
@@ -16,24 +15,28 @@ import ntpath
 from PIL import Image
 import markdown
 import urllib.parse
-import ast
 import requests
 
-from .settings import SettingsDialog
 from .db import LogsDB
+from .tasks import LoadCogTask, MllmRequestWorker, ChatSummaryWorker, LogsSyncScheduler
 from .utils import raw_image_utils as ru
+from .utils.encoded_image_cache import EncodedImageCache
+from .utils.image_encoding import (MIME_TYPES, DEFAULT_QUALITY, supported_format, encode_image,
+                                   encode_image_within_size, resize_to_px_limits, scale_to_px_limits)
 from .custom_qt import (zoom_to_and_flash_feature, CustomTextBrowser, ImageDisplayWidget,
-                        AreaDrawingTool, IdentifyDrawnAreaTool)
+                        AreaDrawingTool, IdentifyDrawnAreaTool, ChatListModel, StreamingMarkdownRenderer)
 
 from qgis.PyQt.QtGui import QPixmap, QImage, QColor, QTextOption, QPalette
-from qgis.PyQt.QtCore import QBuffer, QByteArray, Qt, QSettings, QVariant, QSize, QTimer
+from qgis.PyQt.QtCore import (QBuffer, QByteArray, Qt, QSettings, QVariant, QSize, QTimer, QModelIndex,
+                              QStandardPaths)
 from qgis.PyQt.QtWidgets import (QSizePolicy, QFileDialog, QMessageBox, QInputDialog, QComboBox, QLabel, QVBoxLayout,
                                  QPushButton, QWidget, QTextEdit, QApplication, QRadioButton, QHBoxLayout, QDockWidget,
-                                 QSplitter, QListWidget, QListWidgetItem, QDialog, QTextBrowser)
-from qgis.core import (QgsVectorLayer, QgsRasterLayer, QgsSymbol, QgsSimpleLineSymbolLayer, QgsUnitTypes,
+                                 QSplitter, QListView, QAbstractItemView, QDialog, QTextBrowser, QLineEdit,
+                                 QProgressBar)
+from qgis.core import (QgsVectorLayer, QgsSymbol, QgsSimpleLineSymbolLayer, QgsUnitTypes,
                        QgsRectangle, QgsWkbTypes, QgsProject, QgsGeometry, QgsMapRendererParallelJob, QgsFeature,
                        QgsField, QgsVectorFileWriter, QgsCoordinateReferenceSystem, QgsCoordinateTransform,
-                       QgsFeatureRequest, QgsLayerTreeLayer)
+                       QgsFeatureRequest, QgsLayerTreeLayer, QgsSpatialIndex, QgsApplication, Qgis)
 
 
 class LibreGeoLensDockWidget(QDockWidget):
@@ -57,6 +60,13 @@ class LibreGeoLensDockWidget(QDockWidget):
         self.geojson_path = settings.value("geojson_path", None, type=str)
         self.cogs_dict = json.loads(settings.value("cogs_dict", "{}"))
         self.geojson_layer = None
+        self.geojson_index = None  # Spatial index over the imagery outlines, see build_geojson_index
+        # COGs are loaded in the background, see load_cogs
+        self.max_cogs_to_load = 50
+        self.cog_load_tasks = []
+        self.cog_load_generation = 0  # Bumped for each GeoJSON, see replace_geojson_layer
+        self.cog_loads_finished, self.cogs_loaded = 0, 0
+        self.cog_loading_message, self.cog_loading_bar = None, None
         if self.geojson_path is not None and os.path.exists(self.geojson_path):
             self.handle_imagery_layers()
 
@@ -66,6 +76,22 @@ class LibreGeoLensDockWidget(QDockWidget):
         os.makedirs(self.logs_dir, exist_ok=True)
         self.logs_db = LogsDB(os.path.join(self.logs_dir, "logs.db"))
         self.logs_db.initialize_database()
+        ru.configure_dataset_cache(
+            size=settings.value("dataset_cache_size", ru.DATASET_CACHE_SIZE, type=int),
+            idle_timeout=settings.value("dataset_cache_idle_timeout", ru.DATASET_CACHE_IDLE_TIMEOUT, type=int)
+        )
+        # Otherwise idle raw imagery files would only be closed the next time a raw chip is extracted
+        self.dataset_cache_timer = QTimer(self)
+        self.dataset_cache_timer.timeout.connect(ru.evict_idle_datasets)
+        self.dataset_cache_timer.start(ru.DATASET_CACHE_SWEEP_INTERVAL * 1000)
+        # Where chips that haven't been sent yet are kept, outside the (backed up) logs directory
+        self.pending_chips_dir = os.path.join(tempfile.gettempdir(), "LibreGeoLensPendingChips")
+        # Images as they were last sent to each service, so that chat history doesn't need to be re-encoded
+        self.encoded_image_cache = EncodedImageCache(os.path.join(
+            QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "LibreGeoLens", "encoded_images"
+        ))
+        # Backs the logs directory up to S3 in the background, see persist_mllm_response
+        self.logs_sync_scheduler = LogsSyncScheduler(self.logs_dir, parent=self)
 
         self.current_highlighted_button = None
         self.area_drawing_tool = None
@@ -125,9 +151,27 @@ class LibreGeoLensDockWidget(QDockWidget):
         self.open_logs_dir_button.setToolTip("Open the folder where chat logs and image chips are stored")
         sidebar_layout.addWidget(self.open_logs_dir_button)
 
-        self.chat_list = QListWidget()
-        self.chat_list.itemClicked.connect(self.load_chat)
-        self.chat_list.currentItemChanged.connect(self.on_current_item_changed)
+        self.chat_search_input = QLineEdit()
+        self.chat_search_input.setPlaceholderText("Search chats...")
+        self.chat_search_input.setClearButtonEnabled(True)
+        self.chat_search_input.setToolTip("Filter the chats by the text of their prompts and responses")
+        # Only search once the user pauses typing
+        self.chat_search_timer = QTimer(self)
+        self.chat_search_timer.setSingleShot(True)
+        self.chat_search_timer.timeout.connect(self.apply_chat_search)
+        self.chat_search_input.textChanged.connect(lambda: self.chat_search_timer.start(250))
+        sidebar_layout.addWidget(self.chat_search_input)
+        # chat_id -> best matching interaction_id of the current search, None if not searching
+        self.chat_search_matches = None
+        self.restoring_chat_selection = False
+
+        # Chats are fetched a page at a time as the list is scrolled
+        self.chat_list_model = ChatListModel(self.logs_db, self)
+        self.chat_list = QListView()
+        self.chat_list.setModel(self.chat_list_model)
+        self.chat_list.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.chat_list.clicked.connect(self.select_chat)
+        self.chat_list.selectionModel().currentChanged.connect(self.on_current_item_changed)
         # self.chat_list.setToolTip("List of saved chat conversations - click to load a chat")
         # Add spacing between items
         self.chat_list.setSpacing(3)
@@ -235,22 +279,42 @@ class LibreGeoLensDockWidget(QDockWidget):
         self.send_to_mllm_button.setToolTip("Send your prompt and selected image chips to the Multimodal Large Language Model")
         main_content_layout.addWidget(self.send_to_mllm_button)
 
+        self.stop_mllm_button = QPushButton("Stop")
+        self.stop_mllm_button.setStyleSheet("background-color: #E53935; color: white; padding: 10px;")
+        self.stop_mllm_button.clicked.connect(self.stop_mllm_request)
+        self.stop_mllm_button.setToolTip("Stop generating the response, discarding it")
+        self.stop_mllm_button.hide()
+        main_content_layout.addWidget(self.stop_mllm_button)
+        # The request being generated in the background, see send_to_mllm
+        self.mllm_worker = None
+        self.mllm_request = None
+        # Every request worker still running, including stopped ones, which must be waited for before closing
+        self.mllm_workers = set()
+        self.summary_workers = set()  # See summarize_chat_if_needed
+        self.chat_summary_turns = {}  # chat_id -> number of turns its latest summary was made from
+
         self.supported_api_clients = {
             "OpenAI": {
                 "class": OpenAI,
                 "models": ["gpt-4o-2024-08-06", "gpt-4o-mini-2024-07-18"],
+                "summary_model": "gpt-4o-mini-2024-07-18",  # Chats are titled with a cheaper model
                 "limits": {
                     "image_px": {
                         "longest_side": 2048,
                         "shortest_side": 768
-                    }
+                    },
+                    "image_format": "JPEG",
+                    "image_quality": 90
                 }
             },
             "Groq": {
                 "class": Groq,  # https://console.groq.com/docs/vision
                 "models": ["meta-llama/llama-4-maverick-17b-128e-instruct", "meta-llama/llama-4-scout-17b-16e-instruct"],
+                "summary_model": "meta-llama/llama-4-scout-17b-16e-instruct",
                 "limits": {
-                    "image_mb": 4
+                    "image_mb": 4,
+                    "image_format": "JPEG",
+                    "image_quality": 90
                 }
             },
             "SelfHosted": {
@@ -283,6 +347,13 @@ class LibreGeoLensDockWidget(QDockWidget):
 
         main_content_layout.addLayout(api_model_layout, stretch=1)
 
+        self.logs_sync_status_label = QLabel()
+        self.logs_sync_status_label.setStyleSheet("color: gray; font-size: 11px;")
+        self.logs_sync_status_label.setWordWrap(True)
+        self.logs_sync_status_label.hide()
+        self.logs_sync_scheduler.status_changed.connect(self.update_logs_sync_status)
+        main_content_layout.addWidget(self.logs_sync_status_label)
+
         main_content_widget.setLayout(main_content_layout)
         splitter.addWidget(main_content_widget)
 
@@ -326,8 +397,9 @@ class LibreGeoLensDockWidget(QDockWidget):
 
         self.adjust_size_to_available_space()
 
-        item = self.chat_list.item(self.chat_list.count() - 1)
-        if item is None:
+        # Most recent chat
+        index = self.chat_list_model.index(0)
+        if not index.isValid():
             # If there are no chats, this is likely the first time the plugin is used
             # Show the quick help and then start a new chat
             QApplication.processEvents()  # Ensure UI is fully loaded
@@ -336,11 +408,13 @@ class LibreGeoLensDockWidget(QDockWidget):
             # Show help dialog after a slight delay to allow UI to fully initialize
             QTimer.singleShot(300, lambda: self.show_quick_help(first_time=True))
         else:
-            self.chat_list.setCurrentItem(item)
-            self.load_chat(item)
+            self.chat_list.setCurrentIndex(index)
+            self.load_chat(index)
 
     def closeEvent(self, event):
 
+        self.stop_background_workers()
+
         if self.area_drawing_tool:
             self.area_drawing_tool.rubber_band.reset(QgsWkbTypes.PolygonGeometry)
             self.canvas.unsetMapTool(self.area_drawing_tool)
@@ -473,45 +547,125 @@ class LibreGeoLensDockWidget(QDockWidget):
                 QMessageBox.warning(None, "Feature Not Found", "No feature found for the clicked chip.")
 
     def load_chat_list(self):
-        self.chat_list.clear()
-        chats = self.logs_db.fetch_all_chats()
-        for chat in chats:
-            chat_id, chat_summary = chat[0], chat[2]
-            item = QListWidgetItem(chat_summary if chat_summary else f"New chat")
-            item.setData(Qt.UserRole, chat_id)
-            self.chat_list.addItem(item)
+        # Only the first page is loaded, the rest are fetched by the view as needed
+        self.chat_list_model.reload()
+
+    def apply_chat_search(self):
+        text = self.chat_search_input.text().strip()
+        if text:
+            matches = self.logs_db.search_interactions(text)
+            self.chat_search_matches = {chat_id: interaction_id for chat_id, _, interaction_id in matches}
+            self.chat_list_model.set_filter([(chat_id, chat_summary) for chat_id, chat_summary, _ in matches])
+        else:
+            self.chat_search_matches = None
+            self.chat_list_model.set_filter(None)
+        self.restore_chat_selection()
+
+    def clear_chat_search(self):
+        self.chat_search_timer.stop()
+        self.chat_search_input.blockSignals(True)
+        self.chat_search_input.clear()
+        self.chat_search_input.blockSignals(False)
+        if self.chat_search_matches is not None:
+            self.chat_search_matches = None
+            self.chat_list_model.set_filter(None)
+
+    def restore_chat_selection(self):
+        """Re-select the loaded chat in the list after it's been reset, without reloading it"""
+        row = self.chat_list_model.row_of_chat(self.current_chat_id)
+        if row >= 0:
+            self.restoring_chat_selection = True
+            self.chat_list.setCurrentIndex(self.chat_list_model.index(row))
+            self.restoring_chat_selection = False
+
+    def open_chat(self, chat_id):
+        """
+        Select and load a chat, fetching pages of the chat list until it's reached.
+        Returns whether it was loaded, which it isn't while a response is being streamed into the current chat
+        """
+        if chat_id is None:
+            return False
+        if self.mllm_request is not None:
+            return False  # Reloading the chat would overwrite the response being streamed
+        if self.chat_search_matches is not None and chat_id not in self.chat_search_matches:
+            self.clear_chat_search()
+        row = self.chat_list_model.row_of_chat(chat_id, fetch=True)
+        if row < 0:
+            return False
+        index = self.chat_list_model.index(row)
+        self.chat_list.setCurrentIndex(index)
+        self.load_chat(index)
+        return True
 
     def start_new_chat(self):
+        # Otherwise the new chat would be hidden by the search filter
+        self.clear_chat_search()
         self.current_chat_id = self.logs_db.save_chat([])
         self.conversation = []
         self.chat_history.clear()
-        self.load_chat_list()
-        new_chat = self.chat_list.item(self.chat_list.count() - 1)
-        self.chat_list.setCurrentItem(new_chat)
+        self.chat_list_model.add_chat(self.current_chat_id)
+        new_chat = self.chat_list_model.index(0)
+        self.chat_list.setCurrentIndex(new_chat)
         self.load_chat(new_chat)
 
     def on_current_item_changed(self, current, previous):
         """Handle when user navigates with arrow keys"""
-        if current:
-            self.load_chat(current)
+        if current.isValid() and not self.restoring_chat_selection:
+            self.select_chat(current)
+
+    def select_chat(self, index):
+        """Load the chat and, while searching, jump to its best matching interaction"""
+        self.load_chat(index)
+        if self.chat_search_matches and index.data(Qt.UserRole) in self.chat_search_matches:
+            self.scroll_to_interaction(self.chat_search_matches[index.data(Qt.UserRole)])
+
+    def scroll_to_interaction(self, interaction_id):
+        # Construct the interaction ID anchor
+        interaction_anchor = f"interaction-{interaction_id}"
+        # Retrieve the current chat HTML
+        chat_html = self.chat_history.toHtml()
+        if interaction_anchor in chat_html:
+            highlighted_html = '<p style'.join(
+                chat_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[:-1] +
+                [chat_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[-1].replace('="', '=" background-color: yellow;')]
+            ) + f'<a name="{interaction_anchor}">' + chat_html.split(f'<a name="{interaction_anchor}">')[1]
+            self.chat_history.setHtml(highlighted_html)
+            self.chat_history.scrollToAnchor(interaction_anchor)
+            # Remove highlight after a short duration
+            QTimer.singleShot(2000, lambda: self.remove_highlight(interaction_id))
+        else:
+            QMessageBox.warning(None, "Error", f"Interaction ID {interaction_id} not found.")
+
+    def remove_highlight(self, interaction_id):
+        """
+        Removes the temporary highlight from the interaction.
+        """
+        if self.mllm_request is not None:
+            return  # The chat is reloaded without it once the response being streamed is done
+        interaction_anchor = f"interaction-{interaction_id}"
+        highlighted_html = self.chat_history.toHtml()
+        chat_html = '<p style'.join(
+            highlighted_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[:-1] +
+            [highlighted_html.split(f'<a name="{interaction_anchor}">')[0].split('<p style')[-1].replace(' background-color:#ffff00;','')]
+        ) + f'<a name="{interaction_anchor}">' + highlighted_html.split(f'<a name="{interaction_anchor}">')[1]
+        self.chat_history.setHtml(chat_html)
+        self.chat_history.scrollToAnchor(interaction_anchor)
             
-    def load_chat(self, item):
-        chat_id = item.data(Qt.UserRole)
+    def load_chat(self, index):
+        chat_id = index.data(Qt.UserRole)
         self.current_chat_id = chat_id
         self.conversation = []
         self.chat_history.clear()
 
-        # Get chat data
-        interactions_sequence = json.loads(self.logs_db.fetch_chat_by_id(chat_id)[1])
+        # Get chat data, with all the interactions and their chips at once
+        interactions = self.logs_db.fetch_chat_bundle(chat_id)
         
         # Build full HTML content at once rather than appending incrementally
         full_html = []
         
-        for interaction_id in interactions_sequence:
-            (_, prompt, response, chip_ids, mllm_service, mllm_model, chip_modes,
-             original_resolutions, actual_resolutions) = self.logs_db.fetch_interaction_by_id(
-                interaction_id
-            )
+        for interaction in interactions:
+            interaction_id, prompt, response = interaction["id"], interaction["text_input"], interaction["text_output"]
+            mllm_service, mllm_model = interaction["mllm_service"], interaction["mllm_model"]
 
             # Add unique interaction ID to the HTML for scrolling
             user_html = (
@@ -524,31 +678,14 @@ class LibreGeoLensDockWidget(QDockWidget):
             # Add the interaction to the conversation list
             self.conversation.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
 
-            # Process chips associated with this interaction
-            chip_ids_list = json.loads(chip_ids)
-            chip_modes_list = ast.literal_eval(chip_modes)
-            try:
-                original_resolutions_list = ast.literal_eval(original_resolutions) if original_resolutions else []
-                actual_resolutions_list = ast.literal_eval(actual_resolutions) if actual_resolutions else []
-            except (TypeError, json.JSONDecodeError):
-                # Handle case where columns might be NULL or invalid in older database entries
-                original_resolutions_list = []
-                actual_resolutions_list = []
-            
-            # Ensure lists exist and have correct length (for backward compatibility)
-            if not original_resolutions_list:
-                original_resolutions_list = ["Unknown"] * len(chip_ids_list)
-            if not actual_resolutions_list:
-                actual_resolutions_list = ["Unknown"] * len(chip_ids_list)
-            
             # Optimize image loading - only load visible thumbnails
-            for i, (chip_id, chip_mode) in enumerate(zip(chip_ids_list, chip_modes_list)):
-                image_path = self.logs_db.fetch_chip_by_id(chip_id)[1]
+            for chip in interaction["chips"]:
+                image_path, chip_mode = chip["image_path"], chip["mode"]
                 normalized_path = image_path.replace("\\", "/")
                 
-                # Get resolution information
-                original_res = original_resolutions_list[i] if i < len(original_resolutions_list) else "Unknown"
-                actual_res = actual_resolutions_list[i] if i < len(actual_resolutions_list) else "Unknown"
+                # Get resolution information (NULL for older database entries)
+                original_res = chip["original_res"] or "Unknown"
+                actual_res = chip["actual_res"] or "Unknown"
                 
                 # Create resolution display text
                 resolution_html = ""
@@ -582,7 +719,7 @@ class LibreGeoLensDockWidget(QDockWidget):
                 # For conversation history, we need to load base64 data for API calls
                 # But we'll do this only when sending to MLLM, not during chat display
                 if chip_mode == "raw":
-                    sent_image_path = image_path.replace("_screen.png", "_raw.png")
+                    sent_image_path = ru.best_raw_chip_path(image_path)
                 else:
                     sent_image_path = image_path
                     
@@ -606,76 +743,68 @@ class LibreGeoLensDockWidget(QDockWidget):
         self.chat_history.setHtml(''.join(full_html))
 
     def load_image_base64_downscale_if_needed(self, image_path, api):
+        api_config = self.supported_api_clients.get(api, {})
+        limits = api_config.get("limits", {})
+
+        cache_key = self.encoded_image_cache.make_key(image_path, limits)
+        cached = self.encoded_image_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         image = Image.open(image_path)
         orig_width, orig_height = image.size
         final_width, final_height = orig_width, orig_height  # Default to original size
         was_resized = False
-
-        api_config = self.supported_api_clients.get(api, {})
-        limits = api_config.get("limits", {})
+        # What the image is sent as, the chips archived in the logs stay PNG
+        image_format = supported_format(limits.get("image_format", "PNG"), image)
+        image_quality = limits.get("image_quality", DEFAULT_QUALITY)
 
         # Process pixel-based limits
         if "image_px" in limits:
-            px_limits = limits["image_px"]
-            longest_side_limit = px_limits.get("longest_side")
-            shortest_side_limit = px_limits.get("shortest_side")
-
-            longest = max(orig_width, orig_height)
-            shortest = min(orig_width, orig_height)
+            image = resize_to_px_limits(image, limits["image_px"])
+            final_width, final_height = image.size
+            was_resized = image.size != (orig_width, orig_height)
 
-            # Check if image already meets both constraints.
-            if longest > longest_side_limit or shortest > shortest_side_limit:
-                # Compute scale factors for each constraint.
-                factor_longest = longest_side_limit / longest  # to keep the longest side within limit
-                factor_shortest = shortest_side_limit / shortest  # to keep the shortest side within limit
-
-                # Choose the smallest factor; also do not upscale (max factor = 1).
-                scale_factor = min(1, factor_longest, factor_shortest)
-
-                final_width = int(round(orig_width * scale_factor))
-                final_height = int(round(orig_height * scale_factor))
-                was_resized = True
-                image = image.resize((final_width, final_height))
-
-            # Save the (possibly resized) image into a buffer as PNG
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
+            # Encode the (possibly resized) image
+            encoded_image = encode_image(image, image_format, image_quality)
 
         # Otherwise, if the client has a file size limit in MB
         elif "image_mb" in limits:
-            max_mb = limits["image_mb"]
-            # Save the original image as PNG with optimization and maximum compression
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
-            file_size_mb = buffer.tell() / (1024 * 1024)
-
-            # If the file size exceeds the allowed limit, predict a downscaling factor
-            if file_size_mb > max_mb:
-                # Predict the scaling factor assuming file size scales roughly with image area
-                scaling_factor = math.sqrt(max_mb / file_size_mb)
-                # Only downsample if scaling_factor < 1 (avoid upsampling)
-                if scaling_factor < 1.0:
-                    final_width = int(orig_width * scaling_factor)
-                    final_height = int(orig_height * scaling_factor)
-                    was_resized = True
-                    image = image.resize((final_width, final_height))
-                # Re-encode the resized image
-                buffer = io.BytesIO()
-                image.save(buffer, format="PNG")
+            # Land just under the limit, sizes being predicted and refined on downsampled images. Without a
+            # configured format, PNG is kept if it fits at full resolution, otherwise whichever format needs the
+            # least downscaling is used
+            formats = (image_format,) if "image_format" in limits else ("PNG", "JPEG", "WEBP")
+            encoded_image, image_format, (final_width, final_height) = encode_image_within_size(
+                image, limits["image_mb"] * 1024 * 1024, formats=formats, quality=image_quality
+            )
+            was_resized = (final_width, final_height) != (orig_width, orig_height)
 
         else:
-            # If no image limits are defined, just encode the image as PNG.
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
+            # If no image limits are defined, just encode the image.
+            encoded_image = encode_image(image, image_format, image_quality)
 
         # Return a tuple with the base64-encoded string and dimension info
         dimensions = {
             "original": f"{orig_width}x{orig_height}", 
             "final": f"{final_width}x{final_height}",
-            "was_resized": was_resized
+            "was_resized": was_resized,
+            "mime_type": MIME_TYPES[image_format]
         }
         
-        return base64.b64encode(buffer.getvalue()).decode("utf-8"), dimensions
+        image_base64 = base64.b64encode(encoded_image).decode("utf-8")
+        self.encoded_image_cache.put(cache_key, image_base64, dimensions)
+        return image_base64, dimensions
+
+    def get_max_chip_dimension(self, api, width, height):
+        """
+        Longest side that a width x height chip will be downscaled to in order to comply with the API's pixel limits,
+        or None if the API doesn't have any
+        """
+        px_limits = self.supported_api_clients.get(api, {}).get("limits", {}).get("image_px")
+        if px_limits is None:
+            return None
+        scale_factor = scale_to_px_limits(width, height, px_limits)
+        return int(round(max(width, height) * scale_factor))
 
     @staticmethod
     def style_geojson_layer(geojson_layer, color=(255, 0, 0)):
@@ -787,6 +916,15 @@ class LibreGeoLensDockWidget(QDockWidget):
             QMessageBox.critical(self.iface.mainWindow(), "Error", "No GeoJSON path set.")
             return
 
+        # Stop loading COGs from the previous GeoJSON. Tasks that are already done still report back,
+        # but their generation is stale, so their layers aren't added
+        self.cog_load_generation += 1
+        for task in self.cog_load_tasks:
+            task.cancel()
+        self.cog_load_tasks = []
+        self.cogs_loaded = 0
+        self.update_cog_loading_progress()
+
         # Remove previously tracked layers
         project = QgsProject.instance()
         for layer_id in self.tracked_layers:
@@ -808,11 +946,22 @@ class LibreGeoLensDockWidget(QDockWidget):
         self.style_geojson_layer(self.geojson_layer)
         self.tracked_layers.append(self.geojson_layer.id())
         self.tracked_layers_names.append("geojson_layer")
+        self.build_geojson_index()
 
         self.handle_log_layer()
 
         QMessageBox.information(self.iface.mainWindow(), "Success", "GeoJSON loaded successfully!")
 
+    def build_geojson_index(self):
+        """
+        Bulk load a spatial index over the imagery outlines so that finding the ones that intersect an area
+        doesn't need to go through all of them. The outlines' geometries are kept in the index.
+        """
+        request = QgsFeatureRequest().setNoAttributes()
+        self.geojson_index = QgsSpatialIndex(
+            self.geojson_layer.getFeatures(request), flags=QgsSpatialIndex.FlagStoreFeatureGeometries
+        )
+
     def create_log_layer(self):
         """
         Load logs.geojson from self.logs_dir if it exists.
@@ -964,65 +1113,124 @@ class LibreGeoLensDockWidget(QDockWidget):
 
         rectangle_geom = self.transform_rectangle_crs(rectangle, self.geojson_layer.crs())
 
-        # Record how many layers are currently tracked
-        old_count = len(self.tracked_layers)
-
-        # Find features that intersect with the rectangle
+        # Find features that intersect with the rectangle: candidates come from the spatial index,
+        # and only their geometries are tested exactly
+        if self.geojson_index is None:
+            self.build_geojson_index()
+        candidate_ids = self.geojson_index.intersects(rectangle_geom.boundingBox())
+        request = QgsFeatureRequest().setFilterFids(candidate_ids).setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(["remote_path"], self.geojson_layer.fields())
+        loading_paths = {task.remote_path for task in self.cog_load_tasks}
         cogs_paths = []
-        for feature in self.geojson_layer.getFeatures():
-            if feature.geometry().intersects(rectangle_geom):
+        for feature in self.geojson_layer.getFeatures(request):
+            if self.geojson_index.geometry(feature.id()).intersects(rectangle_geom):
                 remote_path = feature["remote_path"]
-                if remote_path and remote_path not in self.tracked_layers_names:
+                if remote_path and remote_path not in self.tracked_layers_names and remote_path not in loading_paths:
                     cogs_paths.append(remote_path)
 
-        def load_cog(remote_path):
-            if remote_path.startswith("s3://"):
-                cog_url = f"/vsis3/{remote_path[5:]}"
-            elif remote_path.startswith("https://"):
-                cog_url = f"/vsicurl/{remote_path}"
-            else:
-                QMessageBox.warning(
-                    self.iface.mainWindow(),
-                    "Warning",
-                    f"Unsupported remote path format: {remote_path}"
-                )
-                return
-            raster_layer = QgsRasterLayer(cog_url, remote_path.split('/')[-1], "gdal")
-            if raster_layer.isValid():
-                QgsProject.instance().addMapLayer(raster_layer)
-                self.tracked_layers.append(raster_layer.id())
-                self.cogs_dict[raster_layer.id()] = remote_path
-                settings = QSettings("Ampsight", "LibreGeoLens")
-                settings.setValue("cogs_dict", json.dumps(self.cogs_dict))  # Save as JSON string
-                self.tracked_layers_names.append(remote_path)
-            else:
-                QMessageBox.warning(
-                    self.iface.mainWindow(),
-                    "Warning",
-                    f"Failed to load COG: {remote_path}"
-                )
+        if not cogs_paths:
+            QMessageBox.information(
+                self.iface.mainWindow(),
+                "No COGs Found",
+                "No imagery was found within the drawn rectangle or imagery already loaded."
+            )
+            return
 
         # Load corresponding COGs if it's not too many or give the option to select one to load
-        if len(cogs_paths) <= 5:
-            for cog_path in cogs_paths:
-                load_cog(cog_path)
+        if len(cogs_paths) <= self.max_cogs_to_load:
+            self.load_cogs(cogs_paths)
         else:
             options = [path.split('/')[-1] for path in cogs_paths]
             selected_option, ok = QInputDialog.getItem(
                 None,
                 "Select Image Outline",
-                "Please draw an area that intersects with no more than 5 image outlines or select one of these to load:",
+                f"Please draw an area that intersects with no more than {self.max_cogs_to_load} image outlines "
+                f"or select one of these to load:",
                 options,
                 0,
                 False
             )
             if ok:
                 selected_index = options.index(selected_option)
-                load_cog(cogs_paths[selected_index])
+                self.load_cogs([cogs_paths[selected_index]])
+
+    def load_cogs(self, remote_paths):
+        """
+        Load COGs in parallel background tasks, adding each one to the project as soon as it's ready
+        and reporting the progress in the message bar
+        """
+        for remote_path in remote_paths:
+            if remote_path.startswith("s3://"):
+                cog_url = f"/vsis3/{remote_path[5:]}"
+            elif remote_path.startswith("https://"):
+                cog_url = f"/vsicurl/{remote_path}"
             else:
-                return
+                QMessageBox.warning(
+                    self.iface.mainWindow(),
+                    "Warning",
+                    f"Unsupported remote path format: {remote_path}"
+                )
+                continue
+            task = LoadCogTask(remote_path, cog_url, self.cog_load_generation)
+            task.taskCompleted.connect(lambda task=task: self.on_cog_loaded(task))
+            task.taskTerminated.connect(lambda task=task: self.on_cog_load_failed(task))
+            self.cog_load_tasks.append(task)
+            QgsApplication.taskManager().addTask(task)
+        self.update_cog_loading_progress()
+
+    def on_cog_loaded(self, task):
+        if task.generation != self.cog_load_generation:
+            return  # Loaded for a previous GeoJSON
+        self.cog_load_tasks.remove(task)
+        self.cog_loads_finished += 1
+        if task.layer is not None:
+            raster_layer = task.layer
+            QgsProject.instance().addMapLayer(raster_layer)
+            self.tracked_layers.append(raster_layer.id())
+            self.cogs_dict[raster_layer.id()] = task.remote_path
+            settings = QSettings("Ampsight", "LibreGeoLens")
+            settings.setValue("cogs_dict", json.dumps(self.cogs_dict))  # Save as JSON string
+            self.tracked_layers_names.append(task.remote_path)
+            self.keep_vector_layers_on_top()
+            self.cogs_loaded += 1
+        self.update_cog_loading_progress()
+
+    def on_cog_load_failed(self, task):
+        if task.generation != self.cog_load_generation:
+            return
+        self.cog_load_tasks.remove(task)
+        self.cog_loads_finished += 1
+        if not task.isCanceled():
+            self.iface.messageBar().pushWarning("LibreGeoLens", f"Failed to load COG: {task.remote_path}")
+        self.update_cog_loading_progress()
+
+    def update_cog_loading_progress(self):
+        """Show how many of the COGs being loaded are done in the message bar, and how many loaded once all are"""
+        total = self.cog_loads_finished + len(self.cog_load_tasks)
+        try:
+            if self.cog_loading_message is None and self.cog_load_tasks:
+                self.cog_loading_message = self.iface.messageBar().createMessage("LibreGeoLens", "Loading COGs...")
+                self.cog_loading_bar = QProgressBar()
+                self.cog_loading_message.layout().addWidget(self.cog_loading_bar)
+                self.iface.messageBar().pushWidget(self.cog_loading_message, Qgis.Info)
+            if self.cog_loading_bar is not None:
+                self.cog_loading_bar.setMaximum(total)
+                self.cog_loading_bar.setValue(self.cog_loads_finished)
+            if not self.cog_load_tasks and self.cog_loading_message is not None:
+                self.iface.messageBar().popWidget(self.cog_loading_message)
+        except RuntimeError:
+            pass  # The user closed the message
+
+        if not self.cog_load_tasks:
+            if self.cogs_loaded > 0:
+                self.iface.messageBar().pushSuccess(
+                    "LibreGeoLens", f"{self.cogs_loaded} of {total} COGs within the rectangle have been displayed."
+                )
+            self.cog_loads_finished, self.cogs_loaded = 0, 0
+            self.cog_loading_message, self.cog_loading_bar = None, None
 
-        # Reorder layers to ensure log layer and GeoJSON layer remain on top
+    def keep_vector_layers_on_top(self):
+        """Reorder layers to ensure log layer and GeoJSON layer remain on top"""
         root = QgsProject.instance().layerTreeRoot()
         log_layer_node = root.findLayer(self.log_layer.id())
         geojson_layer_node = root.findLayer(self.geojson_layer.id())
@@ -1035,22 +1243,6 @@ class LibreGeoLensDockWidget(QDockWidget):
             root.insertChildNode(1, geojson_layer_node.clone())
             root.removeChildNode(geojson_layer_node)
 
-        # compare old vs. new count of tracked layers
-        new_count = len(self.tracked_layers)
-        cogs_added = new_count - old_count
-        if cogs_added == 0:
-            QMessageBox.information(
-                self.iface.mainWindow(),
-                "No COGs Found",
-                "No imagery was found within the drawn rectangle or imagery already loaded."
-            )
-        else:
-            QMessageBox.information(
-                self.iface.mainWindow(),
-                "Success",
-                "COGs within the rectangle have been displayed."
-            )
-
     def open_directory(self, local_dir):
         """Open the logs directory using the default file explorer for the current OS."""
         local_dir = os.path.abspath(local_dir)
@@ -1091,6 +1283,12 @@ class LibreGeoLensDockWidget(QDockWidget):
             
             if "image_mb" in limits:
                 info_text += f"<li>Max file size: {limits['image_mb']}MB</li>"
+
+            if "image_format" in limits:
+                image_format = limits["image_format"]
+                if image_format in ("JPEG", "WEBP"):
+                    image_format += f" (quality {limits.get('image_quality', DEFAULT_QUALITY)})"
+                info_text += f"<li>Sent as: {image_format}</li>"
                 
             info_text += "</ul></li>"
         
@@ -1146,12 +1344,12 @@ class LibreGeoLensDockWidget(QDockWidget):
 
     def delete_chat(self):
         """Delete the selected chat after confirmation"""
-        current_item = self.chat_list.currentItem()
-        if not current_item:
+        current_index = self.chat_list.currentIndex()
+        if not current_index.isValid():
             QMessageBox.warning(self, "Warning", "Please select a chat to delete.")
             return
 
-        chat_id = current_item.data(Qt.UserRole)
+        chat_id = current_index.data(Qt.UserRole)
         reply = QMessageBox.question(
             self,
             "Confirm Delete",
@@ -1173,31 +1371,32 @@ class LibreGeoLensDockWidget(QDockWidget):
 
             modified_logs = False
             # Delete chat and get chips to remove from log layer
-            for image_path, chip_id in self.logs_db.delete_chat(chat_id, delete_chips=reply == QMessageBox.Yes):
-                # Remove the chip's feature from log layer
-                features_to_remove = []
-                for feature in self.log_layer.getFeatures():
-                    if str(feature["ChipId"]) == str(chip_id):
-                        features_to_remove.append(feature.id())
+            deleted_chips = self.logs_db.delete_chat(chat_id, delete_chips=reply == QMessageBox.Yes)
+            if deleted_chips:
+                # Remove the chips' features from log layer in a single pass
+                deleted_chip_ids = {str(chip_id) for _, chip_id in deleted_chips}
+                features_to_remove = [
+                    feature.id() for feature in self.log_layer.getFeatures()
+                    if str(feature["ChipId"]) in deleted_chip_ids
+                ]
                 if features_to_remove:
                     modified_logs = True
                     self.log_layer.startEditing()
                     self.log_layer.dataProvider().deleteFeatures(features_to_remove)
                     self.log_layer.commitChanges()
+            for image_path, _ in deleted_chips:
                 # Delete the image files
                 if os.path.exists(image_path):
                     os.remove(image_path)
-                raw_path = image_path.replace("_screen.png", "_raw.png")
-                if os.path.exists(raw_path):
+                for raw_path in ru.raw_chip_paths(image_path):
                     os.remove(raw_path)
 
             # Clear the chat display
-            row = self.chat_list.row(current_item)
-            self.chat_list.takeItem(row)
+            self.chat_list_model.remove_chat(chat_id)
             self.current_chat_id = None
             self.conversation = []
             self.chat_history.clear()
-            self.chat_list.setCurrentRow(-1)
+            self.chat_list.setCurrentIndex(QModelIndex())
 
             if modified_logs:
                 # If log layer is empty, remove from disk and create from scratch instead of saving changes
@@ -1210,20 +1409,38 @@ class LibreGeoLensDockWidget(QDockWidget):
                     self.handle_log_layer()
 
             # Start new chat if no chats left
-            if self.chat_list.count() == 0:
+            if self.logs_db.count_chats() == 0:
                 self.start_new_chat()
 
-    def save_image_to_logs(self, image, chip_id, raw=False):
-        image_dir = os.path.join(self.logs_dir, "chips")
+    def save_image_to_logs(self, image, chip_id, raw=False, image_dir=None, max_dimension=None, original_size=None):
+        """
+        Save a chip's screen image, or its raw one, read decimated to `max_dimension` if set
+        from an `original_size` chip of the imagery
+        """
+        if image_dir is None:
+            image_dir = os.path.join(self.logs_dir, "chips")
         os.makedirs(image_dir, exist_ok=True)
         # Save the image file in the created directory
         image_path = os.path.join(image_dir, f"{chip_id}_screen.png")
         if raw:
-            image.save(image_path.replace("_screen.png", "_raw.png"), "PNG")
+            image.save(ru.raw_chip_path(image_path, max_dimension, original_size), "PNG")
         else:
             image.save(image_path, "PNG")
         return image_path
 
+    def finalize_chip_image(self, pending_image_path, chip_id):
+        """Path of a new chip's screen image in the logs, named after its id in the database"""
+        return os.path.join(self.logs_dir, "chips", f"{chip_id}_screen.png")
+
+    @staticmethod
+    def move_chip_images(image_path, new_image_path):
+        """Move a chip's screen image, and its raw images along with it"""
+        os.makedirs(os.path.dirname(new_image_path), exist_ok=True)
+        for raw_image_path in ru.raw_chip_paths(image_path):
+            raw_suffix = raw_image_path[len(image_path.replace("_screen.png", "")):]
+            shutil.move(raw_image_path, new_image_path.replace("_screen.png", raw_suffix))
+        shutil.move(image_path, new_image_path)
+
     def send_to_mllm_fn(self):
         try:
             self.send_to_mllm()
@@ -1238,15 +1455,14 @@ class LibreGeoLensDockWidget(QDockWidget):
 
         selected_api = self.api_selection.currentText()
         selected_model = self.model_selection.currentText()
-        api_key = os.getenv(selected_api.upper() + "_API_KEY")
-        if api_key is None:
+        client = self.get_api_client(selected_api)
+        if client is None:
             QMessageBox.warning(
                 self.iface.mainWindow(), "Error",
                 f"{selected_api} API key not set."
                 f" Please refer to https://github.com/ampsight/LibreGeoLens?tab=readme-ov-file#mllm-services"
             )
             return
-        client = self.supported_api_clients[selected_api]["class"](api_key=api_key)
 
         prompt = self.prompt_input.toPlainText()
         if not prompt.strip():
@@ -1262,8 +1478,7 @@ class LibreGeoLensDockWidget(QDockWidget):
         image_html_list = []
         
         n_images = len(self.image_display_widget.images)
-        chip_ids_sequence, chip_modes_sequence = [], []
-        chips_original_resolutions, chips_actual_resolutions = [], []
+        chips = []  # What gets persisted with the interaction
         send_raw = self.radio_raw.isChecked()
         
         # Process all images first before updating UI
@@ -1273,26 +1488,31 @@ class LibreGeoLensDockWidget(QDockWidget):
             
             # For unsaved images
             if image_path is None:
+                # New chips are only saved to the database together with the interaction, so until then
+                # their images are kept in a pending directory and named after the temp chip id
                 rectangle_geom = self.image_display_widget.images[idx]["rectangle_geom"]
                 polygon_coords = rectangle_geom.asPolygon()
-                chip_id = self.logs_db.save_chip(
-                    image_path="tmp_image_path.png",
-                    geocoords=[[point.x(), point.y()] for point in polygon_coords[0]] +
-                              [[polygon_coords[0][0].x(), polygon_coords[0][0].y()]]
-                )
-                chip_ids_sequence.append(chip_id)
-                image_path = self.save_image_to_logs(image_to_send, chip_id)
-                self.image_display_widget.images[idx]["image_path"] = image_path
-                self.logs_db.update_chip_image_path(chip_id, image_path)
+                chip_key = self.image_display_widget.images[idx]["chip_id"]
+                image_path = self.save_image_to_logs(image_to_send, chip_key, image_dir=self.pending_chips_dir)
+                chips.append({
+                    "id": None,
+                    "image_path": image_path,
+                    "geocoords": [[point.x(), point.y()] for point in polygon_coords[0]] +
+                                 [[polygon_coords[0][0].x(), polygon_coords[0][0].y()]]
+                })
             else:
-                chip_ids_sequence.append(int(ntpath.basename(image_path).split(".")[0].split("_screen")[0]))
+                chip_key = int(ntpath.basename(image_path).split(".")[0].split("_screen")[0])
+                chips.append({"id": chip_key, "image_path": image_path})
 
             # Process raw chips if needed
             if send_raw:
-                chip_modes_sequence.append("raw")
-                raw_image_path = image_path.replace("_screen.png", "_raw.png")
-                
-                if not os.path.exists(raw_image_path):
+                chips[-1]["mode"] = "raw"
+                # Raw images on disk are reused if they're large enough for the service, without opening the imagery
+                raw_image_path = ru.reusable_raw_chip_path(
+                    image_path, lambda width, height: self.get_max_chip_dimension(selected_api, width, height)
+                )
+
+                if raw_image_path is None:
                     # Raw image doesn't exist yet - need to extract it
                     rectangle = self.image_display_widget.images[idx]["rectangle_geom"].boundingBox()
                     cog_path = ru.find_topmost_cog_feature(rectangle)
@@ -1304,12 +1524,17 @@ class LibreGeoLensDockWidget(QDockWidget):
                         )
                         self.reload_current_chat()
                         return
-                        
+
                     drawn_box_geocoords = ru.get_drawn_box_geocoordinates(rectangle, cog_path)
                     chip_width, chip_height = ru.determine_chip_size(drawn_box_geocoords, cog_path)
 
-                    # Hardcoded to OpenAI since we only have OpenAI and Groq and Groq is more permissive
-                    if max(chip_width, chip_height) > 2048:
+                    # Chips are read decimated to the service's pixel limits, which is cheap. Only services without
+                    # them (e.g. Groq, which limits the file size instead) need the full resolution chip to be read
+                    max_dimension = self.get_max_chip_dimension(selected_api, chip_width, chip_height)
+                    if max_dimension is not None and max_dimension >= max(chip_width, chip_height):
+                        max_dimension = None  # Within the limits at full resolution
+
+                    if max_dimension is None and max(chip_width, chip_height) > 2048:
                         reply = QMessageBox.question(
                             self,
                             "Confirm Chip",
@@ -1327,34 +1552,40 @@ class LibreGeoLensDockWidget(QDockWidget):
                     center_latitude = (drawn_box_geocoords.yMinimum() + drawn_box_geocoords.yMaximum()) / 2
                     center_longitude = (drawn_box_geocoords.xMinimum() + drawn_box_geocoords.xMaximum()) / 2
                     
-                    image_to_send = ru.extract_chip_from_tif_point_in_memory(
-                        img_path=cog_path,
-                        center_latitude=center_latitude,
-                        center_longitude=center_longitude,
-                        chip_width_px=chip_width,
-                        chip_height_px=chip_height
-                    )
-                    self.save_image_to_logs(image_to_send, chip_ids_sequence[-1], raw=True)
-                
-                # Get image base64 and dimensions
-                image_base64, dimensions = self.load_image_base64_downscale_if_needed(raw_image_path, selected_api)
-                chips_original_resolutions.append(dimensions["original"])
-                chips_actual_resolutions.append(dimensions["final"])
-                
-                self.conversation[-1]["content"].append(
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
-                )
+                    try:
+                        image_to_send = ru.extract_chip_from_tif_point_in_memory(
+                            img_path=cog_path,
+                            center_latitude=center_latitude,
+                            center_longitude=center_longitude,
+                            chip_width_px=chip_width,
+                            chip_height_px=chip_height,
+                            max_dimension=max_dimension,
+                            band_indexes=ru.parse_band_indexes(
+                                QSettings("Ampsight", "LibreGeoLens").value("raw_chip_bands", "")
+                            )
+                        )
+                    except ValueError as e:
+                        QMessageBox.warning(self.iface.mainWindow(), "Raw Chip Extraction Failed", str(e))
+                        self.reload_current_chat()
+                        return
+                    raw_image_path = ru.raw_chip_path(image_path, max_dimension, (chip_width, chip_height))
+                    self.save_image_to_logs(image_to_send, chip_key, raw=True, image_dir=os.path.dirname(image_path),
+                                            max_dimension=max_dimension, original_size=(chip_width, chip_height))
+
+                # Whatever resolution it was read at, record the resolution of the imagery itself. The full
+                # resolution raw image's is its own, see persist_mllm_response
+                _, original_size = ru.parse_raw_chip_path(raw_image_path)
+                if original_size is not None:
+                    chips[-1]["original_res"] = "{}x{}".format(*original_size)
+                chips[-1]["sent_path"] = raw_image_path
             else:
-                chip_modes_sequence.append("screen")
-                
-                # Get image base64 and dimensions
-                image_base64, dimensions = self.load_image_base64_downscale_if_needed(image_path, selected_api)
-                chips_original_resolutions.append(dimensions["original"])
-                chips_actual_resolutions.append(dimensions["final"])
-                
-                self.conversation[-1]["content"].append(
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
-                )
+                chips[-1]["mode"] = "screen"
+                chips[-1]["sent_path"] = image_path
+
+            # Images are encoded by the request worker
+            self.conversation[-1]["content"].append(
+                {"type": "local_image_path", "path": chips[-1]["sent_path"], "mode": chips[-1]["mode"]}
+            )
             
             # Create image thumbnail HTML - use file:// URL instead of base64 to reduce HTML size
             normalized_path = image_path.replace("\\", "/")
@@ -1376,109 +1607,139 @@ class LibreGeoLensDockWidget(QDockWidget):
         all_content_html = current_html + user_html + ''.join(image_html_list)
         self.chat_history.setHtml(all_content_html)
         self.chat_history.verticalScrollBar().setValue(self.chat_history.verticalScrollBar().maximum())
-        QApplication.processEvents()
-
-        # Stream the response dynamically
-        accumulated_text = f"<b>{selected_model} ({selected_api}):</b> "
-        full_html = self.chat_history.toHtml()
-
-        # Use an efficient buffer for accumulating large responses
-        response_buffer = []
 
-        # Process the conversation to convert any local image paths to base64
-        processed_conversation = []
-        for message in self.conversation:
-            processed_message = {"role": message["role"]}
-            
-            if message["role"] == "assistant":
-                processed_message["content"] = message["content"]
-                processed_conversation.append(processed_message)
-                continue
-                
-            processed_content = []
-            for content in message["content"]:
-                if content.get("type") == "local_image_path":
-                    # Convert local image paths to base64
-                    image_path = content["path"]
-                    if os.path.exists(image_path):
-                        # Get image base64 and dimensions (we collect dimensions for conversation history, 
-                        # though we don't save them when loading past conversations since they're already saved)
-                        image_base64, dimensions = self.load_image_base64_downscale_if_needed(image_path, selected_api)
-                        processed_content.append({
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{image_base64}"}
-                        })
-                else:
-                    processed_content.append(content)
-            
-            processed_message["content"] = processed_content
-            processed_conversation.append(processed_message)
-            
-        # Start API call with processed conversation data
-        response_stream = client.chat.completions.create(
-            model=selected_model,
-            messages=processed_conversation,
-            stream=True
+        # Encoding the images and streaming the response happen in the background,
+        # and the results are persisted once it's all done, see on_mllm_response_completed
+        self.mllm_request = {
+            "chat_id": self.current_chat_id, "prompt": prompt, "chips": chips,
+            "images": self.image_display_widget.images[:n_images],
+            "api": selected_api, "model": selected_model,
+            # Stream the response dynamically
+            "renderer": StreamingMarkdownRenderer(
+                self.chat_history, prefix=f"<b>{selected_model} ({selected_api}):</b> ", parent=self
+            )
+        }
+        self.mllm_worker = MllmRequestWorker(
+            client, selected_model, list(self.conversation),
+            encode_image=lambda path: self.load_image_base64_downscale_if_needed(path, selected_api), parent=self
         )
+        self.mllm_worker.token_received.connect(self.on_mllm_token_received)
+        self.mllm_worker.response_completed.connect(self.on_mllm_response_completed)
+        self.mllm_worker.request_failed.connect(self.on_mllm_request_failed)
+        self.mllm_worker.finished.connect(self.on_mllm_worker_finished)
+        self.mllm_workers.add(self.mllm_worker)
+        self.set_mllm_request_running(True)
+        self.mllm_worker.start()
+
+    def set_mllm_request_running(self, running):
+        """Swap the Send and Stop buttons and lock what could change the chat or its chips during a request"""
+        self.send_to_mllm_button.setVisible(not running)
+        self.stop_mllm_button.setVisible(running)
+        self.stop_mllm_button.setEnabled(True)
+        self.stop_mllm_button.setText("Stop")
+        for widget in (self.chat_list, self.chat_search_input, self.start_new_chat_button, self.delete_chat_button,
+                       self.select_area_button, self.image_display_widget):
+            widget.setEnabled(not running)
+        if running and self.identify_drawn_area_tool:
+            # Selecting an area opens its chat, so the tool is put away like its button
+            self.canvas.unsetMapTool(self.identify_drawn_area_tool)
+            self.identify_drawn_area_tool = None
+            if self.current_highlighted_button is self.select_area_button:
+                self.select_area_button.setStyleSheet("")
+                self.current_highlighted_button = None
+
+    def finish_mllm_request(self):
+        """Detach the dock from the current request, whose worker won't be listened to anymore, and return it"""
+        request = self.mllm_request
+        request["renderer"].stop()
+        request["renderer"].deleteLater()
+        self.mllm_worker, self.mllm_request = None, None
+        self.set_mllm_request_running(False)
+        return request
+
+    def stop_mllm_request(self):
+        """
+        Discard the request being generated. The prompt is given back to be edited or resent
+        once its worker has finished, see on_mllm_worker_finished
+        """
+        if self.mllm_worker is None or self.mllm_worker.isInterruptionRequested():
+            return
+        self.mllm_worker.stop()
+        self.mllm_request["renderer"].stop()
+        self.stop_mllm_button.setEnabled(False)
+        self.stop_mllm_button.setText("Stopping...")
+
+    def is_current_mllm_worker(self, worker):
+        """Whether signals from the worker are still listened to, i.e. it's the current one and wasn't stopped"""
+        return worker is self.mllm_worker and not worker.isInterruptionRequested()
+
+    def on_mllm_worker_finished(self):
+        worker = self.sender()
+        self.mllm_workers.discard(worker)
+        worker.deleteLater()
+        if worker is not self.mllm_worker:
+            return
+        # Stopped, or ended without a response or an error
+        request = self.finish_mllm_request()
+        self.reload_current_chat()
+        self.prompt_input.setPlainText(request["prompt"])
+
+    def stop_background_workers(self):
+        """Stop the workers still running and wait for them, so that none outlives the dock"""
+        self.stop_mllm_request()
+        workers = self.mllm_workers | self.summary_workers
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.wait()
+
+    def on_mllm_token_received(self, content):
+        if not self.is_current_mllm_worker(self.sender()):
+            return  # From a stopped request
+        self.mllm_request["renderer"].append(content)
+
+    def on_mllm_request_failed(self, error):
+        if not self.is_current_mllm_worker(self.sender()):
+            return
+        self.finish_mllm_request()
+        QMessageBox.warning(self.iface.mainWindow(), "Error", error)
+        self.reload_current_chat()
 
-        # Process the stream with fewer UI updates
-        update_counter = 0
-        update_frequency = 2  # Update UI every N chunks to reduce UI redraws
-
-        for chunk in response_stream:
-            content = chunk.choices[0].delta.content
-            if content is None:
-                continue
+    def on_mllm_response_completed(self, response, dimensions):
+        if not self.is_current_mllm_worker(self.sender()):
+            return
+        request = self.finish_mllm_request()
+        try:
+            self.persist_mllm_response(request, response, dimensions)
+            self.summarize_chat_if_needed(request["chat_id"], request["api"], request["model"])
+        except Exception as e:
+            QMessageBox.warning(self.iface.mainWindow(), "Error", str(e))
+        finally:
+            # Reload chat to offload in-memory imagery in self.conversation
+            self.reload_current_chat()
 
-            response_buffer.append(content)
-            update_counter += 1
-
-            # Only update UI periodically to improve performance
-            if update_counter >= update_frequency:
-                accumulated_text += ''.join(response_buffer)
-                rendered_markdown = markdown.markdown(accumulated_text)
-                updated_html = full_html + rendered_markdown
-                self.chat_history.setHtml(updated_html)
-                self.chat_history.verticalScrollBar().setValue(self.chat_history.verticalScrollBar().maximum())
-                QApplication.processEvents()
-                response_buffer = []
-                update_counter = 0
-
-        # Final update with any remaining content
-        if response_buffer:
-            accumulated_text += ''.join(response_buffer)
-
-        # Complete response
-        response = accumulated_text.replace(f"<b>{selected_model} ({selected_api}):</b> ", "")
-        full_html += markdown.markdown(accumulated_text)
-        self.chat_history.setHtml(full_html)
-
-        self.conversation.append({"role": "assistant", "content": response})
-        interaction_id = self.logs_db.save_interaction(
-            text_input=prompt, text_output=response,
-            chips_sequence=chip_ids_sequence,
-            mllm_service=selected_api, mllm_model=selected_model,
-            chips_mode_sequence=chip_modes_sequence,
-            chips_original_resolutions=chips_original_resolutions,
-            chips_actual_resolutions=chips_actual_resolutions
+    def persist_mllm_response(self, request, response, dimensions):
+        """Save a completed request to the logs database and the log layer, and back up the logs"""
+        prompt, chips, images = request["prompt"], request["chips"], request["images"]
+        for chip in chips:
+            chip_dimensions = dimensions[chip.pop("sent_path")]
+            chip.setdefault("original_res", chip_dimensions["original"])
+            chip["actual_res"] = chip_dimensions["final"]
+
+        # Save the new chips, the interaction and its link to the chat in a single transaction
+        interaction_id, chip_ids_sequence = self.logs_db.record_interaction(
+            chat_id=request["chat_id"], text_input=prompt, text_output=response, chips=chips,
+            mllm_service=request["api"], mllm_model=request["model"],
+            finalize_image_path=self.finalize_chip_image, move_image=self.move_chip_images
         )
-        self.logs_db.add_new_interaction_to_chat(self.current_chat_id, interaction_id)
-
-        summary = client.chat.completions.create(
-            model=selected_model,
-            messages=[
-                {"role": "user", "content": [{"type": "text", "text":
-                    f"Summarize the following in 10 words or less: {self.chat_history.toPlainText()}."
-                    f" Only respond with your summary."}]}]
-        ).choices[0].message.content.strip()
-        self.logs_db.update_chat_summary(self.current_chat_id, summary)
-        self.chat_list.currentItem().setText(summary)
+        for idx in range(len(images)):
+            images[idx]["image_path"] = chips[idx]["image_path"]
 
-        for idx in range(n_images):
-            request = QgsFeatureRequest().setFilterExpression(
-                f'"ChipId" = \'{self.image_display_widget.images[idx]["chip_id"]}\''
+        for idx in range(len(images)):
+            feature_request = QgsFeatureRequest().setFilterExpression(
+                f'"ChipId" = \'{images[idx]["chip_id"]}\''
             )
-            for feature in self.log_layer.getFeatures(request):
+            for feature in self.log_layer.getFeatures(feature_request):
                 feat_attrs = feature.attributes()
                 interactions = feat_attrs[0]
                 if type(interactions) == str:
@@ -1490,31 +1751,87 @@ class LibreGeoLensDockWidget(QDockWidget):
                     })
                 else:
                     interactions[interaction_id] = {"prompt": prompt, "response": response}
-                    self.image_display_widget.images[idx]["chip_id"] = chip_ids_sequence[idx]
+                    images[idx]["chip_id"] = chip_ids_sequence[idx]
                     self.log_layer.dataProvider().changeAttributeValues({
                         feature.id(): {0: json.dumps(interactions),
-                                       1: self.image_display_widget.images[idx]["image_path"],
-                                       2: self.image_display_widget.images[idx]["chip_id"]}
+                                       1: images[idx]["image_path"],
+                                       2: images[idx]["chip_id"]}
                     })
                 break
-        if n_images > 0:
+        if images:
             self.log_layer.updateExtents()
             self.save_logs_to_geojson()
             self.handle_log_layer()
             if self.area_drawing_tool:
                 self.area_drawing_tool.rubber_band.reset(QgsWkbTypes.PolygonGeometry)
-            self.image_display_widget.clear_images()
+            # Chips drawn while the request was running stay
+            self.image_display_widget.clear_images(count=len(images))
 
-        settings_dialog = SettingsDialog(self.iface.mainWindow())
-        settings_dialog.sync_local_logs_dir_with_s3(self.logs_dir)
+        self.logs_sync_scheduler.request_sync()
 
-        # Reload chat to offload in-memory imagery in self.conversation
-        self.reload_current_chat()
+    def update_logs_sync_status(self, status):
+        self.logs_sync_status_label.setText(status)
+        self.logs_sync_status_label.show()
+
+    def get_api_client(self, api):
+        """Client for an MLLM service, or None if its API key isn't set"""
+        api_key = os.getenv(api.upper() + "_API_KEY")
+        if api_key is None:
+            return None
+        return self.supported_api_clients[api]["class"](api_key=api_key)
+
+    def get_summary_api_and_model(self, api, model):
+        """
+        Service and model to title chats with: the Chat Summary Model setting if set, as "Service:model" or just
+        "model" of the service the chat uses, otherwise the service's (cheaper) summary model, or the chat's model
+        """
+        summary_model = QSettings("Ampsight", "LibreGeoLens").value("summary_model", "")
+        if summary_model:
+            summary_api, _, api_model = summary_model.partition(":")
+            if api_model and summary_api in self.supported_api_clients:
+                return summary_api, api_model
+            return api, summary_model
+        return api, self.supported_api_clients[api].get("summary_model", model)
+
+    def summarize_chat_if_needed(self, chat_id, api, model):
+        """
+        Title a chat in the background from its first turns. Only the first turns are sent, so this only happens
+        when the chat is new or has doubled in size since, while that still changes them.
+        """
+        n_interactions = self.logs_db.count_chat_interactions(chat_id)
+        if n_interactions > ChatSummaryWorker.MAX_TURNS or n_interactions & (n_interactions - 1) != 0:
+            return
+
+        summary_api, summary_model = self.get_summary_api_and_model(api, model)
+        client = self.get_api_client(summary_api)
+        if client is None:
+            # No API key for the configured service, fall back to the chat's
+            summary_model = model
+            client = self.get_api_client(api)
+        worker = ChatSummaryWorker(
+            client, summary_model, chat_id, self.logs_db.fetch_first_turns(chat_id, ChatSummaryWorker.MAX_TURNS),
+            parent=self
+        )
+        worker.summary_ready.connect(self.on_chat_summary_ready)
+        worker.summary_failed.connect(self.on_chat_summary_failed)
+        worker.finished.connect(lambda: self.summary_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.summary_workers.add(worker)
+        worker.start()
+
+    def on_chat_summary_ready(self, chat_id, n_turns, summary):
+        # Summaries of the same chat can finish out of order, and the chat may have been deleted meanwhile
+        if n_turns <= self.chat_summary_turns.get(chat_id, 0) or self.logs_db.fetch_chat_by_id(chat_id) is None:
+            return
+        self.chat_summary_turns[chat_id] = n_turns
+        self.logs_db.update_chat_summary(chat_id, summary)
+        self.chat_list_model.set_summary(chat_id, summary)
+
+    def on_chat_summary_failed(self, chat_id, error):
+        self.iface.messageBar().pushWarning("LibreGeoLens", f"Failed to summarize chat {chat_id}: {error}")
 
     def reload_current_chat(self):
-        item = self.chat_list.currentItem()
-        self.chat_list.setCurrentItem(item)
-        self.load_chat(item)
+        self.open_chat(self.current_chat_id)
         self.chat_history.verticalScrollBar().setValue(self.chat_history.verticalScrollBar().maximum())
         
     def show_quick_help(self, first_time=False):
@@ -1573,6 +1890,7 @@ class LibreGeoLensDockWidget(QDockWidget):
             <li>You need API keys configured in QGIS environment settings (see <i>icon</i> → Settings)</li>
             <li>For large areas, raw chip extraction can be resource intensive</li>
             <li>All chips are saved as GeoJSON features (orange rectangles) for easy reference</li>
+            <li>Use the search box above the chat list to find past prompts and responses</li>
             <li>Click the "i" button by the radio buttons for info about image size limits</li>
         </ul>
         """
@@ -1629,7 +1947,7 @@ class LibreGeoLensDockWidget(QDockWidget):
         # Get chat data
         chat = self.logs_db.fetch_chat_by_id(self.current_chat_id)
         chat_summary = chat[2]
-        interactions_sequence = json.loads(chat[1])
+        interactions = self.logs_db.fetch_chat_bundle(self.current_chat_id)
 
         # Create a timestamp for unique folder name
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -1643,35 +1961,30 @@ class LibreGeoLensDockWidget(QDockWidget):
         os.makedirs(images_folder_path, exist_ok=True)
         
         # Collect all chips used in this chat
-        all_chip_ids = []
-        for interaction_id in interactions_sequence:
-            (_, _, _, chip_ids, _, _, chip_modes, _, _) = self.logs_db.fetch_interaction_by_id(interaction_id)
-            all_chip_ids.extend(json.loads(chip_ids))
+        all_chips = {chip["id"]: chip for interaction in interactions for chip in interaction["chips"]}
+        all_chip_ids = list(all_chips)
         
         # Copy all chip images to the export folder
         chip_path_mapping = {}  # Original path -> exported path mapping
-        for chip_id in all_chip_ids:
-            chip = self.logs_db.fetch_chip_by_id(chip_id)
-            if chip:
-                original_path = chip[1]
-                filename = os.path.basename(original_path)
-                exported_path = os.path.join(images_folder_path, filename)
+        for chip in all_chips.values():
+            original_path = chip["image_path"]
+            filename = os.path.basename(original_path)
+            exported_path = os.path.join(images_folder_path, filename)
+            
+            # Copy image file if it exists
+            if os.path.exists(original_path):
+                shutil.copy2(original_path, exported_path)
+                chip_path_mapping[original_path] = os.path.join("images", filename)
                 
-                # Copy image file if it exists
-                if os.path.exists(original_path):
-                    shutil.copy2(original_path, exported_path)
-                    chip_path_mapping[original_path] = os.path.join("images", filename)
-                    
-                    # Check for raw version
-                    raw_path = original_path.replace("_screen.png", "_raw.png")
-                    if os.path.exists(raw_path):
-                        raw_filename = os.path.basename(raw_path)
-                        exported_raw_path = os.path.join(images_folder_path, raw_filename)
-                        shutil.copy2(raw_path, exported_raw_path)
-                        chip_path_mapping[raw_path] = os.path.join("images", raw_filename)
+                # Check for raw versions
+                for raw_path in ru.raw_chip_paths(original_path):
+                    raw_filename = os.path.basename(raw_path)
+                    exported_raw_path = os.path.join(images_folder_path, raw_filename)
+                    shutil.copy2(raw_path, exported_raw_path)
+                    chip_path_mapping[raw_path] = os.path.join("images", raw_filename)
         
         # Generate HTML for the chat
-        html_content = self._generate_chat_html(interactions_sequence, chip_path_mapping)
+        html_content = self._generate_chat_html(interactions, chip_path_mapping)
         
         # Write HTML file
         html_path = os.path.join(export_folder_path, "chat.html")
@@ -1683,7 +1996,7 @@ class LibreGeoLensDockWidget(QDockWidget):
 
         self.open_directory(export_folder_path)
         
-    def _generate_chat_html(self, interactions_sequence, chip_path_mapping):
+    def _generate_chat_html(self, interactions, chip_path_mapping):
         """Generate a self-contained HTML representation of the chat"""
         # HTML header with styling
         html = """<!DOCTYPE html>
@@ -1780,44 +2093,27 @@ class LibreGeoLensDockWidget(QDockWidget):
 """
         
         # Add each interaction to the HTML
-        for interaction_id in interactions_sequence:
-            (_, prompt, response, chip_ids, mllm_service, mllm_model, chip_modes,
-             original_resolutions, actual_resolutions) = self.logs_db.fetch_interaction_by_id(interaction_id)
+        for interaction in interactions:
+            prompt, response = interaction["text_input"], interaction["text_output"]
+            mllm_service, mllm_model = interaction["mllm_service"], interaction["mllm_model"]
             
             # User message
             html += f'<div class="user-message">\n<strong>User:</strong> {prompt}\n</div>\n'
             
-            # Process chips
-            chip_ids_list = json.loads(chip_ids)
-            chip_modes_list = ast.literal_eval(chip_modes)
-            
-            try:
-                original_resolutions_list = ast.literal_eval(original_resolutions) if original_resolutions else []
-                actual_resolutions_list = ast.literal_eval(actual_resolutions) if actual_resolutions else []
-            except (TypeError, json.JSONDecodeError):
-                original_resolutions_list = []
-                actual_resolutions_list = []
-            
-            # Ensure lists exist and have correct length (for backward compatibility)
-            if not original_resolutions_list:
-                original_resolutions_list = ["Unknown"] * len(chip_ids_list)
-            if not actual_resolutions_list:
-                actual_resolutions_list = ["Unknown"] * len(chip_ids_list)
-            
             # Add chip images to HTML
-            if chip_ids_list:
+            if interaction["chips"]:
                 html += '<div class="chip-container">\n'
                 
-                for i, (chip_id, chip_mode) in enumerate(zip(chip_ids_list, chip_modes_list)):
-                    image_path = self.logs_db.fetch_chip_by_id(chip_id)[1]
+                for chip in interaction["chips"]:
+                    image_path, chip_mode = chip["image_path"], chip["mode"]
                     
                     # Get mapped path (images are copied to images folder)
                     if image_path in chip_path_mapping:
                         relative_path = chip_path_mapping[image_path]
                         
-                        # Get resolution information
-                        original_res = original_resolutions_list[i] if i < len(original_resolutions_list) else "Unknown"
-                        actual_res = actual_resolutions_list[i] if i < len(actual_resolutions_list) else "Unknown"
+                        # Get resolution information (NULL for older database entries)
+                        original_res = chip["original_res"] or "Unknown"
+                        actual_res = chip["actual_res"] or "Unknown"
                         
                         # Create resolution display text
                         resolution_text = ""
@@ -5,6 +5,7 @@ from qgis.PyQt.QtWidgets import QAction, QFileDialog, QMessageBox
 from .resources import *
 from .dock import LibreGeoLensDockWidget
 from .settings import SettingsDialog
+from .utils import raw_image_utils as ru
 
 
 class LibreGeoLens:
@@ -49,3 +50,7 @@ class LibreGeoLens:
             self.iface.removeToolBarIcon(action)
         if self.dock_widget:
             self.iface.removeDockWidget(self.dock_widget)
+            self.dock_widget.stop_background_workers()
+            self.dock_widget.logs_sync_scheduler.stop()
+            self.dock_widget.logs_db.close()
+        ru.close_cached_datasets()
@@ -0,0 +1,343 @@
+import os
+import gzip
+import time
+import shutil
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_PART_SIZE_MB = 8
+MAX_PARTS = 10000  # S3 limit, boto3 doubles the part size until files fit in it
+# SQLite databases of the logs directory, uploaded as snapshots rather than as they are on disk
+DATABASE_FILES = ("logs.db",)
+SQLITE_SIDECAR_SUFFIXES = ("-wal", "-shm", "-journal")
+# File modification times come from a coarser clock than time.time_ns(), see S3LogsSync.snapshot
+SNAPSHOT_MTIME_MARGIN_NS = 2 * 10 ** 9
+
+
+def _md5(file_path, offset=0, length=None):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            md5.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return md5
+
+
+def calculate_etag(file_path, part_size=None):
+    """
+    Calculate the ETag S3 gives a local file once uploaded. Files of at least `part_size` bytes are uploaded in
+    parts, and their ETag is the MD5 of the parts' MD5s followed by the number of parts, e.g. "<md5>-3".
+    """
+    size = os.path.getsize(file_path)
+    if part_size is None or size < part_size:
+        return _md5(file_path).hexdigest()
+
+    while size / part_size > MAX_PARTS:
+        part_size *= 2
+    part_digests = [_md5(file_path, offset, part_size).digest() for offset in range(0, size, part_size)]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def get_local_files(local_directory):
+    """Map the relative path (with / separators) of every file in the local directory to its full path and stat."""
+    local_files = {}
+    for root, _, files in os.walk(local_directory):
+        for file in files:
+            full_path = os.path.join(root, file)
+            relative_path = os.path.relpath(full_path, local_directory).replace('\\', '/')
+            local_files[relative_path] = (full_path, os.stat(full_path))
+    return local_files
+
+
+class SyncInterrupted(Exception):
+    """Raised from within a sync, including from within its transfers, to abort it once it's interrupted"""
+
+
+def is_sqlite_sidecar(relative_path):
+    """Whether the file is the WAL, shared memory or rollback journal of one of the databases"""
+    return any(relative_path == database + suffix for database in DATABASE_FILES for suffix in SQLITE_SIDECAR_SUFFIXES)
+
+
+def snapshot_database(db_path, snapshot_path, compress=False):
+    """
+    Write a consistent copy of an SQLite database that may be in use to `snapshot_path`, gzipped if `compress`.
+    The online backup API includes the commits still in the WAL, then the copy is VACUUMed to drop its free pages
+    and switched out of WAL mode, so that it's a single self-contained file.
+    """
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    temp_db_path = f"{snapshot_path}.db.tmp"
+    if os.path.exists(temp_db_path):
+        os.remove(temp_db_path)
+    source = sqlite3.connect(db_path)
+    try:
+        target = sqlite3.connect(temp_db_path)
+        try:
+            source.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+            target.execute("VACUUM")
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    if not compress:
+        os.replace(temp_db_path, snapshot_path)
+        return
+    temp_gz_path = f"{snapshot_path}.gz.tmp"
+    # mtime=0 so that snapshots of an unchanged database have the same ETag
+    with open(temp_db_path, 'rb') as f_in, gzip.GzipFile(temp_gz_path, 'wb', mtime=0) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(temp_db_path)
+    os.replace(temp_gz_path, snapshot_path)
+
+
+class SyncJournal:
+    """
+    Remembers the size, modification time and ETag each file had when it was last uploaded, so that
+    only the files written since then need to be examined. Kept in a small SQLite database.
+    """
+    def __init__(self, journal_path):
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        self.conn = sqlite3.connect(journal_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS SyncedFiles (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                etag TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def entries(self):
+        """Map each synced path to its (size, mtime_ns, etag)"""
+        return {
+            path: (size, mtime_ns, etag)
+            for path, size, mtime_ns, etag in self.conn.execute("SELECT path, size, mtime_ns, etag FROM SyncedFiles")
+        }
+
+    def record(self, path, stat, etag):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO SyncedFiles (path, size, mtime_ns, etag) VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, etag)
+        )
+
+    def forget(self, path):
+        self.conn.execute("DELETE FROM SyncedFiles WHERE path = ?", (path,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def default_journal_path(local_directory, s3_directory):
+    """
+    Journals live outside of the logs directory, so that they aren't synced themselves,
+    and there is one per local directory and S3 directory pair.
+    """
+    # Imported here so that the rest of the sync can be used (and tested) without QGIS
+    from qgis.PyQt.QtCore import QStandardPaths
+
+    key = f"{os.path.abspath(local_directory)}|{s3_directory}"
+    journals_dir = os.path.join(
+        QStandardPaths.writableLocation(QStandardPaths.AppDataLocation), "LibreGeoLens", "sync_journals"
+    )
+    return os.path.join(journals_dir, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.db")
+
+
+class S3LogsSync:
+    """
+    Mirrors the local logs directory to an S3 directory (s3://bucket/prefix/).
+    Files whose size and modification time match the journal are skipped without being read, and
+    S3 is only listed the first time, to avoid uploading what's already there.
+    At most `max_concurrency` uploads run at once: files smaller than `part_size_mb` are hashed and uploaded
+    `max_concurrency` at a time, then larger ones are uploaded one at a time, in parts of that size,
+    `max_concurrency` parts at a time.
+    The databases are uploaded as snapshots (gzipped, with a .gz extension, if `compress_snapshots`),
+    and their -wal/-shm/-journal files are neither uploaded nor deleted.
+    """
+    def __init__(self, local_directory, s3_directory, s3=None, journal_path=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, part_size_mb=DEFAULT_PART_SIZE_MB, compress_snapshots=False):
+        self.local_directory = local_directory
+        self.bucket_name, self.s3_prefix = s3_directory.split("/")[2], '/'.join(s3_directory.split("/")[3:])
+        self.s3 = s3 if s3 is not None else boto3.client('s3')
+        self.journal_path = journal_path or default_journal_path(local_directory, s3_directory)
+        self.max_concurrency = max(1, max_concurrency)
+        self.part_size = max(5, part_size_mb) * 1024 * 1024  # S3 parts can't be smaller than 5 MB
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.part_size, multipart_chunksize=self.part_size,
+            max_concurrency=self.max_concurrency
+        )
+        self.compress_snapshots = compress_snapshots
+        self.is_interrupted = lambda: False  # See sync
+        # Next to the journal, outside of the logs directory
+        self.snapshot_dir = f"{os.path.splitext(self.journal_path)[0]}_snapshots"
+
+    def s3_key(self, relative_path):
+        return os.path.join(self.s3_prefix, relative_path).replace('\\', '/')
+
+    def snapshot(self, relative_path, db_path):
+        """Path of an up to date snapshot of a database, only taken again if the database was written since"""
+        snapshot_path = os.path.join(self.snapshot_dir, relative_path + (".gz" if self.compress_snapshots else ""))
+        source_mtime_ns = max(os.stat(path).st_mtime_ns for path in (db_path, f"{db_path}-wal") if os.path.exists(path))
+        if not os.path.exists(snapshot_path) or os.stat(snapshot_path).st_mtime_ns < source_mtime_ns:
+            # Dated from (a bit) before it was taken, so that writes made while taking it trigger another one.
+            # Writes made just before might trigger an identical one, which isn't uploaded again.
+            started_ns = time.time_ns() - SNAPSHOT_MTIME_MARGIN_NS
+            snapshot_database(db_path, snapshot_path, self.compress_snapshots)
+            os.utime(snapshot_path, ns=(started_ns, started_ns))
+        return snapshot_path
+
+    def get_local_files(self):
+        """The local files to sync, with the databases replaced by their snapshots and without their sidecar files"""
+        local_files = {
+            relative_path: file for relative_path, file in get_local_files(self.local_directory).items()
+            if not is_sqlite_sidecar(relative_path)
+        }
+        for database in DATABASE_FILES:
+            if database not in local_files:
+                continue
+            db_path, _ = local_files.pop(database)
+            snapshot_path = self.snapshot(database, db_path)
+            local_files[database + (".gz" if self.compress_snapshots else "")] = (snapshot_path, os.stat(snapshot_path))
+        return local_files
+
+    def get_s3_files(self):
+        """Retrieve all file keys from the S3 bucket, mapped to their ETags."""
+        s3_files = {}
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.s3_prefix):
+            self.check_interrupted()
+            if 'Contents' in page:
+                for obj in page['Contents']:
+                    s3_files[obj['Key']] = obj['ETag'].strip('"')
+        return s3_files
+
+    def bootstrap_journal(self, journal, local_files):
+        """
+        With an empty journal, record the local files that are already up to date in S3 and delete the S3 files
+        that no longer exist locally, like a full sync would.
+        """
+        s3_files = self.get_s3_files()
+        local_keys = {self.s3_key(relative_path): relative_path for relative_path in local_files}
+        for s3_key, s3_etag in s3_files.items():
+            self.check_interrupted()
+            relative_path = local_keys.get(s3_key)
+            if relative_path is None:
+                if is_sqlite_sidecar(s3_key[len(self.s3_prefix):].lstrip('/')):
+                    continue
+                print(f"Deleting file from S3: {s3_key}")
+                self.s3.delete_object(Bucket=self.bucket_name, Key=s3_key)
+                continue
+            full_path, stat = local_files[relative_path]
+            if calculate_etag(full_path, self.part_size) == s3_etag:
+                journal.record(relative_path, stat, s3_etag)
+        journal.commit()
+
+    def check_interrupted(self, *_):
+        """Raise SyncInterrupted if the sync was interrupted. Also the progress callback of the transfers."""
+        if self.is_interrupted():
+            raise SyncInterrupted()
+
+    def upload_if_changed(self, full_path, relative_path, synced_etag):
+        """Upload a file unless its content still has the ETag it was synced with. Returns its ETag."""
+        self.check_interrupted()
+        etag = calculate_etag(full_path, self.part_size)
+        if etag != synced_etag:
+            print(f"Uploading file: {relative_path}")
+            # Raising from the progress callback aborts the transfer, including its multipart upload
+            self.s3.upload_file(full_path, self.bucket_name, self.s3_key(relative_path), Config=self.transfer_config,
+                                Callback=self.check_interrupted)
+        return etag
+
+    def record_uploads(self, journal, uploads):
+        """
+        Record the uploads in the journal as they complete. Once one fails, or the sync is interrupted, the uploads
+        that haven't started are cancelled, while those in flight are still recorded if they succeed.
+        Returns the first error, if any.
+        """
+        error = None
+        for upload in as_completed(uploads):
+            if upload.cancelled():
+                continue
+            try:
+                etag = upload.result()
+            except Exception as e:
+                error = error or e
+            else:
+                relative_path, stat = uploads[upload]
+                journal.record(relative_path, stat, etag)
+                journal.commit()
+            if error is not None or self.is_interrupted():
+                for pending_upload in uploads:
+                    pending_upload.cancel()
+        return error
+
+    def sync(self, is_interrupted=None):
+        """
+        Upload new and changed files and delete the S3 copies of removed ones.
+        Once `is_interrupted()` returns True, the transfers in flight are aborted and the sync stops, without deleting
+        anything. The files uploaded until then stay recorded in the journal.
+        """
+        if is_interrupted is not None:
+            self.is_interrupted = is_interrupted
+        journal = SyncJournal(self.journal_path)
+        try:
+            local_files = self.get_local_files()
+            synced = journal.entries()
+            if not synced:
+                self.bootstrap_journal(journal, local_files)
+                synced = journal.entries()
+
+            small_files, large_files = [], []
+            for relative_path, (full_path, stat) in local_files.items():
+                entry = synced.get(relative_path)
+                if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue  # Unchanged since it was uploaded
+                synced_etag = entry[2] if entry is not None else None
+                files = small_files if stat.st_size < self.part_size else large_files
+                files.append((relative_path, full_path, stat, synced_etag))
+
+            # The journal is only written from this thread, as uploads complete
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                uploads = {
+                    executor.submit(self.upload_if_changed, full_path, relative_path, synced_etag): (relative_path, stat)
+                    for relative_path, full_path, stat, synced_etag in small_files
+                }
+                error = self.record_uploads(journal, uploads)
+            if error is not None:
+                raise error
+            for relative_path, full_path, stat, synced_etag in large_files:
+                journal.record(relative_path, stat, self.upload_if_changed(full_path, relative_path, synced_etag))
+                journal.commit()
+            self.check_interrupted()
+
+            for relative_path in synced.keys() - local_files.keys():
+                if is_sqlite_sidecar(relative_path):
+                    # Synced before databases were snapshotted, and may still be needed next to their database
+                    journal.forget(relative_path)
+                    journal.commit()
+                    continue
+                print(f"Deleting file from S3: {relative_path}")
+                self.s3.delete_object(Bucket=self.bucket_name, Key=self.s3_key(relative_path))
+                journal.forget(relative_path)
+                journal.commit()
+        except SyncInterrupted:
+            pass
+        finally:
+            journal.close()
@@ -1,7 +1,9 @@
-import boto3
-import os
 from PyQt5.QtCore import QSettings
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QMessageBox
+from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QMessageBox,
+                             QSpinBox, QCheckBox)
+
+from .s3_sync import DEFAULT_MAX_CONCURRENCY, DEFAULT_PART_SIZE_MB
+from .utils import raw_image_utils as ru
 
 
 class SettingsDialog(QDialog):
@@ -28,6 +30,25 @@ class SettingsDialog(QDialog):
         self.layout.addWidget(self.s3_logs_directory_label)
         self.layout.addWidget(self.s3_logs_directory_input)
 
+        # S3 Upload Settings
+        self.s3_upload_concurrency_label = QLabel("S3 Upload Concurrency:")
+        self.s3_upload_concurrency_label.setToolTip("How many files, and parts of large files, are uploaded at once")
+        self.s3_upload_concurrency_input = QSpinBox()
+        self.s3_upload_concurrency_input.setRange(1, 64)
+        self.layout.addWidget(self.s3_upload_concurrency_label)
+        self.layout.addWidget(self.s3_upload_concurrency_input)
+
+        self.s3_upload_part_size_label = QLabel("S3 Upload Part Size (MB):")
+        self.s3_upload_part_size_label.setToolTip("Files at least this large are uploaded in parts of this size")
+        self.s3_upload_part_size_input = QSpinBox()
+        self.s3_upload_part_size_input.setRange(5, 5 * 1024)
+        self.layout.addWidget(self.s3_upload_part_size_label)
+        self.layout.addWidget(self.s3_upload_part_size_input)
+
+        self.s3_compress_logs_db_input = QCheckBox("Compress Logs Database Backups")
+        self.s3_compress_logs_db_input.setToolTip("Upload logs.db gzipped, as logs.db.gz")
+        self.layout.addWidget(self.s3_compress_logs_db_input)
+
         # Local Logs Directory Setting
         self.local_logs_directory_label = QLabel("Local Logs Directory:")
         self.local_logs_directory_label.setToolTip("Local directory where logs and image chips will be saved")
@@ -42,6 +63,46 @@ class SettingsDialog(QDialog):
         self.browse_button.setToolTip("Select a folder on your computer for storing logs and chips")
         self.layout.addWidget(self.browse_button)
 
+        # Raw Chip Bands Setting
+        self.raw_chip_bands_label = QLabel("Raw Chip Bands:")
+        self.raw_chip_bands_label.setToolTip("Bands of the raw imagery that raw chips are made of, in RGB order")
+        self.raw_chip_bands_input = QLineEdit()
+        self.raw_chip_bands_input.setToolTip(
+            "Example: 5,3,2 for true color from 8-band imagery, or a single band for grayscale. "
+            "Leave empty to use the first bands of the imagery"
+        )
+        self.layout.addWidget(self.raw_chip_bands_label)
+        self.layout.addWidget(self.raw_chip_bands_input)
+
+        # Raw Imagery Handles Settings
+        self.dataset_cache_size_label = QLabel("Open Raw Imagery Files:")
+        self.dataset_cache_size_label.setToolTip(
+            "How many raw imagery files are kept open between raw chip extractions, so that the headers of remote "
+            "COGs aren't fetched again. 0 closes them after each extraction"
+        )
+        self.dataset_cache_size_input = QSpinBox()
+        self.dataset_cache_size_input.setRange(0, 256)
+        self.layout.addWidget(self.dataset_cache_size_label)
+        self.layout.addWidget(self.dataset_cache_size_input)
+
+        self.dataset_cache_idle_timeout_label = QLabel("Close Unused Raw Imagery Files After (s):")
+        self.dataset_cache_idle_timeout_label.setToolTip("How long a raw imagery file is kept open without being used")
+        self.dataset_cache_idle_timeout_input = QSpinBox()
+        self.dataset_cache_idle_timeout_input.setRange(1, 24 * 60 * 60)
+        self.layout.addWidget(self.dataset_cache_idle_timeout_label)
+        self.layout.addWidget(self.dataset_cache_idle_timeout_input)
+
+        # Chat Summary Model Setting
+        self.summary_model_label = QLabel("Chat Summary Model:")
+        self.summary_model_label.setToolTip("Optional: model used to title chats, e.g. a cheaper or local one")
+        self.summary_model_input = QLineEdit()
+        self.summary_model_input.setToolTip(
+            "Example: SelfHosted:llama3, or just a model name to use the chat's service. "
+            "Leave empty to use each service's default summary model"
+        )
+        self.layout.addWidget(self.summary_model_label)
+        self.layout.addWidget(self.summary_model_input)
+
         # Save button
         self.save_button = QPushButton("Save")
         self.save_button.clicked.connect(self.save_settings)
@@ -50,21 +111,43 @@ class SettingsDialog(QDialog):
 
         self.load_settings()
 
-        self.s3 = boto3.client('s3')
-
     def load_settings(self):
         """Load settings from QSettings."""
         settings = QSettings("Ampsight", "LibreGeoLens")
         self.s3_directory_input.setText(settings.value("default_s3_directory"))
         self.s3_logs_directory_input.setText(settings.value("s3_logs_directory", ""))
         self.local_logs_directory_input.setText(settings.value("local_logs_directory", ""))
+        self.s3_upload_concurrency_input.setValue(
+            settings.value("s3_upload_concurrency", DEFAULT_MAX_CONCURRENCY, type=int)
+        )
+        self.s3_upload_part_size_input.setValue(settings.value("s3_upload_part_size_mb", DEFAULT_PART_SIZE_MB, type=int))
+        self.s3_compress_logs_db_input.setChecked(settings.value("s3_compress_logs_db", False, type=bool))
+        self.raw_chip_bands_input.setText(settings.value("raw_chip_bands", ""))
+        self.dataset_cache_size_input.setValue(settings.value("dataset_cache_size", ru.DATASET_CACHE_SIZE, type=int))
+        self.dataset_cache_idle_timeout_input.setValue(
+            settings.value("dataset_cache_idle_timeout", ru.DATASET_CACHE_IDLE_TIMEOUT, type=int)
+        )
+        self.summary_model_input.setText(settings.value("summary_model", ""))
 
     def save_settings(self):
         """Save settings to QSettings."""
+        try:
+            ru.parse_band_indexes(self.raw_chip_bands_input.text())
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Raw Chip Bands", str(e))
+            return
         settings = QSettings("Ampsight", "LibreGeoLens")
         settings.setValue("default_s3_directory", self.s3_directory_input.text())
         settings.setValue("s3_logs_directory", self.s3_logs_directory_input.text())
         settings.setValue("local_logs_directory", self.local_logs_directory_input.text())
+        settings.setValue("s3_upload_concurrency", self.s3_upload_concurrency_input.value())
+        settings.setValue("s3_upload_part_size_mb", self.s3_upload_part_size_input.value())
+        settings.setValue("s3_compress_logs_db", self.s3_compress_logs_db_input.isChecked())
+        settings.setValue("raw_chip_bands", self.raw_chip_bands_input.text())
+        settings.setValue("dataset_cache_size", self.dataset_cache_size_input.value())
+        settings.setValue("dataset_cache_idle_timeout", self.dataset_cache_idle_timeout_input.value())
+        ru.configure_dataset_cache(self.dataset_cache_size_input.value(), self.dataset_cache_idle_timeout_input.value())
+        settings.setValue("summary_model", self.summary_model_input.text().strip())
         QMessageBox.information(self, "Settings Saved", "Settings have been saved successfully!")
         self.accept()
 
@@ -73,71 +156,3 @@ class SettingsDialog(QDialog):
         directory = QFileDialog.getExistingDirectory(self, "Select Logs Directory")
         if directory:
             self.local_logs_directory_input.setText(directory)
-
-    @staticmethod
-    def get_local_files(local_directory):
-        """Retrieve all file paths from the local directory."""
-        local_files = {}
-        for root, _, files in os.walk(local_directory):
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.relpath(full_path, local_directory)
-                local_files[relative_path] = full_path
-        return local_files
-
-    def get_s3_files(self, bucket_name, s3_prefix):
-        """Retrieve all file keys from the S3 bucket."""
-        s3_files = {}
-        paginator = self.s3.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    key = obj['Key']
-                    s3_files[key] = obj['ETag'].strip('"')
-        return s3_files
-
-    def upload_new_or_updated_files(self, local_files, s3_files, bucket_name, s3_prefix):
-        """Upload new or updated files to the S3 bucket."""
-        for relative_path, full_path in local_files.items():
-            s3_key = os.path.join(s3_prefix, relative_path).replace('\\', '/')
-            # Compare files by ETag (only works for non-multipart files)
-            if s3_key not in s3_files:
-                print(f"Uploading new file: {relative_path}")
-                self.s3.upload_file(full_path, bucket_name, s3_key)
-            else:
-                local_etag = self.calculate_etag(full_path)
-                if s3_files[s3_key] != local_etag:
-                    print(f"Updating file: {relative_path}")
-                    self.s3.upload_file(full_path, bucket_name, s3_key)
-
-    def delete_removed_files(self, local_files, s3_files, bucket_name, s3_prefix):
-        """Delete files from the S3 bucket that no longer exist locally."""
-        for s3_key in s3_files.keys():
-            relative_path = os.path.relpath(s3_key, s3_prefix)
-            if relative_path not in local_files:
-                print(f"Deleting file from S3: {relative_path}")
-                self.s3.delete_object(Bucket=bucket_name, Key=s3_key)
-
-    @staticmethod
-    def calculate_etag(file_path):
-        """Calculate the ETag for a local file."""
-        import hashlib
-        md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                md5.update(chunk)
-        return md5.hexdigest()
-
-    def sync_local_logs_dir_with_s3(self, local_directory):
-        """Sync the local directory with the S3 bucket directory."""
-        s3_logs_dir = self.s3_logs_directory_input.text()
-        if not s3_logs_dir:
-            return
-        try:
-            local_files = self.get_local_files(local_directory)
-            bucket_name, directory_name = s3_logs_dir.split("/")[2], '/'.join(s3_logs_dir.split("/")[3:])
-            s3_files = self.get_s3_files(bucket_name, directory_name)
-            self.upload_new_or_updated_files(local_files, s3_files, bucket_name, directory_name)
-            self.delete_removed_files(local_files, s3_files, bucket_name, directory_name)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to sync logs with S3: {str(e)}")
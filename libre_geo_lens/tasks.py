@@ -0,0 +1,279 @@
+import os
+import datetime
+
+from qgis.PyQt.QtCore import QCoreApplication, QThread, QObject, QTimer, QSettings, pyqtSignal
+from qgis.core import QgsTask, QgsRasterLayer
+
+from .s3_sync import S3LogsSync, DEFAULT_MAX_CONCURRENCY, DEFAULT_PART_SIZE_MB
+
+
+class LoadCogTask(QgsTask):
+    """
+    Opens a remote COG as a raster layer in the background, since GDAL can take a while to fetch its header.
+    On success, the layer is left in `self.layer` to be added to the project from the main thread.
+    `generation` tags the task with the GeoJSON it was loaded for, so that late results can be told apart.
+    """
+    def __init__(self, remote_path, cog_url, generation=0):
+        super().__init__(f"Loading {remote_path.split('/')[-1]}", QgsTask.CanCancel)
+        self.remote_path = remote_path
+        self.cog_url = cog_url
+        self.generation = generation
+        self.layer = None
+
+    def run(self):
+        layer = QgsRasterLayer(self.cog_url, self.remote_path.split('/')[-1], "gdal")
+        if not layer.isValid() or self.isCanceled():
+            return False
+        # The project only takes layers that live in the main thread
+        layer.moveToThread(QCoreApplication.instance().thread())
+        self.layer = layer
+        return True
+
+
+class MllmRequestWorker(QThread):
+    """
+    Sends a conversation to an MLLM service off the GUI thread: encodes its images and streams the response,
+    emitting each token as it arrives.
+    Stop it with stop(), after which it doesn't emit anything else.
+    """
+    token_received = pyqtSignal(str)
+    response_completed = pyqtSignal(str, dict)  # response, dimensions of the images sent by path
+    request_failed = pyqtSignal(str)
+
+    def __init__(self, client, model, conversation, encode_image, parent=None):
+        """
+        `conversation` is in the dock's format, with images as local_image_path contents,
+        and `encode_image(path)` returns an image's base64 and dimensions.
+        """
+        super().__init__(parent)
+        self.client = client
+        self.model = model
+        self.conversation = conversation
+        self.encode_image = encode_image
+        self.response_stream = None
+
+    def stop(self):
+        """
+        Request interruption, and close the response stream, or the client while there's none yet,
+        so that a worker blocked waiting on the service returns promptly
+        """
+        self.requestInterruption()
+        try:
+            (self.response_stream or self.client).close()
+        except Exception:
+            pass  # The request fails, or has already finished
+
+    def encode_conversation(self):
+        """Convert the local image paths of the conversation to base64 and collect the dimensions of the images"""
+        messages, dimensions = [], {}
+        for message in self.conversation:
+            if message["role"] == "assistant":
+                messages.append({"role": message["role"], "content": message["content"]})
+                continue
+
+            content = []
+            for part in message["content"]:
+                if part.get("type") == "local_image_path":
+                    image_path = part["path"]
+                    if os.path.exists(image_path):
+                        image_base64, dimensions[image_path] = self.encode_image(image_path)
+                        mime_type = dimensions[image_path].get("mime_type", "image/png")
+                        content.append({
+                            "type": "image_url",
+                            "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}
+                        })
+                else:
+                    content.append(part)
+            messages.append({"role": message["role"], "content": content})
+        return messages, dimensions
+
+    def run(self):
+        try:
+            messages, dimensions = self.encode_conversation()
+            if self.isInterruptionRequested():
+                return
+
+            self.response_stream = self.client.chat.completions.create(
+                model=self.model, messages=messages, stream=True
+            )
+            response_chunks = []
+            for chunk in self.response_stream:
+                if self.isInterruptionRequested():
+                    self.response_stream.close()
+                    return
+                content = chunk.choices[0].delta.content
+                if content is None:
+                    continue
+                response_chunks.append(content)
+                self.token_received.emit(content)
+            if self.isInterruptionRequested():
+                return
+            self.response_completed.emit("".join(response_chunks), dimensions)
+        except Exception as e:
+            if not self.isInterruptionRequested():
+                self.request_failed.emit(str(e))
+
+
+class ChatSummaryWorker(QThread):
+    """
+    Asks an MLLM service for a short title for a chat, from the text of its first turns, off the GUI thread.
+    Stop it with stop(), after which it doesn't emit anything else.
+    """
+    summary_ready = pyqtSignal(int, int, str)  # chat_id, number of turns it was made from, summary
+    summary_failed = pyqtSignal(int, str)  # chat_id, error
+
+    # Only the first turns of a chat, and only this much of each prompt and response, are sent to title it
+    MAX_TURNS = 4
+    MAX_TURN_CHARS = 1000
+
+    def __init__(self, client, model, chat_id, turns, parent=None):
+        """`turns` are (prompt, response) pairs"""
+        super().__init__(parent)
+        self.client = client
+        self.model = model
+        self.chat_id = chat_id
+        self.turns = turns
+
+    def stop(self):
+        """Request interruption, and close the client so that a worker blocked waiting on the service returns promptly"""
+        self.requestInterruption()
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+    def run(self):
+        chat_text = "\n".join(
+            f"User: {prompt[:self.MAX_TURN_CHARS]}\nAssistant: {response[:self.MAX_TURN_CHARS]}"
+            for prompt, response in self.turns
+        )
+        try:
+            summary = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "user", "content": [{"type": "text", "text":
+                        f"Summarize the following in 10 words or less: {chat_text}."
+                        f" Only respond with your summary."}]}]
+            ).choices[0].message.content.strip()
+        except Exception as e:
+            # The chat just keeps its current summary
+            if not self.isInterruptionRequested():
+                self.summary_failed.emit(self.chat_id, str(e))
+            return
+        if not self.isInterruptionRequested():
+            self.summary_ready.emit(self.chat_id, len(self.turns), summary)
+
+
+# Workers still running after their owner stopped waiting for them, see LogsSyncScheduler.stop
+_detached_workers = set()
+
+
+class LogsSyncWorker(QThread):
+    """
+    Backs up the logs directory to S3 off the GUI thread. If the sync fails, its error is left in `self.error`.
+    Stop it with requestInterruption(), which aborts the transfers in flight.
+    """
+    def __init__(self, local_directory, s3_directory, max_concurrency, part_size_mb, compress_snapshots,
+                 parent=None):
+        super().__init__(parent)
+        self.local_directory = local_directory
+        self.s3_directory = s3_directory
+        self.max_concurrency = max_concurrency
+        self.part_size_mb = part_size_mb
+        self.compress_snapshots = compress_snapshots
+        self.error = None
+
+    def run(self):
+        try:
+            S3LogsSync(
+                self.local_directory, self.s3_directory,
+                max_concurrency=self.max_concurrency, part_size_mb=self.part_size_mb,
+                compress_snapshots=self.compress_snapshots
+            ).sync(is_interrupted=self.isInterruptionRequested)
+        except Exception as e:
+            self.error = str(e)
+
+
+class LogsSyncScheduler(QObject):
+    """
+    Schedules the S3 backups of the logs directory, so that nobody waits on them.
+    Requests are debounced: a burst of them results in a single sync, DEBOUNCE_MS after the last one, and requests
+    made while a sync runs are batched into one more sync after it. Failed syncs are retried with exponential backoff.
+    """
+    status_changed = pyqtSignal(str)
+
+    DEBOUNCE_MS = 2000
+    RETRY_MIN_MS = 5000
+    RETRY_MAX_MS = 5 * 60 * 1000
+    STOP_TIMEOUT_MS = 10000
+
+    def __init__(self, local_directory, parent=None):
+        super().__init__(parent)
+        self.local_directory = local_directory
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.start_sync)
+        self.worker = None
+        self.sync_requested = False  # While the worker runs
+        self.failures = 0
+
+    def request_sync(self):
+        if self.worker is not None:
+            self.sync_requested = True
+        elif not (self.failures > 0 and self.timer.isActive()):
+            # A retry after a failure keeps its backoff, it syncs the new changes too
+            self.timer.start(self.DEBOUNCE_MS)
+
+    def start_sync(self):
+        settings = QSettings("Ampsight", "LibreGeoLens")
+        s3_logs_dir = settings.value("s3_logs_directory", "")
+        if not s3_logs_dir:
+            return
+        self.sync_requested = False
+        self.worker = LogsSyncWorker(
+            self.local_directory, s3_logs_dir,
+            settings.value("s3_upload_concurrency", DEFAULT_MAX_CONCURRENCY, type=int),
+            settings.value("s3_upload_part_size_mb", DEFAULT_PART_SIZE_MB, type=int),
+            settings.value("s3_compress_logs_db", False, type=bool),
+            parent=self
+        )
+        self.worker.finished.connect(self.on_sync_finished)
+        self.status_changed.emit("Backing up logs to S3...")
+        self.worker.start()
+
+    def on_sync_finished(self):
+        worker, self.worker = self.worker, None
+        worker.deleteLater()
+        if worker.isInterruptionRequested():
+            return
+
+        if worker.error is not None:
+            self.failures += 1
+            retry_ms = min(self.RETRY_MIN_MS * 2 ** (self.failures - 1), self.RETRY_MAX_MS)
+            print(f"Failed to sync logs with S3: {worker.error}")
+            self.status_changed.emit(f"S3 backup failed, retrying in {retry_ms // 1000}s: {worker.error}")
+            self.timer.start(retry_ms)
+            return
+
+        self.failures = 0
+        if self.sync_requested:
+            self.request_sync()
+        else:
+            self.status_changed.emit(f"Logs backed up to S3 at {datetime.datetime.now():%H:%M:%S}")
+
+    def stop(self):
+        """
+        Cancel the scheduled syncs and interrupt the one running, if any, waiting up to STOP_TIMEOUT_MS for it to stop.
+        A worker that takes longer (e.g. blocked on the network) is detached and kept alive until it finishes,
+        since destroying a running QThread would abort QGIS.
+        """
+        self.timer.stop()
+        if self.worker is None:
+            return
+        worker, self.worker = self.worker, None
+        worker.finished.disconnect(self.on_sync_finished)
+        worker.requestInterruption()
+        if not worker.wait(self.STOP_TIMEOUT_MS):
+            worker.setParent(None)
+            _detached_workers.add(worker)
+            worker.finished.connect(lambda: _detached_workers.discard(worker))
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class EncodedImageCache:
+    """
+    Cache of the base64 payloads (and dimensions) that images are sent to the MLLM services as, so that replaying
+    the history of a chat doesn't re-encode its images every turn.
+    Entries are keyed by the image's path, modification time and size and by the service limits,
+    and are kept both in memory, least recently used first out, and on disk.
+    The disk is pruned on startup and then every time about a tenth of max_disk_bytes has been written.
+    """
+    PRUNE_FRACTION = 0.1
+
+    def __init__(self, cache_dir, max_memory_bytes=256 * 1024 * 1024, max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()  # key -> (image_base64, dimensions)
+        self.memory_bytes = 0
+        self.written_bytes = 0  # Written to disk since the last prune
+        self.lock = threading.Lock()  # Images are encoded by the MLLM request workers
+        self.prune_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.prune(remove_temp_files=True)
+
+    @staticmethod
+    def make_key(image_path, limits):
+        stat = os.stat(image_path)
+        key = json.dumps([os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, limits], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Return the cached (image_base64, dimensions) for the key, or None"""
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(entry_path)  # So that prune keeps the entries in use
+        except (OSError, ValueError):
+            return None
+        entry = (data["base64"], data["dimensions"])
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key, image_base64, dimensions):
+        self.remember(key, (image_base64, dimensions))
+        entry_path = self.entry_path(key)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"base64": image_base64, "dimensions": dimensions}, f)
+            os.replace(temp_path, entry_path)
+        except OSError:
+            return  # The disk cache is only an optimization
+
+        with self.lock:
+            self.written_bytes += len(image_base64)
+            needs_pruning = self.written_bytes > self.max_disk_bytes * self.PRUNE_FRACTION
+            if needs_pruning:
+                self.written_bytes = 0
+        if needs_pruning:
+            self.prune()
+
+    def remember(self, key, entry):
+        with self.lock:
+            previous_entry = self.memory.pop(key, None)
+            if previous_entry is not None:
+                self.memory_bytes -= len(previous_entry[0])
+            self.memory[key] = entry
+            self.memory_bytes += len(entry[0])
+            while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+                _, (image_base64, _) = self.memory.popitem(last=False)
+                self.memory_bytes -= len(image_base64)
+
+    def prune(self, remove_temp_files=False):
+        """
+        Delete the least recently used entries on disk once they take more than max_disk_bytes.
+        Temporary files are only removed on startup, since they may be entries being written otherwise.
+        """
+        with self.prune_lock:
+            entries = []  # (mtime, size, path)
+            try:
+                with os.scandir(self.cache_dir) as scandir:
+                    for entry in scandir:
+                        try:
+                            if not entry.is_file():
+                                continue
+                            if entry.name.endswith(".tmp"):
+                                if remove_temp_files:
+                                    os.remove(entry.path)
+                                continue
+                            stat = entry.stat()
+                        except OSError:
+                            continue  # E.g. just replaced
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                return
+            entries.sort(reverse=True)
+            total_bytes = 0
+            for _, size, path in entries:
+                total_bytes += size
+                if total_bytes > self.max_disk_bytes:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
@@ -0,0 +1,134 @@
+import io
+import math
+from PIL import features
+
+
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+LOSSY_FORMATS = ("JPEG", "WEBP")
+ALPHA_FORMATS = ("PNG", "WEBP")
+DEFAULT_QUALITY = 90
+MIN_QUALITY = 60  # Lossy formats are downscaled rather than compressed any harder
+SAMPLE_SIZE = 512  # Longest side of the sample that sizes are predicted from
+TARGET_FILL = 0.95  # Fraction of the size limit aimed at, to land just under it
+MAX_ATTEMPTS = 6
+
+
+def has_transparency(image):
+    """Whether a PIL image has any (partly) transparent pixel, e.g. the nodata pixels of raw chips"""
+    if "A" in image.getbands():
+        return image.getchannel("A").getextrema()[0] < 255
+    return "transparency" in image.info
+
+
+def supported_format(image_format, image=None):
+    """
+    The format itself if this PIL build can write it (WebP support is optional) and, if `image` is given,
+    keep its transparent pixels, PNG otherwise
+    """
+    if image_format == "WEBP" and not features.check("webp"):
+        return "PNG"
+    if image_format not in ALPHA_FORMATS and image is not None and has_transparency(image):
+        return "PNG"
+    return image_format
+
+
+def scale_to_px_limits(width, height, px_limits):
+    """Scale that brings a width x height image within the longest and shortest side limits, never above 1"""
+    return min(1, px_limits["longest_side"] / max(width, height), px_limits["shortest_side"] / min(width, height))
+
+
+def resize_to_px_limits(image, px_limits):
+    """Downscale a PIL image, keeping its aspect ratio, for it to be within the longest and shortest side limits"""
+    scale = scale_to_px_limits(image.width, image.height, px_limits)
+    if scale >= 1:
+        return image
+    return image.resize((int(round(image.width * scale)), int(round(image.height * scale))))
+
+
+def encode_image(image, image_format="PNG", quality=None):
+    """Encode a PIL image, dropping its alpha channel for formats that don't support one"""
+    if image_format in LOSSY_FORMATS:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        save_kwargs = {"quality": quality or DEFAULT_QUALITY}
+    else:
+        save_kwargs = {}
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **save_kwargs)
+    return buffer.getvalue()
+
+
+def resize_image(image, scale):
+    if scale >= 1:
+        return image
+    return image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+
+
+def _scale_to_fit(predicted_bytes, max_bytes):
+    """Scale predicted to bring an image of `predicted_bytes` under the limit, assuming size goes with area"""
+    return min(1.0, math.sqrt(TARGET_FILL * max_bytes / max(predicted_bytes, 1)))
+
+
+def encode_image_within_size(image, max_bytes, formats=("PNG",), quality=DEFAULT_QUALITY):
+    """
+    Encode a PIL image in whichever of `formats` keeps the most pixels within `max_bytes`, preferring the first
+    ones on ties (e.g. PNG if it fits at full resolution). Images with transparent pixels are only encoded in
+    formats that keep them, see supported_format. For lossy formats, the highest quality down to
+    MIN_QUALITY that's predicted to fit at full resolution is used.
+    Sizes are predicted from a downsampled sample, then the scale is refined with a few encodes at the predicted
+    resolutions, so the full resolution image is only encoded if it's predicted to fit.
+    Returns the encoded bytes, their format and their (width, height).
+    """
+    formats = list(dict.fromkeys(supported_format(image_format, image) for image_format in formats))
+    sample_scale = min(1.0, SAMPLE_SIZE / max(image.size))
+    sample = resize_image(image, sample_scale)
+
+    def predict_bytes(image_format, format_quality):
+        return len(encode_image(sample, image_format, format_quality)) / sample_scale ** 2
+
+    # Pick the format, and quality for lossy ones, predicted to need the least downscaling
+    best = None  # (scale, format, quality)
+    for image_format in formats:
+        format_quality = quality if image_format in LOSSY_FORMATS else None
+        scale = _scale_to_fit(predict_bytes(image_format, format_quality), max_bytes)
+        if scale < 1 and format_quality is not None:
+            # Binary search the highest quality predicted to fit at full resolution, if any
+            low, high = MIN_QUALITY, format_quality
+            while low < high:
+                middle = (low + high + 1) // 2
+                if _scale_to_fit(predict_bytes(image_format, middle), max_bytes) >= 1:
+                    low = middle
+                else:
+                    high = middle - 1
+            format_quality = low
+            scale = _scale_to_fit(predict_bytes(image_format, format_quality), max_bytes)
+        if best is None or scale > best[0]:
+            best = (scale, image_format, format_quality)
+    scale, image_format, format_quality = best
+
+    # Refine the scale with actual encodes, re-predicting from the last one and bisecting if that doesn't narrow it
+    fitting = None
+    low, high = 0.0, 1.0
+    for _ in range(MAX_ATTEMPTS):
+        resized = resize_image(image, scale)
+        data = encode_image(resized, image_format, format_quality)
+        if len(data) <= max_bytes:
+            fitting = (data, resized.size)
+            low = scale
+            if scale >= 1 or len(data) >= TARGET_FILL ** 2 * max_bytes:
+                break
+        else:
+            high = scale
+        next_scale = scale * math.sqrt(TARGET_FILL * max_bytes / len(data))
+        scale = next_scale if low < next_scale < high else (low + high) / 2
+
+    # Very unlikely, but never send an image over the limit
+    while fitting is None:
+        scale /= 2
+        resized = resize_image(image, scale)
+        data = encode_image(resized, image_format, format_quality)
+        if len(data) <= max_bytes:
+            fitting = (data, resized.size)
+
+    data, size = fitting
+    return data, image_format, size
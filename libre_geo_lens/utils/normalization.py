@@ -0,0 +1,93 @@
+import numpy as np
+from functools import lru_cache
+
+
+# Values below the low percentile and above the high one are clipped before stretching to [0..255]
+DEFAULT_PERCENTILES = (2, 98)
+# Statistics are computed from a strided sample of at most this many pixels per band
+MAX_STATS_SAMPLES = 1_000_000
+
+
+def nodata_mask(data, nodata):
+    """
+    Return a (rows, cols) boolean mask of the pixels of a (bands, rows, cols) array
+    that are nodata in every band, or None if there are none.
+    """
+    if nodata is None:
+        return None
+    if np.isnan(nodata):
+        if not np.issubdtype(data.dtype, np.floating):
+            return None
+        mask = np.isnan(data).all(axis=0)
+    else:
+        mask = (data == nodata).all(axis=0)
+    return mask if mask.any() else None
+
+
+def _percentiles(values, percentiles):
+    """
+    Percentiles of a 1D array. 8 and 16 bit integers are handled through their histogram,
+    which avoids sorting and floating point copies.
+    """
+    if values.size == 0:
+        return [0.0] * len(percentiles)
+    if values.dtype in (np.uint8, np.uint16):
+        cumulative_counts = np.cumsum(np.bincount(values))
+        ranks = [int(percentile / 100 * (values.size - 1)) for percentile in percentiles]
+        return [float(np.searchsorted(cumulative_counts, rank, side="right")) for rank in ranks]
+    return [float(value) for value in np.percentile(values, percentiles)]
+
+
+def compute_stretch(sample, nodata=None, percentiles=DEFAULT_PERCENTILES, per_band=True):
+    """
+    Compute the low and high values to stretch a (bands, rows, cols) array with, ignoring nodata
+    (and NaN) pixels. `sample` is usually a decimated read, and it's further subsampled if needed.
+    Returns two arrays with one value per band.
+    """
+    step = max(1, int(np.ceil(np.sqrt(sample.shape[1] * sample.shape[2] / MAX_STATS_SAMPLES))))
+    sample = sample[:, ::step, ::step]
+
+    valid = np.ones(sample.shape[1:], dtype=bool)
+    mask = nodata_mask(sample, nodata)
+    if mask is not None:
+        valid &= ~mask
+    if np.issubdtype(sample.dtype, np.floating):
+        valid &= ~np.isnan(sample).any(axis=0)
+
+    n_bands = sample.shape[0]
+    if per_band:
+        stretch = [_percentiles(sample[band][valid], percentiles) for band in range(n_bands)]
+    else:
+        stretch = [_percentiles(sample[:, valid].ravel(), percentiles)] * n_bands
+    lows, highs = np.array(stretch, dtype=np.float64).T
+    return lows, highs
+
+
+@lru_cache(maxsize=16)
+def _uint16_lut(low, high):
+    """Lookup table mapping every uint16 value to its stretched uint8 value"""
+    values = (np.arange(65536, dtype=np.float32) - low) * np.float32(255 / (high - low))
+    return np.clip(values, 0, 255, out=values).astype(np.uint8)
+
+
+def apply_stretch(data, lows, highs):
+    """
+    Stretch each band of a (bands, rows, cols) array from [low..high] to [0..255], clipping values outside of it.
+    uint8 data is returned as is, uint16 data goes through integer lookup tables and anything else through float32.
+    Constant bands become 0.
+    """
+    if data.dtype == np.uint8:
+        return data
+
+    stretched = np.zeros(data.shape, dtype=np.uint8)
+    for band, (low, high) in enumerate(zip(lows, highs)):
+        if high - low <= 0:
+            # Avoid divide-by-zero if the band is constant
+            continue
+        if data.dtype == np.uint16:
+            np.take(_uint16_lut(float(low), float(high)), data[band], out=stretched[band])
+        else:
+            values = (data[band].astype(np.float32) - np.float32(low)) * np.float32(255 / (high - low))
+            np.clip(values, 0, 255, out=values)
+            stretched[band] = np.nan_to_num(values, copy=False)
+    return stretched
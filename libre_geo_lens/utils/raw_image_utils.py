@@ -1,7 +1,15 @@
+import re
+import glob
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
 import rasterio
 import numpy as np
-from rasterio.windows import from_bounds
-from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.windows import Window, from_bounds
 from qgis.core import (
     QgsRectangle, QgsGeometry, QgsProject, QgsLayerTreeLayer,
     QgsCoordinateTransform, QgsCoordinateReferenceSystem
@@ -9,6 +17,106 @@ from qgis.core import (
 from qgis.PyQt.QtGui import QImage
 from pyproj import Transformer
 
+from . import normalization
+
+
+# Open dataset handles are reused across calls so that the header of a remote (/vsis3/, /vsicurl/) COG is only
+# fetched once per raw chip extraction. Handles idle for longer than the timeout are closed on the next access,
+# or by evict_idle_datasets, which the dock calls every DATASET_CACHE_SWEEP_INTERVAL.
+# The size and timeout can be changed in the settings, see configure_dataset_cache.
+DATASET_CACHE_SIZE = 8
+DATASET_CACHE_IDLE_TIMEOUT = 300  # seconds
+DATASET_CACHE_SWEEP_INTERVAL = 30  # seconds
+
+# Full resolution chips are read in strips of at most this many bytes (source pixels plus their float32 copy)
+STREAMING_MEMORY_BUDGET = 64 * 1024 * 1024
+# Longest side of the decimated sample that the normalization stretch is computed from
+STATS_SAMPLE_SIZE = 1024
+
+_dataset_cache = OrderedDict()  # img_path -> [dataset, last_used, users]
+_dataset_cache_lock = threading.Lock()
+
+
+def configure_dataset_cache(size=None, idle_timeout=None):
+    """
+    Change the maximum number of cached dataset handles and/or how long (in seconds)
+    an unused handle is kept open. Handles that no longer fit are closed right away.
+    """
+    global DATASET_CACHE_SIZE, DATASET_CACHE_IDLE_TIMEOUT
+    with _dataset_cache_lock:
+        if size is not None:
+            DATASET_CACHE_SIZE = max(0, int(size))
+        if idle_timeout is not None:
+            DATASET_CACHE_IDLE_TIMEOUT = idle_timeout
+        _evict_datasets(time.monotonic())
+
+
+def _evict_datasets(now):
+    """
+    Close idle handles and, least recently used first, those over the cache size.
+    Handles in use are left alone until they're released. Caller holds the lock.
+    """
+    n_over_size = len(_dataset_cache) - DATASET_CACHE_SIZE
+    for img_path, (dataset, last_used, users) in list(_dataset_cache.items()):
+        if users == 0 and (n_over_size > 0 or now - last_used > DATASET_CACHE_IDLE_TIMEOUT):
+            del _dataset_cache[img_path]
+            dataset.close()
+            n_over_size -= 1
+
+
+@contextmanager
+def open_dataset(img_path):
+    """
+    Context manager yielding an open rasterio dataset for `img_path`, reusing a cached handle if there is one.
+    Cached handles stay open on exit, for the next calls, while with the cache disabled (size 0) the handle
+    is closed. Either way, callers must not close it themselves.
+    """
+    with _dataset_cache_lock:
+        now = time.monotonic()
+        _evict_datasets(now)
+        entry = _dataset_cache.get(img_path)
+        if entry is None or entry[0].closed:
+            entry = None
+            if DATASET_CACHE_SIZE > 0:
+                entry = _dataset_cache[img_path] = [rasterio.open(img_path), now, 0]
+        if entry is not None:
+            entry[1] = now
+            entry[2] += 1
+            _dataset_cache.move_to_end(img_path)
+
+    if entry is None:
+        with rasterio.open(img_path) as dataset:
+            yield dataset
+        return
+
+    try:
+        yield entry[0]
+    finally:
+        with _dataset_cache_lock:
+            entry[1] = time.monotonic()
+            entry[2] -= 1
+            _evict_datasets(entry[1])
+
+
+def evict_idle_datasets():
+    """Close the cached handles that have been idle for longer than the timeout, without waiting for the next access"""
+    with _dataset_cache_lock:
+        _evict_datasets(time.monotonic())
+
+
+def close_cached_datasets():
+    """Close every cached dataset handle, e.g. when the plugin is unloaded."""
+    with _dataset_cache_lock:
+        while _dataset_cache:
+            _, (dataset, _, _) = _dataset_cache.popitem()
+            dataset.close()
+
+
+@lru_cache(maxsize=32)
+def get_transformer(source_crs, target_crs):
+    """Return an (always_xy) Transformer between two CRS strings, building each PROJ pipeline only once."""
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
 
 def find_topmost_cog_feature(drawn_rectangle):
     """
@@ -52,12 +160,12 @@ def get_drawn_box_geocoordinates(drawn_rectangle, image_path):
     4. Transforms that bounding box to EPSG:4326 and returns it as a QgsRectangle.
     """
     # (A) Read the TIFF’s CRS with rasterio
-    with rasterio.open(image_path) as ds:
-        tiff_crs = ds.crs
+    with open_dataset(image_path) as src:
+        tiff_crs = src.crs
 
     # (B) Transform the drawn rectangle from source CRS to TIFF CRS
     source_crs = QgsCoordinateReferenceSystem("EPSG:4326")
-    to_tiff_transform = Transformer.from_crs(source_crs.authid(), tiff_crs.to_string(), always_xy=True)
+    to_tiff_transform = get_transformer(source_crs.authid(), tiff_crs.to_string())
 
     # Extract the raw bounds (in source CRS)
     x_min_source = drawn_rectangle.xMinimum()
@@ -72,7 +180,7 @@ def get_drawn_box_geocoordinates(drawn_rectangle, image_path):
     # At this point, we have the bounding box in the TIFF's CRS
     # (C) Transform that bounding box to EPSG:4326, if TIFF CRS is not already EPSG:4326
     if tiff_crs.to_string() != "EPSG:4326":
-        to_epsg4326 = Transformer.from_crs(tiff_crs.to_string(), "EPSG:4326", always_xy=True)
+        to_epsg4326 = get_transformer(tiff_crs.to_string(), "EPSG:4326")
         min_lon, min_lat = to_epsg4326.transform(min_x_tiff, min_y_tiff)
         max_lon, max_lat = to_epsg4326.transform(max_x_tiff, max_y_tiff)
     else:
@@ -98,106 +206,261 @@ def determine_chip_size(geocoords, img_path):
     top = geocoords.yMaximum()
 
     # Open the raster file to get resolution
-    with rasterio.open(img_path) as src:
+    with open_dataset(img_path) as src:
         raster_crs = src.crs
         raster_resolution_x = abs(src.transform.a)  # Units per pixel in X
         raster_resolution_y = abs(src.transform.e)  # Units per pixel in Y
 
-        # Prevent division by zero
-        if raster_resolution_x == 0 or raster_resolution_y == 0:
-            raise ValueError("Raster resolution cannot be zero.")
+    # Prevent division by zero
+    if raster_resolution_x == 0 or raster_resolution_y == 0:
+        raise ValueError("Raster resolution cannot be zero.")
 
-        # Transform geocoordinates to raster CRS if necessary
-        if raster_crs.to_string() != "EPSG:4326":
-            transformer = Transformer.from_crs("EPSG:4326", raster_crs, always_xy=True)
-            left, bottom = transformer.transform(left, bottom)
-            right, top = transformer.transform(right, top)
+    # Transform geocoordinates to raster CRS if necessary
+    if raster_crs.to_string() != "EPSG:4326":
+        transformer = get_transformer("EPSG:4326", raster_crs.to_string())
+        left, bottom = transformer.transform(left, bottom)
+        right, top = transformer.transform(right, top)
 
-        # Calculate the chip dimensions in units
-        width_in_units = right - left
-        height_in_units = top - bottom
+    # Calculate the chip dimensions in units
+    width_in_units = right - left
+    height_in_units = top - bottom
 
-        if width_in_units <= 0 or height_in_units <= 0:
-            raise ValueError("Invalid bounding box (non-positive width/height).")
+    if width_in_units <= 0 or height_in_units <= 0:
+        raise ValueError("Invalid bounding box (non-positive width/height).")
 
-        # Convert to pixels based on the raster resolution
-        chip_width_in_pixels = int(width_in_units / raster_resolution_x)
-        chip_height_in_pixels = int(height_in_units / raster_resolution_y)
+    # Convert to pixels based on the raster resolution
+    chip_width_in_pixels = int(width_in_units / raster_resolution_x)
+    chip_height_in_pixels = int(height_in_units / raster_resolution_y)
 
-        # Ensure chip sizes are at least 1 pixel
-        chip_width_in_pixels = max(1, chip_width_in_pixels)
-        chip_height_in_pixels = max(1, chip_height_in_pixels)
+    # Ensure chip sizes are at least 1 pixel
+    chip_width_in_pixels = max(1, chip_width_in_pixels)
+    chip_height_in_pixels = max(1, chip_height_in_pixels)
 
     return chip_width_in_pixels, chip_height_in_pixels
 
 
-def extract_chip_from_tif_point_in_memory(img_path, center_latitude, center_longitude, chip_width_px, chip_height_px):
+def raw_chip_path(screen_image_path, max_dimension=None, original_size=None):
     """
-    Extract a square chip from a GeoTIFF using Rasterio, centered on
-    (center_longitude, center_latitude). Return the PNG image bytes
-    (in memory) instead of writing to disk.
+    Path of a chip's raw image, from the path of its screen image. Chips read decimated to a service's pixel limits
+    are kept apart from the full resolution one, named after their longest side and the (width, height) of the
+    chip in the imagery, so that whether they're large enough for a service can be told without the imagery.
     """
-    with rasterio.open(img_path) as src:
-        # If necessary, transform (lon/lat) from EPSG:4326 -> the raster's CRS
-        if src.crs.to_string() != "EPSG:4326":
-            transformer = Transformer.from_crs("EPSG:4326", src.crs, always_xy=True)
-            center_longitude, center_latitude = transformer.transform(
-                center_longitude, center_latitude
-            )
+    if max_dimension is None:
+        return screen_image_path.replace("_screen.png", "_raw.png")
+    width, height = original_size
+    return screen_image_path.replace("_screen.png", f"_raw_{max_dimension}px_{width}x{height}.png")
+
+
+def parse_raw_chip_path(raw_image_path):
+    """
+    The (max_dimension, original_size) that a raw image was saved with, see raw_chip_path.
+    Both are None for full resolution raw images, and None is returned for anything that isn't a raw image.
+    """
+    match = re.search(r"_raw(?:_(\d+)px_(\d+)x(\d+))?\.png$", raw_image_path)
+    if match is None:
+        return None
+    if match.group(1) is None:
+        return None, None
+    return int(match.group(1)), (int(match.group(2)), int(match.group(3)))
+
+
+def raw_chip_paths(screen_image_path):
+    """The raw images of a chip that exist: the full resolution one first, then the decimated ones, largest first"""
+    base_path = screen_image_path.replace("_screen.png", "")
+    paths = []
+    for path in glob.glob(f"{glob.escape(base_path)}_raw*.png"):
+        raw_info = parse_raw_chip_path(path)
+        if raw_info is not None and path == raw_chip_path(screen_image_path, *raw_info):
+            paths.append((float("inf") if raw_info[0] is None else raw_info[0], path))
+    return [path for _, path in sorted(paths, reverse=True)]
 
-        # Calculate window based on raster resolution
-        x_res = abs(src.transform.a)
-        y_res = abs(src.transform.a)
-        half_width_units = (chip_width_px / 2) * x_res
-        half_height_units = (chip_height_px / 2) * y_res
 
-        min_x = center_longitude - half_width_units
-        max_x = center_longitude + half_width_units
-        min_y = center_latitude - half_height_units
-        max_y = center_latitude + half_height_units
+def best_raw_chip_path(screen_image_path):
+    """The largest raw image of a chip, or the path of the full resolution one if there are none yet"""
+    paths = raw_chip_paths(screen_image_path)
+    return paths[0] if paths else raw_chip_path(screen_image_path)
 
-        window = from_bounds(min_x, min_y, max_x, max_y, transform=src.transform)
-        data = src.read(window=window)
 
-        # Validate we actually got data
-        if data.shape[1] == 0 or data.shape[2] == 0:
+def reusable_raw_chip_path(screen_image_path, get_max_dimension):
+    """
+    The smallest raw image of a chip that's large enough to be sent to a service, or None if one has to be extracted.
+    `get_max_dimension(width, height)` is the longest side that the service's pixel limits allow for a chip of that
+    size, or None if it doesn't have any. Decimated raw images at least that large are only downscaled further when
+    encoded, and the full resolution one is always large enough.
+    """
+    for path in reversed(raw_chip_paths(screen_image_path)):
+        max_dimension, original_size = parse_raw_chip_path(path)
+        if max_dimension is None:
+            return path
+        needed_dimension = get_max_dimension(*original_size)
+        if needed_dimension is not None and needed_dimension <= max_dimension:
+            return path
+    return None
+
+
+def parse_band_indexes(text):
+    """
+    Parse a comma-separated list of 1-based band indexes, e.g. "5,3,2" for an RGB composite of 8-band imagery.
+    Returns a tuple with 1 or 3 (or 4, the last one being used as alpha) indexes, or None if `text` is empty.
+    """
+    if not text or not text.strip():
+        return None
+    try:
+        band_indexes = tuple(int(index) for index in text.split(","))
+    except ValueError:
+        raise ValueError(f"Invalid band list '{text}': expected comma-separated band numbers such as 5,3,2.")
+    if len(band_indexes) not in (1, 3, 4) or min(band_indexes) < 1:
+        raise ValueError(f"Invalid band list '{text}': expected 1, 3 or 4 band numbers, starting at 1.")
+    return band_indexes
+
+
+def _select_band_indexes(src, band_indexes=None):
+    """
+    The bands to read from `src`: the requested ones if given, otherwise all of them for
+    1, 3 and 4-band imagery and the first three (or the first one for 2 bands) for anything else.
+    """
+    if band_indexes is not None:
+        if max(band_indexes) > src.count:
             raise ValueError(
-                "The requested chip window is empty or invalid (out-of-bounds). "
-                f"Shape={data.shape}"
+                f"The raw chip bands {','.join(map(str, band_indexes))} were requested, "
+                f"but the imagery only has {src.count} bands. Change them in the settings."
             )
+        return list(band_indexes)
+    if src.count in (1, 3, 4):
+        return list(range(1, src.count + 1))
+    return [1] if src.count == 2 else [1, 2, 3]
+
+
+def _new_rgba_image(width, height):
+    """Allocate the output QImage and return it along with a writable (height, width, 4) view of its pixels."""
+    image = QImage(width, height, QImage.Format_RGBA8888)
+    if image.isNull():
+        raise MemoryError(f"Could not allocate a {width}x{height} image for the chip.")
+    buffer = image.bits()
+    buffer.setsize(image.sizeInBytes())
+    pixels = np.ndarray(
+        shape=(height, width, 4), dtype=np.uint8, buffer=buffer, strides=(image.bytesPerLine(), 4, 1)
+    )
+    return image, pixels
+
+
+def _write_rgba(pixels, data, stretch, nodata):
+    """
+    Normalize a (bands, rows, cols) block to [0..255] with the (lows, highs) stretch and write it into
+    the matching RGBA pixels. Nodata pixels are made transparent.
+    """
+    mask = normalization.nodata_mask(data, nodata)
+    data = normalization.apply_stretch(data, *stretch)
+
+    # RGB(A) or single-band (e.g., grayscale)
+    if data.shape[0] >= 3:
+        for channel in range(3):
+            pixels[:, :, channel] = data[channel]
+    else:
+        pixels[:, :, :3] = data[0][:, :, np.newaxis]
+    pixels[:, :, 3] = data[3] if data.shape[0] == 4 else 255
+    if mask is not None:
+        pixels[mask, 3] = 0
+
+
+def _sample_stretch(src, window, band_indexes):
+    """Stretch for a window, computed from a decimated read so that it doesn't need the full resolution pixels."""
+    scale = min(1, STATS_SAMPLE_SIZE / max(window.width, window.height))
+    out_shape = (len(band_indexes), max(1, round(window.height * scale)), max(1, round(window.width * scale)))
+    sample = src.read(band_indexes, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+    return normalization.compute_stretch(sample, src.nodata)
+
+
+def _iter_strips(src, window, band_indexes):
+    """
+    Yield (row offset within the window, data) for consecutive full-width strips of the window.
+    Strips are made of whole rows of the dataset's internal blocks and sized to STREAMING_MEMORY_BUDGET.
+    """
+    block_height = src.block_shapes[0][0]
+    bytes_per_row = window.width * len(band_indexes) * (np.dtype(src.dtypes[0]).itemsize + 4)  # + float32 copy
+    rows_per_strip = max(block_height, STREAMING_MEMORY_BUDGET // bytes_per_row // block_height * block_height)
+
+    row, stop = window.row_off, window.row_off + window.height
+    while row < stop:
+        # End strips on block boundaries so that each internal tile is only fetched once
+        strip_stop = min(stop, row // block_height * block_height + rows_per_strip)
+        strip = Window(window.col_off, row, window.width, strip_stop - row)
+        yield row - window.row_off, src.read(band_indexes, window=strip)
+        row = strip_stop
+
+
+def extract_chip_from_tif_point_in_memory(img_path, center_latitude, center_longitude, chip_width_px, chip_height_px,
+                                          max_dimension=None, band_indexes=None):
+    """
+    Extract a square chip from a GeoTIFF using Rasterio, centered on
+    (center_longitude, center_latitude). Return it as a QImage
+    (in memory) instead of writing to disk.
+    If the chip's longest side is larger than `max_dimension`, it is read
+    decimated down to it, which lets GDAL serve it from the COG's overviews.
+    Full resolution chips are read in strips and written straight into the
+    QImage, so memory use doesn't grow with the size of the chip.
+    Non-uint8 imagery gets a per-band percentile stretch (see normalization.py)
+    and nodata pixels are made transparent.
+    `band_indexes` (1-based) picks which bands make up the chip, e.g. (5, 3, 2);
+    only those are read.
+    """
+    with open_dataset(img_path) as src:
+        return _extract_chip(src, center_latitude, center_longitude, chip_width_px, chip_height_px,
+                             max_dimension, band_indexes)
+
+
+def _extract_chip(src, center_latitude, center_longitude, chip_width_px, chip_height_px, max_dimension, band_indexes):
+    band_indexes = _select_band_indexes(src, band_indexes)
+
+    # If necessary, transform (lon/lat) from EPSG:4326 -> the raster's CRS
+    if src.crs.to_string() != "EPSG:4326":
+        transformer = get_transformer("EPSG:4326", src.crs.to_string())
+        center_longitude, center_latitude = transformer.transform(
+            center_longitude, center_latitude
+        )
+
+    # Calculate window based on raster resolution
+    x_res = abs(src.transform.a)
+    y_res = abs(src.transform.a)
+    half_width_units = (chip_width_px / 2) * x_res
+    half_height_units = (chip_height_px / 2) * y_res
+
+    min_x = center_longitude - half_width_units
+    max_x = center_longitude + half_width_units
+    min_y = center_latitude - half_height_units
+    max_y = center_latitude + half_height_units
+
+    window = from_bounds(min_x, min_y, max_x, max_y, transform=src.transform)
+
+    # Snap the window to whole pixels within the raster
+    col_start, row_start = max(0, round(window.col_off)), max(0, round(window.row_off))
+    col_stop = min(src.width, round(window.col_off + window.width))
+    row_stop = min(src.height, round(window.row_off + window.height))
+
+    # Validate we actually got data
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError(
+            "The requested chip window is empty or invalid (out-of-bounds). "
+            f"Window={window}"
+        )
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+    # Only read as many pixels as will be sent
+    width, height = window.width, window.height
+    if max_dimension is not None and max(width, height) > max_dimension:
+        scale = max_dimension / max(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+
+    image_to_send, pixels = _new_rgba_image(width, height)
+    if (width, height) != (window.width, window.height):
+        # Decimated reads are bounded by the service limits, so they are done in one go
+        data = src.read(band_indexes, window=window, out_shape=(len(band_indexes), height, width),
+                        resampling=Resampling.average)
+        stretch = (None, None) if data.dtype == np.uint8 else normalization.compute_stretch(data, src.nodata)
+        _write_rgba(pixels, data, stretch, src.nodata)
+    else:
+        stretch = (None, None) if src.dtypes[0] == "uint8" else _sample_stretch(src, window, band_indexes)
+        for row_offset, data in _iter_strips(src, window, band_indexes):
+            _write_rgba(pixels[row_offset:row_offset + data.shape[1]], data, stretch, src.nodata)
 
-        # Determine whether RGB, RGBA, or single-band
-        bands, height, width = data.shape
-        if bands == 3:
-            mode = "RGB"
-        elif bands == 4:
-            mode = "RGBA"
-        else:
-            mode = "L"  # single-band (e.g., grayscale)
-
-        # If data isn't uint8, normalize to [0..255]
-        if data.dtype != np.uint8:
-            data_min = np.min(data)
-            data_max = np.max(data)
-            if data_max - data_min == 0:
-                # Avoid divide-by-zero if raster is constant
-                data_normalized = np.zeros_like(data, dtype=np.uint8)
-            else:
-                data_normalized = ((data - data_min) / (data_max - data_min) * 255).astype(np.uint8)
-        else:
-            data_normalized = data
-
-        # PIL expects (height, width, channels)
-        if bands > 1:
-            data_for_pil = data_normalized.transpose(1, 2, 0)
-        else:
-            data_for_pil = data_normalized[0]
-
-        # Build a PIL image
-        pil_img = Image.fromarray(data_for_pil, mode=mode)
-        if pil_img.mode != "RGBA":
-            pil_img = pil_img.convert("RGBA")
-        data = pil_img.tobytes("raw", "RGBA")
-        image_to_send = QImage(data, pil_img.width, pil_img.height, QImage.Format_RGBA8888)
-
-        return image_to_send
+    return image_to_send
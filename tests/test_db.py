@@ -0,0 +1,336 @@
+import os
+import sqlite3
+
+import pytest
+
+from libre_geo_lens.db import LogsDB
+
+
+GEOCOORDS = [[10.0, 20.0], [11.0, 20.0], [11.0, 21.0], [10.0, 21.0], [10.0, 20.0]]
+
+
+@pytest.fixture
+def logs_db(tmp_path):
+    logs_db = LogsDB(str(tmp_path / "logs.db"))
+    logs_db.initialize_database()
+    yield logs_db
+    logs_db.close()
+
+
+def create_v0_database(db_path):
+    """A database from before versioning: no SchemaVersion, no resolution columns, sequences stored as text"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE Chips (id INTEGER PRIMARY KEY AUTOINCREMENT, image_path TEXT NOT NULL, geocoords TEXT NOT NULL);
+        CREATE TABLE Interactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text_input TEXT NOT NULL,
+            text_output TEXT NOT NULL,
+            chips_sequence TEXT NOT NULL,
+            mllm_service TEXT NOT NULL,
+            mllm_model TEXT NOT NULL,
+            chips_mode_sequence TEXT NOT NULL
+        );
+        CREATE TABLE Chats (id INTEGER PRIMARY KEY AUTOINCREMENT, interactions_sequence TEXT NOT NULL,
+                            summary TEXT NOT NULL);
+    """)
+    conn.execute("INSERT INTO Chips (image_path, geocoords) VALUES (?, ?)", ("chips/1_screen.png", str(GEOCOORDS)))
+    conn.execute("INSERT INTO Chips (image_path, geocoords) VALUES (?, ?)", ("chips/2_screen.png", "[]"))
+    conn.execute("""
+        INSERT INTO Interactions (text_input, text_output, chips_sequence, mllm_service, mllm_model,
+                                  chips_mode_sequence)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, ("Count the ships in the harbor", "There are three ships", "[1, 2]", "OpenAI", "gpt-4o",
+          "['screen', 'raw']"))
+    conn.execute("""
+        INSERT INTO Interactions (text_input, text_output, chips_sequence, mllm_service, mllm_model,
+                                  chips_mode_sequence)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, ("Any aircraft?", "No", "[]", "OpenAI", "gpt-4o", "[]"))
+    conn.execute("INSERT INTO Chats (interactions_sequence, summary) VALUES (?, ?)", ("[1, 2]", "Harbor"))
+    conn.commit()
+    conn.close()
+
+
+def schema_version(logs_db):
+    return logs_db.connection.execute("SELECT version FROM SchemaVersion").fetchone()[0]
+
+
+def test_new_database_is_created_at_the_current_version(logs_db):
+    assert schema_version(logs_db) == LogsDB.CURRENT_VERSION
+    assert logs_db.count_chats() == 0
+
+
+def test_initializing_twice_is_a_no_op(tmp_path):
+    db_path = str(tmp_path / "logs.db")
+    for _ in range(2):
+        logs_db = LogsDB(db_path)
+        logs_db.initialize_database()
+        assert schema_version(logs_db) == LogsDB.CURRENT_VERSION
+        logs_db.close()
+
+
+def test_unversioned_database_is_migrated_and_backfilled(tmp_path):
+    db_path = str(tmp_path / "logs.db")
+    create_v0_database(db_path)
+    logs_db = LogsDB(db_path)
+    logs_db.initialize_database()
+
+    assert schema_version(logs_db) == LogsDB.CURRENT_VERSION
+    columns = {column[1] for column in logs_db.connection.execute("PRAGMA table_info(Interactions)")}
+    assert {"chips_original_resolutions", "chips_actual_resolutions"} <= columns
+
+    # Junction tables (v2)
+    interactions = logs_db.fetch_chat_bundle(1)
+    assert [interaction["id"] for interaction in interactions] == [1, 2]
+    assert [(chip["id"], chip["mode"]) for chip in interactions[0]["chips"]] == [(1, "screen"), (2, "raw")]
+    assert interactions[1]["chips"] == []
+
+    # Spatial index (v3), chips without footprint are left out of it
+    assert [chip[0] for chip in logs_db.query_chips_at_point(10.5, 20.5)] == [1]
+
+    # Full-text index (v4)
+    assert logs_db.search_interactions("ships") == [(1, "Harbor", 1)]
+    logs_db.close()
+
+
+def test_version_1_database_is_migrated(tmp_path):
+    db_path = str(tmp_path / "logs.db")
+    create_v0_database(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        ALTER TABLE Interactions ADD COLUMN chips_original_resolutions TEXT;
+        ALTER TABLE Interactions ADD COLUMN chips_actual_resolutions TEXT;
+        UPDATE Interactions SET chips_original_resolutions = "['100x100', '4000x3000']",
+                                chips_actual_resolutions = "['100x100', '2048x1536']" WHERE id = 1;
+        CREATE TABLE SchemaVersion (version INTEGER NOT NULL);
+        INSERT INTO SchemaVersion (version) VALUES (1);
+    """)
+    conn.close()
+
+    logs_db = LogsDB(db_path)
+    logs_db.initialize_database()
+    assert schema_version(logs_db) == LogsDB.CURRENT_VERSION
+    chips = logs_db.fetch_chat_bundle(1)[0]["chips"]
+    assert [(chip["original_res"], chip["actual_res"]) for chip in chips] == [
+        ("100x100", "100x100"), ("4000x3000", "2048x1536")
+    ]
+    logs_db.close()
+
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "logs.db")
+    create_v0_database(db_path)
+
+    def fail(self, conn, cursor):
+        raise sqlite3.OperationalError("interrupted")
+    monkeypatch.setattr(LogsDB, "_migrate_to_v4", fail)
+    logs_db = LogsDB(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        logs_db.initialize_database()
+    logs_db.close()
+
+    conn = sqlite3.connect(db_path)
+    tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    assert "SchemaVersion" not in tables and "ChatInteractions" not in tables
+
+
+def test_spatial_queries(logs_db):
+    inside = logs_db.save_chip("chips/1_screen.png", GEOCOORDS)
+    elsewhere = logs_db.save_chip("chips/2_screen.png", [[50.0, 50.0], [51.0, 51.0]])
+
+    assert [chip[0] for chip in logs_db.query_chips_at_point(10.5, 20.5)] == [inside]
+    assert logs_db.query_chips_at_point(30.0, 30.0) == []
+    assert sorted(chip[0] for chip in logs_db.query_chips_in_bbox(10.9, 20.9, 50.5, 50.5)) == [inside, elsewhere]
+    assert logs_db.query_chips_in_bbox(12.0, 22.0, 13.0, 23.0) == []
+
+
+def test_deleted_chips_leave_the_spatial_index(logs_db):
+    chat_id = logs_db.save_chat([])
+    chip = {"image_path": "chips/tmp_screen.png", "geocoords": GEOCOORDS, "mode": "screen",
+            "original_res": "10x10", "actual_res": "10x10"}
+    logs_db.record_interaction(chat_id, "prompt", "response", [chip], "OpenAI", "gpt-4o")
+    assert len(logs_db.query_chips_at_point(10.5, 20.5)) == 1
+
+    logs_db.delete_chat(chat_id, delete_chips=True)
+    assert logs_db.query_chips_at_point(10.5, 20.5) == []
+
+
+def add_chat(logs_db, turns, summary=""):
+    chat_id = logs_db.save_chat([])
+    for prompt, response in turns:
+        logs_db.record_interaction(chat_id, prompt, response, [], "OpenAI", "gpt-4o")
+    if summary:
+        logs_db.update_chat_summary(chat_id, summary)
+    return chat_id
+
+
+def test_search_matches_prompts_and_responses(logs_db):
+    harbor = add_chat(logs_db, [("Count the ships", "Three cargo ships")], "Harbor")
+    airfield = add_chat(logs_db, [("Any aircraft?", "Two jets on the runway")], "Airfield")
+
+    assert logs_db.search_interactions("ships") == [(harbor, "Harbor", 1)]
+    assert logs_db.search_interactions("runway") == [(airfield, "Airfield", 2)]
+    assert logs_db.search_interactions("submarine") == []
+    assert logs_db.search_interactions("   ") == []
+
+
+def test_search_requires_every_term_and_prefixes_the_last_one(logs_db):
+    chat_id = add_chat(logs_db, [("Count the cargo ships", "Three")])
+    add_chat(logs_db, [("Count the cars", "Twelve")])
+
+    assert [row[0] for row in logs_db.search_interactions("cargo shi")] == [chat_id]
+    assert logs_db.search_interactions("cargo cars") == []
+
+
+def test_search_returns_one_row_per_chat(logs_db):
+    chat_id = add_chat(logs_db, [("ships?", "one ship"), ("more ships?", "ships ships ships")])
+
+    rows = logs_db.search_interactions("ships")
+    assert [row[0] for row in rows] == [chat_id]
+    assert rows[0][2] in (1, 2)
+
+
+def test_search_handles_fts_syntax_in_the_text(logs_db):
+    chat_id = add_chat(logs_db, [('What does "NEAR" mean?', "A keyword (sometimes) AND an operator")])
+
+    assert [row[0] for row in logs_db.search_interactions('"NEAR')] == [chat_id]
+    assert [row[0] for row in logs_db.search_interactions("AND (sometimes")] == [chat_id]
+
+
+def test_deleted_chats_leave_the_search_index(logs_db):
+    chat_id = add_chat(logs_db, [("Count the ships", "Three")])
+    logs_db.delete_chat(chat_id, delete_chips=False)
+
+    assert logs_db.search_interactions("ships") == []
+    assert logs_db.connection.execute("SELECT COUNT(*) FROM InteractionsFTS").fetchone()[0] == 0
+
+
+def test_chat_summaries_are_paged_newest_first(logs_db):
+    chat_ids = [add_chat(logs_db, [], f"Chat {i}") for i in range(5)]
+
+    assert logs_db.count_chats() == 5
+    first_page = logs_db.fetch_chat_summaries(0, 2)
+    assert first_page == [(chat_ids[4], "Chat 4"), (chat_ids[3], "Chat 3")]
+    pages = first_page + logs_db.fetch_chat_summaries(2, 2) + logs_db.fetch_chat_summaries(4, 2)
+    assert [chat_id for chat_id, _ in pages] == chat_ids[::-1]
+    assert logs_db.fetch_chat_summaries(5, 2) == []
+
+
+def new_chip(image_path):
+    return {"image_path": image_path, "geocoords": GEOCOORDS, "mode": "raw",
+            "original_res": "4000x3000", "actual_res": "2048x1536"}
+
+
+def test_record_interaction_saves_new_and_existing_chips(logs_db):
+    chat_id = logs_db.save_chat([])
+    existing_chip_id = logs_db.save_chip("chips/1_screen.png", GEOCOORDS)
+    chips = [
+        {"id": existing_chip_id, "mode": "screen", "original_res": "100x100", "actual_res": "100x100"},
+        new_chip("pending/tmp_screen.png")
+    ]
+
+    interaction_id, chip_ids = logs_db.record_interaction(
+        chat_id, "prompt", "response", chips, "OpenAI", "gpt-4o",
+        summary="Summary", finalize_image_path=lambda image_path, chip_id: f"chips/{chip_id}_screen.png"
+    )
+
+    assert chip_ids == [existing_chip_id, chips[1]["id"]]
+    assert chips[1]["image_path"] == f"chips/{chip_ids[1]}_screen.png"
+    assert logs_db.fetch_chip_by_id(chip_ids[1])[1] == chips[1]["image_path"]
+    assert logs_db.fetch_chat_by_id(chat_id)[2] == "Summary"
+    assert logs_db.fetch_first_turns(chat_id, 4) == [("prompt", "response")]
+
+    interaction, = logs_db.fetch_chat_bundle(chat_id)
+    assert interaction["id"] == interaction_id
+    assert [(chip["id"], chip["image_path"], chip["mode"], chip["original_res"], chip["actual_res"])
+            for chip in interaction["chips"]] == [
+        (existing_chip_id, "chips/1_screen.png", "screen", "100x100", "100x100"),
+        (chip_ids[1], chips[1]["image_path"], "raw", "4000x3000", "2048x1536")
+    ]
+
+
+def test_record_interaction_is_all_or_nothing(logs_db):
+    chat_id = logs_db.save_chat([])
+
+    def fail(image_path, chip_id):
+        raise OSError("disk full")
+    with pytest.raises(OSError):
+        logs_db.record_interaction(chat_id, "prompt", "response", [new_chip("pending/tmp_screen.png")],
+                                   "OpenAI", "gpt-4o", summary="Summary", finalize_image_path=fail)
+
+    assert logs_db.fetch_all_chips() == []
+    assert logs_db.fetch_all_interactions() == []
+    assert logs_db.count_chat_interactions(chat_id) == 0
+    assert logs_db.fetch_chat_by_id(chat_id)[2] == ""
+    assert logs_db.query_chips_at_point(10.5, 20.5) == []
+    assert logs_db.search_interactions("prompt") == []
+
+
+def test_record_interaction_moves_images_back_on_failure(logs_db, tmp_path):
+    pending_dir, chips_dir = tmp_path / "pending", tmp_path / "chips"
+    pending_dir.mkdir()
+    chips_dir.mkdir()
+    chips = []
+    for key in ("a", "b"):
+        (pending_dir / f"{key}_screen.png").write_bytes(key.encode())
+        chips.append(new_chip(str(pending_dir / f"{key}_screen.png")))
+
+    # Both chips are saved and their images moved before the link to the (missing) chat fails
+    with pytest.raises(TypeError):
+        logs_db.record_interaction(
+            12345, "prompt", "response", chips, "OpenAI", "gpt-4o",
+            finalize_image_path=lambda image_path, chip_id: str(chips_dir / f"{chip_id}_screen.png"),
+            move_image=os.replace
+        )
+
+    assert sorted(os.listdir(pending_dir)) == ["a_screen.png", "b_screen.png"]
+    assert os.listdir(chips_dir) == []
+    assert [chip["image_path"] for chip in chips] == [str(pending_dir / "a_screen.png"),
+                                                      str(pending_dir / "b_screen.png")]
+    assert all("id" not in chip for chip in chips)
+    assert logs_db.fetch_all_chips() == []
+
+
+def test_nested_transactions_join_the_outermost_one(logs_db):
+    with pytest.raises(RuntimeError):
+        with logs_db.transaction():
+            logs_db.save_chip("chips/1_screen.png", GEOCOORDS)
+            with logs_db.transaction():
+                logs_db.save_chip("chips/2_screen.png", GEOCOORDS)
+            raise RuntimeError()
+
+    assert logs_db.fetch_all_chips() == []
+    logs_db.save_chip("chips/3_screen.png", GEOCOORDS)
+    assert len(logs_db.fetch_all_chips()) == 1
+
+
+def test_delete_chat_keeps_chips_used_by_other_chats(logs_db):
+    first_chat = logs_db.save_chat([])
+    second_chat = logs_db.save_chat([])
+    _, (shared_chip, own_chip) = logs_db.record_interaction(
+        first_chat, "prompt", "response", [new_chip("chips/a_screen.png"), new_chip("chips/b_screen.png")],
+        "OpenAI", "gpt-4o"
+    )
+    logs_db.record_interaction(
+        second_chat, "prompt", "response",
+        [{"id": shared_chip, "mode": "raw", "original_res": "1x1", "actual_res": "1x1"}], "OpenAI", "gpt-4o"
+    )
+
+    assert logs_db.delete_chat(first_chat, delete_chips=True) == [("chips/b_screen.png", own_chip)]
+    assert logs_db.fetch_chip_by_id(shared_chip) is not None
+    assert [chip["id"] for chip in logs_db.fetch_chat_bundle(second_chat)[0]["chips"]] == [shared_chip]
+
+
+def test_delete_chat_deletes_chips_sent_twice_in_it_once(logs_db):
+    chat_id = logs_db.save_chat([])
+    _, (chip_id,) = logs_db.record_interaction(chat_id, "prompt", "response", [new_chip("chips/a_screen.png")],
+                                               "OpenAI", "gpt-4o")
+    logs_db.record_interaction(chat_id, "prompt", "response",
+                               [{"id": chip_id, "mode": "screen", "original_res": "1x1", "actual_res": "1x1"}],
+                               "OpenAI", "gpt-4o")
+
+    assert logs_db.delete_chat(chat_id, delete_chips=True) == [("chips/a_screen.png", chip_id)]
+    assert logs_db.fetch_all_chips() == []
+    assert logs_db.connection.execute("SELECT COUNT(*) FROM InteractionChips").fetchone()[0] == 0
@@ -0,0 +1,82 @@
+import os
+
+from libre_geo_lens.utils.encoded_image_cache import EncodedImageCache
+
+
+DIMENSIONS = {"original": "10x10", "final": "10x10", "was_resized": False, "mime_type": "image/png"}
+
+
+def disk_entries(cache):
+    return sorted(name for name in os.listdir(cache.cache_dir) if name.endswith(".json"))
+
+
+def test_least_recently_used_entries_leave_memory_first(tmp_path):
+    cache = EncodedImageCache(str(tmp_path / "cache"), max_memory_bytes=30)
+    cache.put("a", "a" * 10, DIMENSIONS)
+    cache.put("b", "b" * 10, DIMENSIONS)
+    cache.get("a")
+    cache.put("c", "c" * 10, DIMENSIONS)
+    cache.put("d", "d" * 10, DIMENSIONS)
+
+    assert list(cache.memory) == ["a", "c", "d"]
+    assert cache.memory_bytes == 30
+
+
+def test_entries_evicted_from_memory_are_read_from_disk(tmp_path):
+    cache = EncodedImageCache(str(tmp_path / "cache"), max_memory_bytes=10)
+    cache.put("a", "a" * 10, DIMENSIONS)
+    cache.put("b", "b" * 10, DIMENSIONS)
+    assert "a" not in cache.memory
+
+    assert cache.get("a") == ("a" * 10, DIMENSIONS)
+    assert list(cache.memory) == ["a"]
+    # And by a new cache, e.g. in the next session
+    assert EncodedImageCache(str(tmp_path / "cache")).get("b") == ("b" * 10, DIMENSIONS)
+    assert cache.get("c") is None
+
+
+def test_keys_change_with_the_image_file_and_the_limits(tmp_path):
+    image_path = tmp_path / "1_screen.png"
+    image_path.write_bytes(b"screen")
+    limits = {"image_px": {"longest_side": 2048, "shortest_side": 768}}
+    key = EncodedImageCache.make_key(str(image_path), limits)
+
+    assert EncodedImageCache.make_key(str(image_path), limits) == key
+    assert EncodedImageCache.make_key(str(image_path), {"image_mb": 4}) != key
+
+    stat = image_path.stat()
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    touched_key = EncodedImageCache.make_key(str(image_path), limits)
+    assert touched_key != key
+
+    image_path.write_bytes(b"raw chip")
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert EncodedImageCache.make_key(str(image_path), limits) not in (key, touched_key)
+
+
+def test_prune_keeps_the_most_recently_used_entries_within_the_limit(tmp_path):
+    cache = EncodedImageCache(str(tmp_path / "cache"))
+    for i, key in enumerate("abcd"):
+        cache.put(key, key * 100, DIMENSIONS)
+        os.utime(cache.entry_path(key), (1000 + i, 1000 + i))
+    entry_size = os.path.getsize(cache.entry_path("a"))
+    os.utime(cache.entry_path("a"), (2000, 2000))  # Used last
+    (tmp_path / "cache" / "e.json.1.tmp").write_text("{")
+
+    cache.max_disk_bytes = 2 * entry_size
+    cache.prune()
+
+    assert disk_entries(cache) == ["a.json", "d.json"]
+    assert os.path.exists(tmp_path / "cache" / "e.json.1.tmp")  # Could be an entry being written
+    EncodedImageCache(str(tmp_path / "cache"))
+    assert not os.path.exists(tmp_path / "cache" / "e.json.1.tmp")
+
+
+def test_disk_is_pruned_as_entries_are_written(tmp_path):
+    cache = EncodedImageCache(str(tmp_path / "cache"), max_disk_bytes=5000)
+    for i in range(50):
+        cache.put(str(i), "x" * 500, DIMENSIONS)
+
+    sizes = [os.path.getsize(cache.entry_path(str(i))) for i in range(50) if os.path.exists(cache.entry_path(str(i)))]
+    # At most what's written between two prunes over the limit
+    assert sum(sizes) <= 5000 + 5000 * EncodedImageCache.PRUNE_FRACTION + max(sizes)
@@ -0,0 +1,96 @@
+import io
+import random
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from libre_geo_lens.utils.image_encoding import (encode_image, encode_image_within_size, has_transparency,
+                                                 resize_to_px_limits, supported_format)
+
+
+# The limits of the MLLM services, see supported_api_clients in dock.py
+OPENAI_PX_LIMITS = {"longest_side": 2048, "shortest_side": 768}
+
+
+def noise_image(width, height, mode="RGB", seed=0):
+    """An image that barely compresses, so that size limits are actually hit"""
+    rng = random.Random(seed)
+    return Image.frombytes(mode, (width, height), rng.randbytes(width * height * len(mode)))
+
+
+def decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG", "WEBP"])
+def test_encoded_images_stay_within_the_byte_limit(image_format):
+    image = noise_image(1200, 900)
+    max_bytes = 300 * 1024
+
+    data, encoded_format, size = encode_image_within_size(image, max_bytes, formats=(image_format,))
+
+    assert len(data) <= max_bytes
+    assert encoded_format == supported_format(image_format)
+    decoded = decode(data)
+    assert decoded.format == encoded_format
+    assert decoded.size == size
+    assert size[0] < 1200 and abs(size[0] / size[1] - 4 / 3) < 0.01
+
+
+def test_images_within_the_byte_limit_are_kept_at_full_resolution():
+    image = Image.new("RGB", (800, 600), (10, 120, 200))
+
+    data, encoded_format, size = encode_image_within_size(image, 4 * 1024 * 1024, formats=("PNG", "JPEG", "WEBP"))
+
+    assert encoded_format == "PNG"
+    assert size == (800, 600)
+
+
+def test_the_format_needing_the_least_downscaling_is_picked():
+    image = noise_image(1200, 900)
+
+    data, encoded_format, size = encode_image_within_size(image, 300 * 1024, formats=("PNG", "JPEG"))
+
+    # Lossy formats fit noise in far fewer bytes than PNG
+    assert encoded_format == "JPEG"
+    assert decode(data).format == "JPEG"
+
+
+def test_lossy_formats_drop_the_alpha_channel_of_opaque_images():
+    image = noise_image(64, 64, mode="RGBA").copy()
+    image.putalpha(255)
+
+    assert not has_transparency(image)
+    assert supported_format("JPEG", image) == "JPEG"
+    assert decode(encode_image(image, "JPEG")).mode == "RGB"
+
+
+def test_transparent_images_fall_back_to_png_for_formats_without_alpha():
+    image = Image.new("RGBA", (400, 300), (10, 120, 200, 255))
+    image.paste((0, 0, 0, 0), (0, 0, 100, 100))  # Nodata
+
+    assert has_transparency(image)
+    assert supported_format("JPEG", image) == "PNG"
+    assert supported_format("PNG", image) == "PNG"
+    data, encoded_format, _ = encode_image_within_size(image, 4 * 1024 * 1024, formats=("JPEG",))
+    assert encoded_format == "PNG"
+    assert decode(data).getpixel((0, 0))[3] == 0
+
+
+@pytest.mark.parametrize("size", [(4000, 3000), (3000, 4000), (1500, 1000), (2048, 768), (500, 400)])
+def test_images_are_resized_within_the_pixel_limits(size):
+    image = Image.new("RGB", size)
+
+    resized = resize_to_px_limits(image, OPENAI_PX_LIMITS)
+
+    assert max(resized.size) <= OPENAI_PX_LIMITS["longest_side"]
+    assert min(resized.size) <= OPENAI_PX_LIMITS["shortest_side"]
+    if max(size) <= 2048 and min(size) <= 768:
+        assert resized is image
+    else:
+        # As large as the limits allow, keeping the aspect ratio
+        assert min(resized.size) == 768 or max(resized.size) == 2048
+        assert abs(resized.width / resized.height - size[0] / size[1]) < 0.01
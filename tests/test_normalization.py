@@ -0,0 +1,97 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from libre_geo_lens.utils import normalization
+from libre_geo_lens.utils.normalization import apply_stretch, compute_stretch, nodata_mask
+
+
+def test_nodata_mask_only_covers_pixels_nodata_in_every_band():
+    data = np.array([[[0, 0], [5, 0]],
+                     [[0, 7], [5, 0]]], dtype=np.uint16)
+
+    assert nodata_mask(data, None) is None
+    assert nodata_mask(data, 9) is None
+    assert nodata_mask(data, 0).tolist() == [[True, False], [False, True]]
+
+
+def test_nan_nodata_is_only_masked_for_floating_point_data():
+    data = np.array([[[np.nan, 1.0]], [[np.nan, np.nan]]], dtype=np.float32)
+
+    assert nodata_mask(data, float("nan")).tolist() == [[True, False]]
+    assert nodata_mask(np.zeros((1, 2, 2), dtype=np.uint16), float("nan")) is None
+
+
+def test_stretch_ignores_nodata_and_nan_pixels():
+    data = np.tile(np.arange(100, dtype=np.float32), (2, 10, 1))
+    data[:, :, :10] = -9999  # Nodata in every band
+    data[0, 0, 50] = np.nan
+
+    lows, highs = compute_stretch(data, nodata=-9999, percentiles=(0, 100))
+
+    assert lows.tolist() == [10.0, 10.0]
+    assert highs.tolist() == [99.0, 99.0]
+
+
+def test_uint16_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4096, size=(1, 200, 300), dtype=np.uint16)
+
+    lows, highs = compute_stretch(data)
+
+    expected_low, expected_high = np.percentile(data, normalization.DEFAULT_PERCENTILES)
+    assert abs(lows[0] - expected_low) <= 1
+    assert abs(highs[0] - expected_high) <= 1
+
+
+def test_stretch_is_shared_across_bands_unless_per_band():
+    data = np.stack([np.arange(100, dtype=np.float32).reshape(10, 10),
+                     np.arange(100, 200, dtype=np.float32).reshape(10, 10)])
+
+    lows, highs = compute_stretch(data, percentiles=(0, 100))
+    assert lows.tolist() == [0.0, 100.0] and highs.tolist() == [99.0, 199.0]
+    lows, highs = compute_stretch(data, percentiles=(0, 100), per_band=False)
+    assert lows.tolist() == [0.0, 0.0] and highs.tolist() == [199.0, 199.0]
+
+
+def test_uint8_data_is_passed_through():
+    data = np.arange(12, dtype=np.uint8).reshape(3, 2, 2)
+
+    assert apply_stretch(data, [4, 4, 4], [8, 8, 8]) is data
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_stretch_maps_low_and_high_to_the_full_range(dtype):
+    data = np.array([[[100, 200, 300, 400]]], dtype=dtype)
+
+    stretched = apply_stretch(data, [200], [300])
+
+    assert stretched.dtype == np.uint8
+    assert stretched.tolist() == [[[0, 0, 255, 255]]]
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_constant_bands_become_zero(dtype):
+    data = np.full((2, 3, 3), 1000, dtype=dtype)
+    data[1] = np.arange(9).reshape(3, 3)
+
+    stretched = apply_stretch(data, [1000, 0], [1000, 8])
+
+    assert (stretched[0] == 0).all()
+    assert stretched[1].max() == 255
+
+
+def test_uint16_lookup_table_matches_the_float_computation():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 65536, size=(3, 64, 64), dtype=np.uint16)
+    lows, highs = np.array([100.0, 2000.0, 0.0]), np.array([3000.0, 60000.5, 65535.0])
+
+    stretched = apply_stretch(data, lows, highs)
+
+    np.testing.assert_array_equal(stretched, apply_stretch(data.astype(np.float32), lows, highs))
+
+
+def test_nan_pixels_become_zero():
+    data = np.array([[[np.nan, 5.0, 10.0]]], dtype=np.float32)
+
+    assert apply_stretch(data, [0], [10]).tolist() == [[[0, 127, 255]]]
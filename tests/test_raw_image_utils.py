@@ -0,0 +1,125 @@
+import pytest
+
+pytest.importorskip("qgis.core")
+np = pytest.importorskip("numpy")
+rasterio = pytest.importorskip("rasterio")
+
+from libre_geo_lens.utils import raw_image_utils as ru
+
+# Only the dataset handles are looked at, the test imagery isn't georeferenced
+pytestmark = pytest.mark.filterwarnings("ignore::rasterio.errors.NotGeoreferencedWarning")
+
+
+@pytest.fixture
+def screen_image_path(tmp_path):
+    path = tmp_path / "7_screen.png"
+    path.write_bytes(b"screen")
+    return str(path)
+
+
+@pytest.fixture
+def tif_paths(tmp_path):
+    paths = []
+    for name in ("a", "b"):
+        path = str(tmp_path / f"{name}.tif")
+        with rasterio.open(path, "w", driver="GTiff", width=4, height=4, count=1, dtype="uint8") as dst:
+            dst.write(np.zeros((1, 4, 4), dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def dataset_cache():
+    size, idle_timeout = ru.DATASET_CACHE_SIZE, ru.DATASET_CACHE_IDLE_TIMEOUT
+    yield
+    ru.close_cached_datasets()
+    ru.configure_dataset_cache(size=size, idle_timeout=idle_timeout)
+
+
+def touch(path):
+    with open(path, "wb"):
+        pass
+    return path
+
+
+@pytest.mark.parametrize("text, band_indexes", [
+    ("", None), ("  ", None), (None, None), ("1", (1,)), ("5,3,2", (5, 3, 2)), (" 4, 3 ,2,1", (4, 3, 2, 1))
+])
+def test_parse_band_indexes(text, band_indexes):
+    assert ru.parse_band_indexes(text) == band_indexes
+
+
+@pytest.mark.parametrize("text", ["5,3", "1,2,3,4,5", "0,1,2", "r,g,b", "5;3;2"])
+def test_parse_band_indexes_rejects_invalid_lists(text):
+    with pytest.raises(ValueError, match="Invalid band list"):
+        ru.parse_band_indexes(text)
+
+
+def test_raw_chip_paths_are_named_after_the_screen_image():
+    assert ru.raw_chip_path("chips/7_screen.png") == "chips/7_raw.png"
+    assert ru.raw_chip_path("chips/7_screen.png", 1568, (4000, 3000)) == "chips/7_raw_1568px_4000x3000.png"
+    assert ru.parse_raw_chip_path("chips/7_raw.png") == (None, None)
+    assert ru.parse_raw_chip_path("chips/7_raw_1568px_4000x3000.png") == (1568, (4000, 3000))
+    assert ru.parse_raw_chip_path("chips/7_screen.png") is None
+
+
+def test_raw_chip_paths_lists_full_resolution_first_then_largest(screen_image_path):
+    assert ru.raw_chip_paths(screen_image_path) == []
+    assert ru.best_raw_chip_path(screen_image_path) == ru.raw_chip_path(screen_image_path)
+
+    small = touch(ru.raw_chip_path(screen_image_path, 768, (4000, 3000)))
+    large = touch(ru.raw_chip_path(screen_image_path, 1568, (4000, 3000)))
+    touch(screen_image_path.replace("7_screen.png", "7_raw_notes.png"))
+    touch(screen_image_path.replace("7_screen.png", "77_raw.png"))
+    assert ru.raw_chip_paths(screen_image_path) == [large, small]
+    assert ru.best_raw_chip_path(screen_image_path) == large
+
+    full = touch(ru.raw_chip_path(screen_image_path))
+    assert ru.raw_chip_paths(screen_image_path) == [full, large, small]
+    assert ru.best_raw_chip_path(screen_image_path) == full
+
+
+def test_reusable_raw_chip_path_is_the_smallest_large_enough(screen_image_path):
+    small = touch(ru.raw_chip_path(screen_image_path, 768, (4000, 3000)))
+    large = touch(ru.raw_chip_path(screen_image_path, 1568, (4000, 3000)))
+
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: 768) == small
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: 1024) == large
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: 2048) is None
+    # Services without pixel limits need the full resolution chip
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: None) is None
+
+    full = touch(ru.raw_chip_path(screen_image_path))
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: 2048) == full
+    assert ru.reusable_raw_chip_path(screen_image_path, lambda width, height: None) == full
+
+
+def test_idle_datasets_are_evicted_without_being_accessed(tif_paths, dataset_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ru.time, "monotonic", lambda: now[0])
+    ru.configure_dataset_cache(idle_timeout=60)
+
+    with ru.open_dataset(tif_paths[0]) as idle_dataset:
+        pass
+    with ru.open_dataset(tif_paths[1]) as used_dataset:
+        now[0] += 61
+        ru.evict_idle_datasets()
+
+        assert idle_dataset.closed
+        assert not used_dataset.closed
+        assert list(ru._dataset_cache) == [tif_paths[1]]
+
+    now[0] += 30
+    ru.evict_idle_datasets()
+    assert not used_dataset.closed
+    now[0] += 31
+    ru.evict_idle_datasets()
+    assert used_dataset.closed and not ru._dataset_cache
+
+
+def test_datasets_are_closed_on_exit_with_the_cache_disabled(tif_paths, dataset_cache):
+    ru.configure_dataset_cache(size=0)
+
+    with ru.open_dataset(tif_paths[0]) as dataset:
+        assert not dataset.closed
+    assert dataset.closed and not ru._dataset_cache
@@ -0,0 +1,293 @@
+import os
+import gzip
+import shutil
+import sqlite3
+import hashlib
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from libre_geo_lens import s3_sync
+from libre_geo_lens.s3_sync import S3LogsSync, SyncJournal, calculate_etag, snapshot_database
+
+
+MB = 1024 * 1024
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client, storing the ETags S3 would give the uploaded files"""
+    def __init__(self, fail_keys=()):
+        self.objects = {}  # key -> ETag
+        self.uploaded_keys = []
+        self.deleted_keys = []
+        self.fail_keys = set(fail_keys)
+
+    def get_paginator(self, operation):
+        fake_s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{"Contents": [{"Key": key, "ETag": f'"{etag}"'}
+                                      for key, etag in fake_s3.objects.items() if key.startswith(Prefix)]}]
+        return Paginator()
+
+    def upload_file(self, file_path, bucket, key, Config=None, Callback=None):
+        if key in self.fail_keys:
+            raise ConnectionError(f"Failed to upload {key}")
+        if Callback is not None:
+            Callback(os.path.getsize(file_path))
+        self.objects[key] = calculate_etag(file_path, Config.multipart_chunksize)
+        self.uploaded_keys.append(key)
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[Key]
+        self.deleted_keys.append(Key)
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def logs_dir(tmp_path):
+    logs_dir = str(tmp_path / "logs")
+    write_file(os.path.join(logs_dir, "logs.geojson"), b"{}")
+    write_file(os.path.join(logs_dir, "chips", "1_screen.png"), b"screen")
+    write_file(os.path.join(logs_dir, "chips", "1_raw.png"), b"raw")
+    return logs_dir
+
+
+def make_sync(logs_dir, s3, tmp_path, **kwargs):
+    return S3LogsSync(logs_dir, "s3://bucket/logs/", s3=s3, journal_path=str(tmp_path / "journal.db"), **kwargs)
+
+
+def test_etag_of_small_files_is_their_md5(tmp_path):
+    path = str(tmp_path / "file")
+    write_file(path, b"hello world")
+
+    assert calculate_etag(path) == "5eb63bbbe01eeed093cb22bb8f5acdc3"
+    assert calculate_etag(path, 5 * MB) == "5eb63bbbe01eeed093cb22bb8f5acdc3"
+
+
+def test_etag_of_multipart_files(tmp_path):
+    path = str(tmp_path / "file")
+    data = (bytes(range(256)) * (11 * MB // 256 + 1))[:11 * MB + 123]
+    write_file(path, data)
+
+    # Three parts: 5 MB, 5 MB and the rest
+    assert calculate_etag(path, 5 * MB) == "a3793b934c69bf6075985cd13e96b0f2-3"
+    # A file exactly one part large is uploaded in one part
+    write_file(path, data[:5 * MB])
+    assert calculate_etag(path, 5 * MB) == hashlib.md5(hashlib.md5(data[:5 * MB]).digest()).hexdigest() + "-1"
+
+
+def test_etag_part_size_doubles_to_stay_within_the_part_limit(tmp_path, monkeypatch):
+    path = str(tmp_path / "file")
+    data = os.urandom(10 * 1024)
+    write_file(path, data)
+    monkeypatch.setattr(s3_sync, "MAX_PARTS", 4)
+
+    # 10 parts of 1 KB are too many, so parts of 4 KB are used instead, like boto3 does
+    part_digests = b"".join(hashlib.md5(data[offset:offset + 4096]).digest() for offset in range(0, len(data), 4096))
+    assert calculate_etag(path, 1024) == hashlib.md5(part_digests).hexdigest() + "-3"
+
+
+def test_first_sync_only_uploads_what_is_missing(logs_dir, tmp_path):
+    s3 = FakeS3()
+    s3.objects["logs/chips/1_screen.png"] = hashlib.md5(b"screen").hexdigest()
+    s3.objects["logs/chips/1_raw.png"] = hashlib.md5(b"outdated").hexdigest()
+    s3.objects["logs/chips/2_screen.png"] = hashlib.md5(b"deleted").hexdigest()
+
+    make_sync(logs_dir, s3, tmp_path).sync()
+
+    assert sorted(s3.uploaded_keys) == ["logs/chips/1_raw.png", "logs/logs.geojson"]
+    assert s3.deleted_keys == ["logs/chips/2_screen.png"]
+    assert sorted(SyncJournal(str(tmp_path / "journal.db")).entries()) == [
+        "chips/1_raw.png", "chips/1_screen.png", "logs.geojson"
+    ]
+
+
+def test_later_syncs_only_upload_changes(logs_dir, tmp_path):
+    s3 = FakeS3()
+    make_sync(logs_dir, s3, tmp_path).sync()
+    s3.uploaded_keys.clear()
+
+    make_sync(logs_dir, s3, tmp_path).sync()
+    assert s3.uploaded_keys == []
+
+    write_file(os.path.join(logs_dir, "logs.geojson"), b'{"features": []}')
+    os.remove(os.path.join(logs_dir, "chips", "1_raw.png"))
+    make_sync(logs_dir, s3, tmp_path).sync()
+    assert s3.uploaded_keys == ["logs/logs.geojson"]
+    assert s3.deleted_keys == ["logs/chips/1_raw.png"]
+    assert s3.objects["logs/logs.geojson"] == hashlib.md5(b'{"features": []}').hexdigest()
+
+
+def test_touched_but_unchanged_files_are_not_uploaded_again(logs_dir, tmp_path):
+    s3 = FakeS3()
+    make_sync(logs_dir, s3, tmp_path).sync()
+    s3.uploaded_keys.clear()
+
+    path = os.path.join(logs_dir, "logs.geojson")
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    make_sync(logs_dir, s3, tmp_path).sync()
+    assert s3.uploaded_keys == []
+
+
+def test_large_files_are_uploaded_in_parts(logs_dir, tmp_path):
+    s3 = FakeS3()
+    data = os.urandom(11 * MB)
+    write_file(os.path.join(logs_dir, "chips", "2_raw.png"), data)
+
+    sync = make_sync(logs_dir, s3, tmp_path, max_concurrency=3, part_size_mb=5)
+    assert (sync.transfer_config.multipart_chunksize, sync.transfer_config.max_concurrency) == (5 * MB, 3)
+    sync.sync()
+    assert s3.objects["logs/chips/2_raw.png"].endswith("-3")
+
+    # Matches what S3 reports, so a fresh journal doesn't upload it again
+    s3.uploaded_keys.clear()
+    os.remove(str(tmp_path / "journal.db"))
+    make_sync(logs_dir, s3, tmp_path, max_concurrency=3, part_size_mb=5).sync()
+    assert s3.uploaded_keys == []
+
+
+def test_failed_uploads_dont_lose_the_finished_ones(logs_dir, tmp_path):
+    s3 = FakeS3(fail_keys=["logs/logs.geojson"])
+
+    with pytest.raises(ConnectionError):
+        make_sync(logs_dir, s3, tmp_path, max_concurrency=1).sync()
+    recorded = set(SyncJournal(str(tmp_path / "journal.db")).entries())
+    assert recorded == {key[len("logs/"):] for key in s3.uploaded_keys}
+
+    s3.fail_keys.clear()
+    uploaded_before = list(s3.uploaded_keys)
+    make_sync(logs_dir, s3, tmp_path, max_concurrency=1).sync()
+    assert "logs/logs.geojson" in s3.uploaded_keys
+    assert not set(uploaded_before) & set(s3.uploaded_keys[len(uploaded_before):])
+
+
+def test_interrupted_sync_stops_without_deleting(logs_dir, tmp_path):
+    s3 = FakeS3()
+    make_sync(logs_dir, s3, tmp_path).sync()
+    os.remove(os.path.join(logs_dir, "chips", "1_raw.png"))
+    write_file(os.path.join(logs_dir, "chips", "2_screen.png"), b"new")
+
+    make_sync(logs_dir, s3, tmp_path).sync(is_interrupted=lambda: True)
+    assert "logs/chips/2_screen.png" not in s3.objects
+    assert "logs/chips/1_raw.png" in s3.objects
+
+
+@pytest.fixture
+def wal_db(logs_dir):
+    """logs.db in WAL mode, with commits still in its -wal file and free pages left by a deletion"""
+    conn = sqlite3.connect(os.path.join(logs_dir, "logs.db"))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.execute("CREATE TABLE Interactions (id INTEGER PRIMARY KEY, text TEXT)")
+    conn.executemany("INSERT INTO Interactions (text) VALUES (?)", [("x" * 1000,)] * 1000)
+    conn.commit()
+    conn.execute("DELETE FROM Interactions WHERE id > 10")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def read_snapshot(snapshot_path, tmp_path, compressed=False):
+    if compressed:
+        db_path = str(tmp_path / "uncompressed.db")
+        with gzip.open(snapshot_path, "rb") as f_in, open(db_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        snapshot_path = db_path
+    return sqlite3.connect(snapshot_path)
+
+
+def test_snapshot_includes_the_wal_and_drops_free_pages(logs_dir, wal_db, tmp_path):
+    assert os.path.getsize(os.path.join(logs_dir, "logs.db-wal")) > 0
+    snapshot_path = str(tmp_path / "snapshots" / "logs.db")
+
+    snapshot_database(os.path.join(logs_dir, "logs.db"), snapshot_path)
+
+    snapshot = read_snapshot(snapshot_path, tmp_path)
+    assert snapshot.execute("SELECT COUNT(*) FROM Interactions").fetchone()[0] == 10
+    assert snapshot.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert snapshot.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert snapshot.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    snapshot.close()
+    assert not os.path.exists(f"{snapshot_path}-wal")
+    assert os.path.getsize(snapshot_path) < 100 * 1024
+
+
+def test_snapshot_leaves_out_uncommitted_writes(logs_dir, wal_db, tmp_path):
+    wal_db.execute("BEGIN")
+    wal_db.execute("INSERT INTO Interactions (text) VALUES ('uncommitted')")
+    snapshot_path = str(tmp_path / "snapshots" / "logs.db")
+
+    snapshot_database(os.path.join(logs_dir, "logs.db"), snapshot_path)
+    wal_db.rollback()
+
+    snapshot = read_snapshot(snapshot_path, tmp_path)
+    assert snapshot.execute("SELECT COUNT(*) FROM Interactions").fetchone()[0] == 10
+
+
+def test_compressed_snapshots_are_reproducible(logs_dir, wal_db, tmp_path):
+    first_path, second_path = str(tmp_path / "first" / "logs.db"), str(tmp_path / "second" / "logs.db")
+
+    snapshot_database(os.path.join(logs_dir, "logs.db"), first_path, compress=True)
+    snapshot_database(os.path.join(logs_dir, "logs.db"), second_path, compress=True)
+
+    assert calculate_etag(first_path) == calculate_etag(second_path)
+    snapshot = read_snapshot(first_path, tmp_path, compressed=True)
+    assert snapshot.execute("SELECT COUNT(*) FROM Interactions").fetchone()[0] == 10
+
+
+def test_sync_uploads_snapshots_instead_of_the_database_files(logs_dir, wal_db, tmp_path):
+    s3 = FakeS3()
+    s3.objects["logs/logs.db-wal"] = "remote-wal"
+
+    sync = make_sync(logs_dir, s3, tmp_path)
+    sync.sync()
+    assert "logs/logs.db" in s3.uploaded_keys
+    assert not [key for key in s3.uploaded_keys if key.endswith(("-wal", "-shm"))]
+    assert s3.objects["logs/logs.db-wal"] == "remote-wal"
+    assert s3.objects["logs/logs.db"] == calculate_etag(os.path.join(sync.snapshot_dir, "logs.db"))
+
+    # Unchanged, so not uploaded again
+    s3.uploaded_keys.clear()
+    make_sync(logs_dir, s3, tmp_path).sync()
+    assert s3.uploaded_keys == []
+
+    # New commits are
+    wal_db.execute("INSERT INTO Interactions (text) VALUES ('new')")
+    wal_db.commit()
+    make_sync(logs_dir, s3, tmp_path).sync()
+    assert s3.uploaded_keys == ["logs/logs.db"]
+
+
+def test_snapshots_are_only_taken_again_after_writes(logs_dir, wal_db, tmp_path, monkeypatch):
+    sync = make_sync(logs_dir, FakeS3(), tmp_path)
+    db_path = os.path.join(logs_dir, "logs.db")
+    for path in (db_path, f"{db_path}-wal"):
+        os.utime(path, ns=(0, 0))
+    snapshot_path = sync.snapshot("logs.db", db_path)
+
+    monkeypatch.setattr(s3_sync, "snapshot_database", lambda *args: pytest.fail("Snapshot taken again"))
+    assert sync.snapshot("logs.db", db_path) == snapshot_path
+
+    # Snapshots are backdated, so a write dated up to the margin before one was taken still triggers another
+    os.utime(f"{db_path}-wal", ns=(0, os.stat(snapshot_path).st_mtime_ns + 1))
+    with pytest.raises(pytest.fail.Exception):
+        sync.snapshot("logs.db", db_path)
+
+
+def test_sync_uploads_compressed_snapshots(logs_dir, wal_db, tmp_path):
+    s3 = FakeS3()
+
+    sync = make_sync(logs_dir, s3, tmp_path, compress_snapshots=True)
+    sync.sync()
+
+    assert "logs/logs.db.gz" in s3.objects and "logs/logs.db" not in s3.objects
+    snapshot = read_snapshot(os.path.join(sync.snapshot_dir, "logs.db.gz"), tmp_path, compressed=True)
+    assert snapshot.execute("SELECT COUNT(*) FROM Interactions").fetchone()[0] == 10